@@ -0,0 +1,358 @@
+#!/usr/bin/python
+"""
+Time every stage of the maphot pipeline on synthetic data.
+
+For each catalog size (number of stars), a synthetic data set is made (see
+synthetic.py) and the image stages are timed on its first frame:
+  catalogLoad      readPanSTARRS of the PS1 VOTable
+  PS1_vs_SEx       matching the PS1 and Source Extractor catalogs
+  trimCatalog      trimming the Source Extractor catalog
+  inspectStars     fitting the PSF stars and building the PSF
+  trailedPSF       the line (TSF) of the PSF at the TNO's rate
+  starPhotometry   pill photometry of the PSF stars
+  centroiding      chooseCentroidAuto (with the MCMC centroid)
+  removal          removeTSF (fitting and removing the trailed TNO)
+and photcor (with the zpsolver) is timed on results stores of each number
+of frames. -n sets how many frames each synthetic data set has (only the
+first is timed; the others are there to run maphot itself on).
+Every stage is run <repeats> times. Stages whose dependencies
+(TRIPPy, stsci, ...) are missing, or whose inputs are, are skipped.
+The results are written as JSON, which benchmark.py -c <old.json> compares
+against to spot regressions between versions.
+Usage:
+  benchmark.py [-s <nstars,...>] [-f <nframes,...>] [-n <imageframes>]
+               [-r <repeats>] [-S <stage,...>] [-o <output.json>]
+               [-c <compare.json>] [-w <workdir>] [-v]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+import subprocess
+from timeit import default_timer
+import numpy as np
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHDIR)
+sys.path.insert(0, os.path.join(BENCHDIR, '..', 'maphot'))
+import synthetic  # noqa: E402
+from __version__ import __version__  # noqa: E402
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+IMAGE_STAGES = ['catalogLoad', 'PS1_vs_SEx', 'trimCatalog', 'inspectStars',
+                'trailedPSF', 'starPhotometry', 'centroiding', 'removal']
+STAGES = IMAGE_STAGES + ['photcor']
+REPFACT = 10
+ROUND_APER_RAD = 1.4
+
+
+class Quiet(object):
+  '''Send everything printed inside the with block to /dev/null.'''
+
+  def __init__(self, quiet=True):
+    self.quiet = quiet
+    self.stdout = None
+    self.devnull = None
+
+  def __enter__(self):
+    if self.quiet:
+      self.stdout, self.devnull = sys.stdout, open(os.devnull, 'w')
+      sys.stdout = self.devnull
+    return self
+
+  def __exit__(self, *args):
+    if self.quiet:
+      sys.stdout = self.stdout
+      self.devnull.close()
+    return False
+
+
+class SkipStage(Exception):
+  '''A stage that can't run here, with the reason.'''
+
+
+def timeStage(function, repeats, verbose=False):
+  '''Run function repeats times. Returns the wall times (s) and the last
+  return value.'''
+  times = []
+  for dummy in np.arange(repeats):
+    with Quiet(not verbose):
+      start = default_timer()
+      value = function()
+      times.append(default_timer() - start)
+  return times, value
+
+
+def imageStages(dataset, state):
+  '''The image stages as (name, setup) pairs. Each setup imports what the
+  stage needs, raising SkipStage if it can't run, and returns the function
+  to time and a function that stores its result in state.'''
+  from maphot_functions import getDataHeader
+  (data, header, EXPTIME, MAGZERO, MJD, MJDm, GAIN, NAXIS1, NAXIS2, WCS,
+   FILTER) = getDataHeader(dataset['frames'][0], extno=1)
+  sexCat = dataset['sexCats'][0]
+  xTNO, yTNO = sexCat['XWIN_IMAGE'][-1], sexCat['YWIN_IMAGE'][-1]
+  rate = synthetic.TNO_RATE / synthetic.PIXEL_SCALE  # pixels/hour
+  angle = synthetic.TNO_ANGLE
+
+  def need(*names):
+    missing = [name for name in names if name not in state]
+    if missing:
+      raise SkipStage('needs the result of ' + ', '.join(missing))
+
+  def catalogLoad():
+    from maphot_functions import readPanSTARRS
+    return (lambda: readPanSTARRS(dataset['panstarrs']),
+            lambda value: state.update(PS1Cat=value))
+
+  def PS1_vs_SEx():
+    from maphot_functions import PS1_vs_SEx as match
+    need('PS1Cat')
+    return (lambda: match(state['PS1Cat'], sexCat, maxDist=1.0),
+            lambda value: state.update(catalog_psf=value))
+
+  def trimCatalog():
+    from maphot_functions import trimCatalog as trim
+    return (lambda: trim(sexCat, data, dcut=5, mcut=55000, snrcut=0,
+                         shapecut=5, naxis1=NAXIS1, naxis2=NAXIS2),
+            lambda value: None)
+
+  def inspectStars():
+    from maphot_functions import inspectStars as inspect
+    need('catalog_psf')
+    return (lambda: inspect(data, state['catalog_psf'], REPFACT,
+                            noVisualSelection=True),
+            lambda value: state.update(zip(['goodFits', 'goodMeds',
+                                            'goodSTDs', 'goodPSF', 'fwhm'],
+                                           value)))
+
+  def trailedPSF():
+    need('goodPSF')
+    return (lambda: state['goodPSF'].line(rate, angle, EXPTIME / 3600.,
+                                          pixScale=1.0,
+                                          useLookupTable=True),
+            lambda value: state.update(trailed=True))
+
+  def starPhotometry():
+    from trippy import pill
+    from maphot_functions import extractGoodStarCatalogue
+    need('goodFits', 'fwhm')
+    catalog = extractGoodStarCatalogue(state['catalog_psf'],
+                                       state['goodFits'][:, 4],
+                                       state['goodFits'][:, 5])
+    fwhm = state['fwhm']
+
+    def photometry():
+      bg = []
+      for xcat, ycat in zip(catalog['XWIN_IMAGE'], catalog['YWIN_IMAGE']):
+        starPhot = pill.pillPhot(data, repFact=REPFACT)
+        starPhot(xcat, ycat, radius=fwhm * ROUND_APER_RAD, l=0.0, a=0.0,
+                 exptime=EXPTIME, zpt=MAGZERO, skyRadius=4 * fwhm,
+                 width=30., enableBGSelection=False, display=False,
+                 backupMode="smart", trimBGHighPix=3., zscale=False)
+        starPhot.SNR(gain=GAIN, useBGstd=True)
+        bg.append(starPhot.bg)
+      return np.median(bg)
+    return photometry, lambda value: state.update(bg=value)
+
+  def centroiding():
+    from maphot_functions import chooseCentroidAuto
+    need('trailed', 'bg')
+    return (lambda: chooseCentroidAuto(data, xTNO, yTNO, xTNO, yTNO,
+                                       state['bg'], state['goodPSF'], NAXIS1,
+                                       NAXIS2, repfact=REPFACT,
+                                       centroid=True),
+            lambda value: state.update(xUse=value[0], yUse=value[1]))
+
+  def removal():
+    from maphot_functions import removeTSF
+    need('xUse')
+    return (lambda: removeTSF(data, state['xUse'], state['yUse'],
+                              state['bg'], state['goodPSF'], NAXIS1, NAXIS2,
+                              header, 'benchmark', repfact=REPFACT,
+                              remove=True, diagnostics='none'),
+            lambda value: None)
+
+  return [('catalogLoad', catalogLoad), ('PS1_vs_SEx', PS1_vs_SEx),
+          ('trimCatalog', trimCatalog), ('inspectStars', inspectStars),
+          ('trailedPSF', trailedPSF), ('starPhotometry', starPhotometry),
+          ('centroiding', centroiding), ('removal', removal)]
+
+
+def runStage(name, setup, repeats, verbose=False, **counts):
+  '''Set up and time one stage, returning its result record.'''
+  record = dict(stage=name, status='ok', **counts)
+  try:
+    with Quiet(not verbose):
+      function, store = setup()
+    times, value = timeStage(function, repeats, verbose)
+    store(value)
+    record.update(times=times, best=min(times), median=np.median(times))
+  except (ImportError, SkipStage) as error:
+    record.update(status='skipped', reason=str(error))
+  except Exception as error:  # pylint: disable=broad-except
+    record.update(status='failed', reason='{}: {}'.format(
+        type(error).__name__, error))
+  print('{stage:>15} stars={nstars:<5} frames={nframes:<4} '.format(
+      **record) + ('{:9.4f} s'.format(record['best'])
+                   if record['status'] == 'ok'
+                   else '{status} ({reason})'.format(**record)))
+  return record
+
+
+def benchmarkImages(workDir, nstars, nframes, stages, repeats,
+                    verbose=False):
+  '''Time the image stages on a synthetic data set of nstars stars.
+  Making the data set (which is not timed) is skipped without astropy.'''
+  records = []
+  try:
+    with Quiet(not verbose):
+      dataset = synthetic.makeDataset(os.path.join(workDir,
+                                                   'stars{}'.format(nstars)),
+                                      nstars, nframes)
+      setups = imageStages(dataset, {})
+  except ImportError as error:
+    setups = [(name, raiser(error)) for name in IMAGE_STAGES]
+  for name, setup in setups:
+    if name in stages:
+      records.append(runStage(name, setup, repeats, verbose, nstars=nstars,
+                              nframes=1))
+  return records
+
+
+def raiser(error):
+  '''A stage setup that raises error.'''
+  def setup():
+    raise error
+  return setup
+
+
+def benchmarkPhotcor(workDir, nstars, nframes, repeats, verbose=False):
+  '''Time photcor.calibrate on a results store of nframes frames of
+  nstars stars.'''
+  storeDir = os.path.join(workDir, 'store{}x{}'.format(nstars, nframes))
+
+  def setup():
+    import photcor
+    shutil.rmtree(storeDir, ignore_errors=True)
+    synthetic.makeStarStore(storeDir, nstars, nframes)
+    return (lambda: photcor.calibrate(storedir=storeDir,
+                                      objectname=synthetic.TNO_NAME),
+            lambda value: None)
+  return runStage('photcor', setup, repeats, verbose, nstars=nstars,
+                  nframes=nframes)
+
+
+def environment():
+  '''The versions and machine the benchmark ran with.'''
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                     cwd=BENCHDIR,
+                                     stderr=subprocess.STDOUT).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return {'maphot': __version__, 'commit': commit,
+          'python': platform.python_version(), 'numpy': np.__version__,
+          'platform': platform.platform(), 'machine': platform.machine(),
+          'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compareResults(old, new):
+  '''Print the ratio of the new to the old best time of every stage and
+  size measured in both.'''
+  oldTimes = dict(((record['stage'], record['nstars'], record['nframes']),
+                   record['best']) for record in old['results']
+                  if record['status'] == 'ok')
+  print('Compared to {} ({}):'.format(old['environment']['commit'],
+                                      old['environment']['date']))
+  for record in new['results']:
+    key = (record['stage'], record['nstars'], record['nframes'])
+    if (record['status'] == 'ok') and (key in oldTimes):
+      print('{:>15} stars={:<5} frames={:<4} {:6.2f}x'.format(
+          *(key + (record['best'] / oldTimes[key],))))
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = ('benchmark [-s <nstars,...> -f <nframes,...> -n <imageframes> '
+            '-r <repeats> -S <stage,...> -o <output.json> '
+            '-c <compare.json> -w <workdir> -v]')
+  nstars, nframes, imageFrames, repeats = [100, 300, 1000], [10, 50], 1, 3
+  stages, outFile, compareFile, workDir = STAGES, 'benchmark.json', None, None
+  verbose = False
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "s:f:n:r:S:o:c:w:vh",
+                                   ["stars=", "frames=", "imageframes=",
+                                    "repeats=", "stages=", "output=",
+                                    "compare=", "workdir=", "verbose"])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+      sys.exit()
+    elif opt in ('-s', '--stars'):
+      nstars = [int(value) for value in arg.split(',')]
+    elif opt in ('-f', '--frames'):
+      nframes = [int(value) for value in arg.split(',')]
+    elif opt in ('-n', '--imageframes'):
+      imageFrames = int(arg)
+    elif opt in ('-r', '--repeats'):
+      repeats = int(arg)
+    elif opt in ('-S', '--stages'):
+      stages = arg.split(',')
+    elif opt in ('-o', '--output'):
+      outFile = arg
+    elif opt in ('-c', '--compare'):
+      compareFile = arg
+    elif opt in ('-w', '--workdir'):
+      workDir = arg
+    elif opt in ('-v', '--verbose'):
+      verbose = True
+  unknown = set(stages) - set(STAGES)
+  if unknown:
+    print('Unknown stages {}; known are {}'.format(sorted(unknown), STAGES))
+    sys.exit(2)
+  return (nstars, nframes, imageFrames, repeats, stages, outFile,
+          compareFile, workDir, verbose)
+
+
+if __name__ == '__main__':
+  (NSTARS, NFRAMES, IMAGEFRAMES, REPEATS, BENCHSTAGES, OUTFILE, COMPAREFILE,
+   WORKDIR, VERBOSE) = getArguments(sys.argv)
+  KEEPWORKDIR = WORKDIR is not None
+  WORKDIR = tempfile.mkdtemp(prefix='maphotbench') if WORKDIR is None \
+      else WORKDIR
+  RESULTS = {'environment': environment(),
+             'parameters': {'nstars': NSTARS, 'nframes': NFRAMES,
+                            'imageFrames': IMAGEFRAMES, 'repeats': REPEATS,
+                            'stages': BENCHSTAGES},
+             'results': []}
+  try:
+    for NSTAR in NSTARS:
+      if set(BENCHSTAGES) & set(IMAGE_STAGES):
+        RESULTS['results'] += benchmarkImages(WORKDIR, NSTAR, IMAGEFRAMES,
+                                              BENCHSTAGES, REPEATS, VERBOSE)
+      if 'photcor' in BENCHSTAGES:
+        for NFRAME in NFRAMES:
+          RESULTS['results'].append(benchmarkPhotcor(WORKDIR, NSTAR, NFRAME,
+                                                     REPEATS, VERBOSE))
+  finally:
+    if not KEEPWORKDIR:
+      shutil.rmtree(WORKDIR, ignore_errors=True)
+  with open(OUTFILE, 'w') as han:
+    json.dump(RESULTS, han, indent=1, default=float)
+  print('Timings written to ' + OUTFILE)
+  if COMPAREFILE is not None:
+    with open(COMPAREFILE) as han:
+      compareResults(json.load(han), RESULTS)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,276 @@
+"""
+Synthetic test data for the maphot benchmarks.
+
+makeDataset writes a small, self-consistent data set into a directory:
+  frameNN.fits      HSC-like images (an empty primary HDU and the image in
+                    extension 1, with a TAN WCS and the MAGZERO, MJD,
+                    GAINEFF, EXPTIME and FILTER keywords maphot reads),
+                    with Moffat stars, sky noise and a trailed TNO;
+  panstarrs.xml     a PS1-like VOTable of the stars (as queryPanSTARRS
+                    would save it);
+  synthetic.mpc     MPC lines of the TNO at the middle of every frame.
+It also returns what Source Extractor would have found in each frame and
+the true star and TNO parameters, so no external program is needed.
+makeStarStore writes a results store (see resultsstore.py) of the star and
+TNO photometry of any number of frames, without images, for photcor.
+The TNO moves on a straight line at a constant rate, which is all maphot
+needs from the MPC file over one night, but not a real orbit.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'maphot'))
+from pix2world import mpcLines, writeMPCReport  # noqa: E402
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+HSC_SHAPE = (4176, 2048)  # (NAXIS2, NAXIS1) of an HSC CCD.
+PIXEL_SCALE = 0.168  # arcsec/pixel
+FIELD_CENTRE = (150.0, 2.2)  # RA and Dec (degrees)
+MAGZERO = 32.5  # For counts (ADU) in an EXPTIME r-band exposure.
+GAIN = 3.0
+EXPTIME = 300.
+SKY = 1300.  # Sky level (counts/pixel), about 20.8 mag/arcsec^2
+SEEING = 0.7  # FWHM (arcsec)
+BETA = 3.  # Moffat beta
+MJD_START = 58150.4
+CADENCE = 360.  # Time between the starts of exposures (s)
+TNO_MAG = 23.5
+TNO_RATE = 3.0  # arcsec/hour
+TNO_ANGLE = 20.  # degrees, anticlockwise from x+
+TNO_NAME = 'SYNTNO1'
+STAMP = 15  # Half width of the stamps stars are drawn into (pixels)
+
+
+def moffatAlpha(fwhm, beta=BETA):
+  '''The Moffat alpha of a given FWHM (pixels) and beta.'''
+  return fwhm / (2. * np.sqrt(2. ** (1. / beta) - 1.))
+
+
+def makeWCS(shape=HSC_SHAPE, centre=FIELD_CENTRE, pixelScale=PIXEL_SCALE):
+  '''A TAN WCS of an image of the given shape, centred on centre, with
+  north up and east left.'''
+  from astropy import wcs
+  WCS = wcs.WCS(naxis=2)
+  WCS.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+  WCS.wcs.crval = list(centre)
+  WCS.wcs.crpix = [(shape[1] + 1) / 2., (shape[0] + 1) / 2.]
+  WCS.wcs.cd = np.array([[-pixelScale, 0.], [0., pixelScale]]) / 3600.
+  return WCS
+
+
+def drawMoffats(image, x, y, flux, fwhm, beta=BETA, stamp=STAMP):
+  '''Add Moffat profiles of total flux (counts) at x, y (0-based pixel
+  coordinates of the centres) to image, each within its own stamp.'''
+  alpha = moffatAlpha(fwhm, beta)
+  norm = (beta - 1.) / (np.pi * alpha ** 2)
+  offsets = np.arange(-stamp, stamp + 1)
+  ny, nx = image.shape
+  for xi, yi, fi in zip(x, y, flux):
+    x0, y0 = int(round(xi)), int(round(yi))
+    xs, ys = offsets + x0, offsets + y0
+    xs, ys = xs[(xs >= 0) & (xs < nx)], ys[(ys >= 0) & (ys < ny)]
+    if (len(xs) == 0) or (len(ys) == 0):
+      continue
+    r2 = (xs[np.newaxis, :] - xi) ** 2 + (ys[:, np.newaxis] - yi) ** 2
+    image[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1] += (
+        fi * norm * (1. + r2 / alpha ** 2) ** -beta)
+
+
+def drawTrail(image, x, y, flux, length, angle, fwhm):
+  '''Add a trailed source of total flux, centred on x, y, moving length
+  pixels at angle (degrees from x+) during the exposure.'''
+  nsteps = max(int(np.ceil(2 * length)), 1) + 1
+  steps = np.linspace(-length / 2., length / 2., nsteps)
+  drawMoffats(image, x + steps * np.cos(np.radians(angle)),
+              y + steps * np.sin(np.radians(angle)),
+              np.full(nsteps, flux / nsteps), fwhm)
+
+
+def magnitudeToFlux(mag, zeroPoint=MAGZERO):
+  '''Total counts of a source of magnitude mag.'''
+  return 10. ** (-0.4 * (np.asarray(mag) - zeroPoint))
+
+
+def makeStars(nstars, shape=HSC_SHAPE, rng=None, brightest=17.5,
+              faintest=23.5, margin=20):
+  '''Random stars, uniformly over the image and with number counts rising
+  like 10^(0.3 m). Returns a dictionary of x, y (0-based pixels), the PS1
+  g, r, i, z magnitudes and objName.'''
+  rng = np.random.default_rng(1) if rng is None else rng
+  # Inverse-transform sampling of dN/dm ~ 10^(0.3 m).
+  low, high = 10. ** (0.3 * brightest), 10. ** (0.3 * faintest)
+  rMag = np.log10(low + rng.random(nstars) * (high - low)) / 0.3
+  gr = rng.uniform(0.2, 1.4, nstars)
+  return {'x': rng.uniform(margin, shape[1] - margin, nstars),
+          'y': rng.uniform(margin, shape[0] - margin, nstars),
+          'g': rMag + gr, 'r': rMag, 'i': rMag - 0.4 * gr,
+          'z': rMag - 0.6 * gr,
+          'objName': np.array(['SYN {:08d}'.format(ii)
+                               for ii in np.arange(nstars)])}
+
+
+def tnoTrack(nframes, shape=HSC_SHAPE, mjdStart=MJD_START, cadence=CADENCE,
+             exptime=EXPTIME, rate=TNO_RATE, angle=TNO_ANGLE,
+             pixelScale=PIXEL_SCALE):
+  '''The x, y (0-based pixels, at mid-exposure) and mid-exposure MJDs of
+  the TNO, moving in a straight line through the centre of the sequence.
+  Also returns the exposure start MJDs and the trail length (pixels).'''
+  mjd = mjdStart + np.arange(nframes) * cadence / 86400.
+  mjdMid = mjd + exptime / 172800.
+  hours = (mjdMid - np.mean(mjdMid)) * 24.
+  speed = rate / pixelScale  # pixels/hour
+  x = shape[1] / 2. + hours * speed * np.cos(np.radians(angle))
+  y = shape[0] / 2. + hours * speed * np.sin(np.radians(angle))
+  return x, y, mjd, mjdMid, speed * exptime / 3600.
+
+
+def makeImage(stars, tnoX, tnoY, trailLength, zeroPointOffset=0.,
+              shape=HSC_SHAPE, fwhm=None, rng=None):
+  '''A float32 image of the stars (in r) and the TNO on a noisy sky.
+  zeroPointOffset dims (positive) or brightens everything, like
+  transparency or airmass changes between frames.'''
+  rng = np.random.default_rng(2) if rng is None else rng
+  fwhm = SEEING / PIXEL_SCALE if fwhm is None else fwhm
+  image = np.full(shape, SKY, dtype=np.float64)
+  drawMoffats(image, stars['x'], stars['y'],
+              magnitudeToFlux(stars['r'] + zeroPointOffset), fwhm)
+  drawTrail(image, tnoX, tnoY, magnitudeToFlux(TNO_MAG + zeroPointOffset),
+            trailLength, TNO_ANGLE, fwhm)
+  image += rng.standard_normal(shape) * np.sqrt(image / GAIN)
+  return image.astype(np.float32)
+
+
+def writeFrame(fileName, image, WCS, mjd, exptime=EXPTIME):
+  '''Write image as an HSC-like file: an empty primary HDU and the image,
+  with its WCS and the keywords maphot reads, in extension 1.'''
+  import astropy.io.fits as pyf
+  header = WCS.to_header()
+  header['EXPTIME'] = (exptime, 'Exposure time (s)')
+  header['MAGZERO'] = (MAGZERO, 'Photometric zero point')
+  header['MJD'] = (mjd, 'MJD at the start of the exposure')
+  header['GAINEFF'] = (GAIN, 'Effective gain (e/ADU)')
+  header['FILTER'] = ('r', 'Filter')
+  header['OBJECT'] = ('SYNTHETIC', 'maphot benchmark data')
+  pyf.HDUList([pyf.PrimaryHDU(),
+               pyf.ImageHDU(image, header=header)]).writeto(fileName,
+                                                            overwrite=True)
+
+
+def writePanSTARRS(fileName, stars, WCS, rng=None):
+  '''Write the stars as a PS1-like VOTable, with the columns readPanSTARRS
+  and the photometric transforms use.'''
+  from astropy.table import Table
+  rng = np.random.default_rng(3) if rng is None else rng
+  ra, dec = WCS.all_pix2world(stars['x'], stars['y'], 0)
+  table = Table()
+  table['objName'] = stars['objName']
+  table['raMean'], table['decMean'] = ra, dec
+  for band in 'griz':
+    error = 0.002 + 0.02 * 10. ** (0.4 * (stars[band] - 22.))
+    table[band + 'MeanPSFMag'] = stars[band] + rng.normal(0, error)
+    table[band + 'MeanPSFMagErr'] = error
+    table[band + 'MeanKronMag'] = stars[band] + rng.normal(0, 2 * error)
+  table['nDetections'] = np.full(len(table), 20, dtype=np.int16)
+  table.write(fileName, format='votable', overwrite=True)
+
+
+def sourceExtractorCatalog(stars, WCS, tnoX, tnoY, zeroPointOffset=0.,
+                           fwhm=None, rng=None):
+  '''What Source Extractor would find in an image made by makeImage:
+  a dictionary of XWIN_IMAGE, YWIN_IMAGE (1-based), X_WORLD, Y_WORLD,
+  FLUX_AUTO, FLUXERR_AUTO, MAG_AUTO, AWIN_IMAGE, BWIN_IMAGE, FWHM_IMAGE
+  and FLAGS arrays, with the TNO as the last source.'''
+  rng = np.random.default_rng(4) if rng is None else rng
+  fwhm = SEEING / PIXEL_SCALE if fwhm is None else fwhm
+  x = np.append(stars['x'], tnoX) + rng.normal(0, 0.05, len(stars['x']) + 1)
+  y = np.append(stars['y'], tnoY) + rng.normal(0, 0.05, len(x))
+  flux = magnitudeToFlux(np.append(stars['r'], TNO_MAG) + zeroPointOffset)
+  fluxErr = np.sqrt(flux / GAIN + np.pi * (1.5 * fwhm) ** 2 * SKY / GAIN)
+  ra, dec = WCS.all_pix2world(x, y, 0)
+  return {'XWIN_IMAGE': x + 1., 'YWIN_IMAGE': y + 1., 'X_WORLD': ra,
+          'Y_WORLD': dec, 'FLUX_AUTO': flux, 'FLUXERR_AUTO': fluxErr,
+          'MAG_AUTO': MAGZERO - 2.5 * np.log10(flux),
+          'AWIN_IMAGE': np.full(len(x), fwhm / 2.3548),
+          'BWIN_IMAGE': np.full(len(x), fwhm / 2.3548) * 0.95,
+          'FWHM_IMAGE': np.full(len(x), fwhm),
+          'FLAGS': np.zeros(len(x), dtype=np.int16)}
+
+
+def makeDataset(directory, nstars, nframes, shape=HSC_SHAPE, seed=1):
+  '''Write nframes frames with nstars stars, the PS1 VOTable and the MPC
+  file to directory. Returns a dictionary of the file names
+  (frames, panstarrs, mpc), the star and TNO truth (stars, tnoX, tnoY,
+  mjd, mjdMid, trailLength, zeroPointOffsets) and the Source Extractor
+  catalogs of the frames (sexCats).'''
+  rng = np.random.default_rng(seed)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  WCS = makeWCS(shape)
+  stars = makeStars(nstars, shape, rng)
+  tnoX, tnoY, mjd, mjdMid, trailLength = tnoTrack(nframes, shape)
+  zeroPointOffsets = rng.normal(0, 0.03, nframes)
+  dataset = {'frames': [], 'sexCats': [], 'stars': stars, 'tnoX': tnoX,
+             'tnoY': tnoY, 'mjd': mjd, 'mjdMid': mjdMid,
+             'trailLength': trailLength,
+             'zeroPointOffsets': zeroPointOffsets, 'shape': shape,
+             'panstarrs': os.path.join(directory, 'panstarrs.xml'),
+             'mpc': os.path.join(directory, 'synthetic.mpc')}
+  for ii in np.arange(nframes):
+    frameName = os.path.join(directory, 'frame{:02d}.fits'.format(ii))
+    writeFrame(frameName, makeImage(stars, tnoX[ii], tnoY[ii], trailLength,
+                                    zeroPointOffsets[ii], shape, rng=rng),
+               WCS, mjd[ii])
+    dataset['frames'].append(frameName)
+    dataset['sexCats'].append(sourceExtractorCatalog(
+        stars, WCS, tnoX[ii], tnoY[ii], zeroPointOffsets[ii], rng=rng))
+  writePanSTARRS(dataset['panstarrs'], stars, WCS, rng)
+  tnoRA, tnoDec = WCS.all_pix2world(tnoX, tnoY, 0)
+  writeMPCReport(dataset['mpc'], mpcLines(TNO_NAME, mjdMid, tnoRA, tnoDec,
+                                          TNO_MAG, 'r'), mode='w')
+  return dataset
+
+
+def makeStarStore(storeDir, nstars, nframes, objectName=TNO_NAME,
+                  variableFraction=0.05, seed=1):
+  '''Write a results store of the photometry of nstars stars (a fraction
+  of them variable) and the TNO in nframes frames, with per-frame
+  zero-point offsets, as maphot -R would. Returns the offsets.'''
+  from resultsstore import appendRecords, makeRecords
+  from phottransforms import toPS1
+  rng = np.random.default_rng(seed)
+  stars = makeStars(nstars, rng=rng)
+  mjd = MJD_START + np.arange(nframes) * CADENCE / 86400.
+  offsets = rng.normal(0, 0.03, nframes)
+  dmag = 0.002 + 0.02 * 10. ** (0.4 * (stars['r'] - 22.))
+  variable = rng.random(nstars) < variableFraction
+  images = np.array(['frame{:04d}.fits'.format(ii)
+                     for ii in np.arange(nframes)])
+  mag = (stars['r'] + offsets[:, np.newaxis]
+         + rng.normal(0, 1, (nframes, nstars)) * dmag
+         + np.where(variable, 0.2, 0.) * np.sin(
+             mjd[:, np.newaxis] * 24. + rng.uniform(0, 6, nstars)))
+  appendRecords(storeDir, 'stars', makeRecords(
+      'stars', nframes * nstars, image=np.repeat(images, nstars), extno=1,
+      mjdMid=np.repeat(mjd, nstars), objName=np.tile(stars['objName'],
+                                                     nframes),
+      x=np.tile(stars['x'], nframes), y=np.tile(stars['y'], nframes),
+      filter='r', mag=mag.ravel(), dmag=np.tile(dmag, nframes),
+      refMag=np.tile(stars['r'], nframes),
+      refColour=np.tile(stars['g'] - stars['r'], nframes)))
+  tnoX, tnoY = tnoTrack(nframes)[:2]
+  tnoMag = TNO_MAG + offsets + rng.normal(0, 0.05, nframes)
+  magPS1, dmagPS1 = toPS1(tnoMag - offsets, 0.05, 'CFHT', 'r')
+  appendRecords(storeDir, 'tno', makeRecords(
+      'tno', nframes, image=images, object=objectName, extno=1, mjd=mjd,
+      mjdMid=mjd, x=tnoX, y=tnoY, filter='r', magRaw=tnoMag, dmagRaw=0.05,
+      magCalibration=-offsets, dmagCalibration=0.01,
+      magInst=tnoMag - offsets, dmagInst=0.05, magPS1=magPS1,
+      dmagPS1=dmagPS1, zptRaw=MAGZERO))
+  return offsets
+
+
+# End of file.
+# Nothing to see here.
@@ -4,4 +4,4 @@ accross multiple images of the same field.
 """
 __version__ = '0.1.1'
 __author__ = 'Mike Alexandersen (github: mikea1985)'
-__all__ = ['maphot', 'photcor', 'best']
+__all__ = ['maphot', 'photcor', 'best', 'review']
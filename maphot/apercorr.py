@@ -0,0 +1,114 @@
+"""
+A cache of aperture-correction curves, keyed by the geometry of the trail.
+
+Computing the round and line aperture corrections of a new PSF means
+measuring it in 100 apertures each. Within a sequence of images the FWHM,
+trail length, angle and repFact hardly change, so the curves of one image
+can be reused (or interpolated between nearby images) for the next.
+Curves are stored against radius/FWHM, one small npz file per entry, which
+makes entries with slightly different FWHMs directly comparable and lets
+parallel workers share a cache directory without locking.
+"""
+from __future__ import print_function, division
+import os
+import glob
+import numpy as np
+from psfstore import setAperCorrs
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+# Quantization step and interpolation tolerance of FWHM (pix),
+# trail length (pix) and angle (deg).
+KEY_STEPS = np.array([0.05, 0.25, 1.0])
+KEY_TOLERANCES = np.array([0.1, 1.0, 5.0])
+
+
+def aperCorrKey(fwhm, trailLength, angle, repFact):
+  '''The quantized (fwhm, trailLength, angle, repFact) key of a geometry.'''
+  steps = np.round(np.array([fwhm, trailLength, angle % 180.]) / KEY_STEPS)
+  return tuple(int(step) for step in steps) + (int(repFact),)
+
+
+def aperCorrFile(cacheDir, key):
+  '''The file name of a cache entry.'''
+  return os.path.join(cacheDir, 'apcorr_{}_{}_{}_{}.npz'.format(*key))
+
+
+def findAperCorrs(cacheDir, fwhm, trailLength, angle, repFact):
+  '''Look up aperture-correction curves for this geometry.
+  An exact (quantized) match is used as is. Otherwise, all entries with the
+  same repFact and within KEY_TOLERANCES are averaged, weighted by inverse
+  distance. Returns (aperCorrRadii, aperCorrs, lineAperCorrRadii,
+  lineAperCorrs) in pixels, or None if nothing is close enough.'''
+  key = aperCorrKey(fwhm, trailLength, angle, repFact)
+  entries = []
+  for entryFile in glob.glob(os.path.join(cacheDir,
+                                          'apcorr_*_{}.npz'.format(repFact))):
+    entryKey = np.array(os.path.basename(entryFile)[7:-4].split('_'),
+                        dtype=int)
+    delta = np.abs(entryKey[:3] - np.array(key[:3])) * KEY_STEPS
+    delta[2] = np.min([delta[2], 180. - delta[2]])  # Angles wrap at 180.
+    if np.all(delta <= KEY_TOLERANCES):
+      entries.append((np.sum((delta / KEY_TOLERANCES) ** 2) ** 0.5,
+                      entryFile))
+  if not entries:
+    return None
+  entries.sort()
+  with np.load(entries[0][1]) as han:
+    roundRadii, lineRadii = han['roundRadii'], han['lineRadii']
+    if entries[0][0] == 0:
+      return (roundRadii * fwhm, han['roundCorrs'],
+              lineRadii * fwhm, han['lineCorrs'])
+  weights = np.zeros(len(entries))
+  roundCorrs = np.zeros((len(entries), len(roundRadii)))
+  lineCorrs = np.zeros((len(entries), len(lineRadii)))
+  for ii, (distance, entryFile) in enumerate(entries):
+    weights[ii] = 1. / distance
+    with np.load(entryFile) as han:
+      roundCorrs[ii] = np.interp(roundRadii, han['roundRadii'],
+                                 han['roundCorrs'])
+      lineCorrs[ii] = np.interp(lineRadii, han['lineRadii'],
+                                han['lineCorrs'])
+  return (roundRadii * fwhm, np.average(roundCorrs, axis=0, weights=weights),
+          lineRadii * fwhm, np.average(lineCorrs, axis=0, weights=weights))
+
+
+def saveAperCorrs(cacheDir, goodPSF, fwhm, trailLength, angle, repFact):
+  '''Save the aperture-correction curves of goodPSF to the cache.'''
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  entryFile = aperCorrFile(cacheDir, aperCorrKey(fwhm, trailLength, angle,
+                                                 repFact))
+  tmpFile = entryFile[:-4] + '.tmp{}.npz'.format(os.getpid())
+  np.savez(tmpFile, roundRadii=np.array(goodPSF.aperCorrRadii) / fwhm,
+           roundCorrs=np.array(goodPSF.aperCorrs),
+           lineRadii=np.array(goodPSF.lineAperCorrRadii) / fwhm,
+           lineCorrs=np.array(goodPSF.lineAperCorrs))
+  os.rename(tmpFile, entryFile)
+
+
+def getAperCorrs(goodPSF, fwhm, trailLength, angle, repFact, cacheDir=None):
+  '''Give goodPSF its round and line aperture-correction curves,
+  from the cache in cacheDir if possible, otherwise by computing them
+  (and then adding them to the cache). goodPSF.line() must have been run.
+  Returns True if the curves came from the cache.'''
+  if cacheDir is not None:
+    cached = findAperCorrs(cacheDir, fwhm, trailLength, angle, repFact)
+    if cached is not None:
+      setAperCorrs(goodPSF, *cached)
+      return True
+  from trippy import psf
+  goodPSF.computeRoundAperCorrFromPSF(psf.extent(0.7 * fwhm, 4 * fwhm, 100),
+                                      display=False,
+                                      displayAperture=False,
+                                      useLookupTable=True)
+  goodPSF.computeLineAperCorrFromTSF(psf.extent(0.1 * fwhm, 4 * fwhm, 100),
+                                     l=trailLength, a=angle, display=False,
+                                     displayAperture=False)
+  if cacheDir is not None:
+    saveAperCorrs(cacheDir, goodPSF, fwhm, trailLength, angle, repFact)
+  return False
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,74 @@
+"""
+Appending to files shared by many maphot workers.
+
+appendLocked takes an exclusive lock on the file for the duration of the
+write, so rows from parallel workers never interleave, and writes the header
+only if the file is still empty. replaceLocked does the same, but first
+drops the rows that the new ones supersede. exclusiveLock holds the same
+kind of lock for a whole read-modify-write of a file that is replaced
+rather than appended to.
+On systems without fcntl (Windows) no lock is taken.
+"""
+from __future__ import print_function, division
+from contextlib import contextmanager
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+
+def appendLocked(fileName, data, header=None):
+  '''Append data (str, or bytes) to fileName while holding an exclusive lock.
+  If header is given, it is written first, but only if the file is empty.'''
+  mode = 'ab' if isinstance(data, bytes) else 'a'
+  with open(fileName, mode) as han:
+    if fcntl is not None:
+      fcntl.flock(han.fileno(), fcntl.LOCK_EX)
+    try:
+      han.seek(0, 2)
+      if (header is not None) and (han.tell() == 0):
+        han.write(header)
+      han.write(data)
+      han.flush()
+    finally:
+      if fcntl is not None:
+        fcntl.flock(han.fileno(), fcntl.LOCK_UN)
+
+
+def replaceLocked(fileName, data, superseded, header=None):
+  '''Like appendLocked, but the lines of fileName for which superseded(line)
+  is True are removed first, under the same lock.'''
+  with open(fileName, 'a+') as han:
+    if fcntl is not None:
+      fcntl.flock(han.fileno(), fcntl.LOCK_EX)
+    try:
+      han.seek(0)
+      lines = [line for line in han if not superseded(line)]
+      han.truncate(0)  # Writes still go to the end, which is now the start.
+      if (header is not None) and not lines:
+        han.write(header)
+      han.write(''.join(lines) + data)
+      han.flush()
+    finally:
+      if fcntl is not None:
+        fcntl.flock(han.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def exclusiveLock(lockFileName):
+  '''Hold an exclusive lock on lockFileName (created if needed) for the
+  duration of the with block.'''
+  with open(lockFileName, 'a') as han:
+    if fcntl is not None:
+      fcntl.flock(han.fileno(), fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      if fcntl is not None:
+        fcntl.flock(han.fileno(), fcntl.LOCK_UN)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,58 @@
+"""
+A tiny background worker, so that slow side jobs (rendering plots, writing
+diagnostic files) don't hold up the photometry.
+"""
+from __future__ import print_function, division
+import threading
+from six.moves import queue
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+
+class BackgroundWorker(object):
+  '''Runs submitted jobs, in order, on a single daemon thread.
+  Usage:
+    worker = BackgroundWorker()
+    worker.submit(someFunction, arg1, arg2, keyword=value)
+    worker.close()  # Waits for all submitted jobs to finish.
+  Exceptions raised by jobs are printed and kept in worker.errors,
+  rather than killing the thread.
+  '''
+
+  def __init__(self, maxQueue=0):
+    self.jobs = queue.Queue(maxQueue)
+    self.errors = []
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        self.jobs.task_done()
+        break
+      function, args, kwargs = job
+      try:
+        function(*args, **kwargs)
+      except Exception as error:  # pylint: disable=broad-except
+        print('Background job {} failed: {}'.format(function.__name__, error))
+        self.errors.append(error)
+      self.jobs.task_done()
+
+  def submit(self, function, *args, **kwargs):
+    '''Queue function(*args, **kwargs) to be run in the background.'''
+    if not self.thread.is_alive():
+      raise RuntimeError('BackgroundWorker has already been closed.')
+    self.jobs.put((function, args, kwargs))
+
+  def close(self):
+    '''Wait for all queued jobs, then stop the thread.'''
+    if self.thread.is_alive():
+      self.jobs.put(None)
+      self.thread.join()
+    return self.errors
+
+
+# End of file.
+# Nothing to see here.
@@ -19,6 +19,8 @@ from maphot_functions import (getSExCatalog, inspectStars,
                               queryPanSTARRS, readPanSTARRS, PS1_vs_SEx,
                               getDataHeader, findSharedPS1Catalogue,
                               saveStarMag, trimCatalog)
+from footprints import FootprintIndex
+from metrics import RunMetrics, stage
 from __version__ import __version__
 __author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
               'mike.alexandersen@alumni.ubc.ca)')
@@ -90,10 +92,12 @@ def getArguments(sysargv):
   verbose = False
   ignoreWarns = False
   extno = None
+  footprints = None  # Change with '-F footprints.npz'
   try:
-    options, dummy = getopt.getopt(sysargv[1:], "f:v:h:r:e:i:",
+    options, dummy = getopt.getopt(sysargv[1:], "f:v:h:r:e:i:F:",
                                    ["filenamefile=", "verbose=", "repfactor=",
-                                    "extension=", "ignoreWarnings="])
+                                    "extension=", "ignoreWarnings=",
+                                    "footprints="])
   except TypeError as error:
     print(error)
     sys.exit()
@@ -114,7 +118,8 @@ def getArguments(sysargv):
           raise TypeError("-v and -i flags must be followed by " +
                           "0/False/1/True")
       if opt == '-h':
-        print('best -f <filenamefile> -e <extension> -i <ignoreWarnings>')
+        print('best -f <filenamefile> -e <extension> -i <ignoreWarnings>'
+              + ' -F <footprintindexfile>')
       elif opt in ('-f', '--filenamefile'):
         filenameFile = arg
       elif opt in ('-v', '--verbose'):
@@ -125,11 +130,13 @@ def getArguments(sysargv):
         extno = int(arg)
       elif opt in ('-i', '--ignoreWarnings'):
         ignoreWarns = arg
+      elif opt in ('-F', '--footprints'):
+        footprints = arg
     imageArray = np.array([ia.replace('.fits', '')
                            for ia in np.genfromtxt(filenameFile,
                                                    usecols=(0), dtype=str)])
   print(imageArray)
-  return imageArray, repfactor, verbose, extno, ignoreWarns
+  return imageArray, repfactor, verbose, extno, ignoreWarns, footprints
 
 
 def pickleCatalogue(catalogue, filename, **kwargs):
@@ -156,13 +163,10 @@ def unpickleCatalogue(filename, **kwargs):
   return catalogue
 
 
-def PanSTARRSStuff(SExCatalogArray, bestID):
-  """Load the PS1 catalogue, identify PS1 stars in the SExtractor catalog.
+def loadPanSTARRS(obsRA, obsDec):
+  """Load the PS1 catalogue around obsRA, obsDec.
+  Only query PS1 if the catalog hasn't already been downloaded once.
   """
-  #Get the PS1 catalog for the area around the TNO.
-  #Only do this if the catalog hasn't already been downloaded once.
-  obsRA = np.nanmedian(SExCatalogArray[bestID]['X_WORLD'])
-  obsDec = np.nanmedian(SExCatalogArray[bestID]['Y_WORLD'])
   RADecString = '{0:05.1f}_{1:+4.1f}'.format(obsRA, obsDec)
   try:
     PS1Catalog = readPanSTARRS('panstarrs_' + RADecString + '.xml',
@@ -172,6 +176,24 @@ def PanSTARRSStuff(SExCatalogArray, bestID):
                    catalog_filename='panstarrs_' + RADecString + '.xml')
     PS1Catalog = readPanSTARRS('panstarrs_' + RADecString + '.xml',
                                PSF_Kron=0.4)
+  return PS1Catalog
+
+
+def PanSTARRSStuff(SExCatalogArray, bestID, **kwargs):
+  """Load the PS1 catalogue, identify PS1 stars in the SExtractor catalog.
+  The catalog is centred on centre=(RA, Dec) if given (e.g. from a
+  footprint index), otherwise on the SExtractor catalog of the best image.
+  """
+  centre = kwargs.pop('centre', None)
+  if kwargs:
+    raise TypeError('Unexpected **kwargs: %r' % kwargs)
+  #Get the PS1 catalog for the area around the TNO.
+  if centre is None:
+    obsRA = np.nanmedian(SExCatalogArray[bestID]['X_WORLD'])
+    obsDec = np.nanmedian(SExCatalogArray[bestID]['Y_WORLD'])
+  else:
+    obsRA, obsDec = centre[0], centre[1]
+  PS1Catalog = loadPanSTARRS(obsRA, obsDec)
   print('A Pan-STARRS catalog has been loaded with '
         + '{} entries.'.format(len(PS1Catalog)))
   #Match the PS1 sources to the SExtractor catalog. Only keep matched pairs.
@@ -185,42 +207,66 @@ def PanSTARRSStuff(SExCatalogArray, bestID):
 
 def best(imageArray, repfactor, **kwargs):
   """This function can be run to do all of the above.
-  This is called automatically if this is main."""
+  This is called automatically if this is main.
+  With footprints=<footprint index file>, the PS1 catalog is centred on the
+  footprints of the images and fetched before SExtractor is run.
+  Each step is timed as a stage of the current run (see metrics.py)."""
   extno = kwargs.pop('extno', None)
   verbose = kwargs.pop('verbose', False)
+  footprints = kwargs.pop('footprints', None)
   if kwargs:
     raise TypeError('Unexpected **kwargs: %r' % kwargs)
   print(__version__ if verbose else "")
   print(imageArray if verbose else "")
+  centre = None
+  if footprints is not None:
+    with stage('footprints', images=len(imageArray)):
+      index = FootprintIndex(footprints)
+      index.update([image + '.fits' for image in imageArray])
+      index.save()
+      centre = index.centre([image + '.fits' for image in imageArray], extno)
+      loadPanSTARRS(centre[0], centre[1])
   #bestID, bestSExCat = findBestImage(imageArray, extno=extno)
   #print(bestID if verbose else "")
-  catalogueArray = getAllCatalogues(imageArray, extno=extno)
-  nCatMembers = [len(cat['XWIN_IMAGE']) for cat in catalogueArray]
+  with stage('sourceExtractor', images=len(imageArray)) as counts:
+    catalogueArray = getAllCatalogues(imageArray, extno=extno)
+    nCatMembers = [len(cat['XWIN_IMAGE']) for cat in catalogueArray]
+    counts['sources'] = int(np.sum(nCatMembers))
   bestID = np.argmax(nCatMembers)
   bestSExCat = catalogueArray[bestID]
-  (bestData, _, _, _, _, MJDm, _, NAXIS1, NAXIS2, _, _
-   ) = getDataHeader(imageArray[bestID] + '.fits', extno=extno)
-  print("The best image is {}".format(imageArray[bestID]))
-  bestSExCatTrimmed = trimCatalog(bestSExCat, bestData, dcut=5, mcut=55000,
-                                  snrcut=0, shapecut=5,  # basically no cuts
-                                  naxis1=NAXIS1, naxis2=NAXIS2)
+  with stage('trimCatalog') as counts:
+    (bestData, _, _, _, _, MJDm, _, NAXIS1, NAXIS2, _, _
+     ) = getDataHeader(imageArray[bestID] + '.fits', extno=extno)
+    print("The best image is {}".format(imageArray[bestID]))
+    bestSExCatTrimmed = trimCatalog(bestSExCat, bestData, dcut=5,
+                                    mcut=55000, snrcut=0,
+                                    shapecut=5,  # basically no cuts
+                                    naxis1=NAXIS1, naxis2=NAXIS2)
+    counts['sources'] = len(bestSExCat['XWIN_IMAGE'])
+    counts['kept'] = len(bestSExCatTrimmed['XWIN_IMAGE'])
   catalogueArray[bestID] = bestSExCatTrimmed  # lazy workaround
-  PS1SharedCat = PanSTARRSStuff(catalogueArray, bestID)
+  with stage('PanSTARRS') as counts:
+    PS1SharedCat = PanSTARRSStuff(catalogueArray, bestID, centre=centre)
+    counts['sharedStars'] = len(PS1SharedCat)
   print('{}'.format(len(PS1SharedCat)) +
         ' PS1 sources are visible in all images.')
   timeNow = datetime.now().strftime('%Y-%m-%d/%H:%M:%S')
   if verbose:
     saveStarMag('PS1SharedCat.txt', PS1SharedCat,
                 timeNow, __version__, 'All images', extno=extno)
-  bestSharedPS1SExCat = PS1_vs_SEx(PS1SharedCat, bestSExCat,
-                                   maxDist=2.5, appendSEx=True)
+  with stage('PS1_vs_SEx') as counts:
+    bestSharedPS1SExCat = PS1_vs_SEx(PS1SharedCat, bestSExCat,
+                                     maxDist=2.5, appendSEx=True)
+    counts['matchedStars'] = len(bestSharedPS1SExCat)
   if verbose:
     saveStarMag('bestSharedPS1SExCat.txt', bestSharedPS1SExCat,
                 timeNow, __version__, MJDm, extno=extno)
-  inspectedSExCat = inspectStars(bestData, bestSharedPS1SExCat[:],
-                                 repfactor, SExCatalogue=True,
-                                 noVisualSelection=False)
-  inspectedPS1Cat = findSharedPS1Catalogue([PS1SharedCat, inspectedSExCat])
+  with stage('inspectStars') as counts:
+    inspectedSExCat = inspectStars(bestData, bestSharedPS1SExCat[:],
+                                   repfactor, SExCatalogue=True,
+                                   noVisualSelection=False)
+    inspectedPS1Cat = findSharedPS1Catalogue([PS1SharedCat, inspectedSExCat])
+    counts['inspectedStars'] = len(inspectedPS1Cat)
   saveStarMag('InspectedStars.txt', inspectedPS1Cat,
               timeNow, __version__, 'All images', extno=extno)
   print('{}'.format(len(inspectedPS1Cat)) +
@@ -232,12 +278,17 @@ def best(imageArray, repfactor, **kwargs):
 
 
 if __name__ == '__main__':
-  images, repfact, verbatim, extension, ignoreWarnings = getArguments(sys.argv)
+  (images, repfact, verbatim, extension, ignoreWarnings, footprintIndex
+   ) = getArguments(sys.argv)
   #Ignore all Python warnings.
   #This is generally a terrible idea, and should be turned off for de-bugging.
   if ignoreWarnings:
     warnings.filterwarnings("ignore")
-  bestImage, bestCat = best(images, repfact, extno=extension, verbose=verbatim)
+  RUNMETRICS = RunMetrics.fromEnvironment(
+      'best' + ('' if extension is None else '{0:02.0f}'.format(extension)))
+  bestImage, bestCat = best(images, repfact, extno=extension, verbose=verbatim,
+                            footprints=footprintIndex)
+  RUNMETRICS.write()
   print('Best catalogue:')
   print(bestCat)
   print('Best image #: ' + str(bestImage))
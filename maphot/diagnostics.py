@@ -0,0 +1,68 @@
+"""
+The diagnostic images that removeTSF saves for each image.
+
+Instead of separate _modelImage, _removed, _lookupTable and _Data files,
+each with its own copy of the header, everything goes into one
+<inputName>_diagnostics.fits, with the image header once in the primary HDU
+and the images as float32, losslessly tile-compressed extensions:
+  level 'none':   nothing is written;
+  level 'stamps': DATA (background-subtracted stamp around the TNO) and,
+                  if the TSF was removed, MODEL and REMOVED;
+  level 'full':   as 'stamps', plus the PSF LOOKUPTABLE.
+Writing is done on a BackgroundWorker when one is given, so that the
+photometry doesn't wait for the disk.
+"""
+from __future__ import print_function, division
+import os
+import numpy as np
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+DIAGNOSTIC_LEVELS = ('none', 'stamps', 'full')
+
+
+def diagnosticsFileName(inputName):
+  '''The name of the diagnostics file of an image.'''
+  return inputName + '_diagnostics.fits'
+
+
+def writeDiagnostics(fileName, header, images):
+  '''Write images, a list of (extension name, array or None) pairs,
+  as float32 tile-compressed extensions of one FITS file.'''
+  import astropy.io.fits as pyf
+  hdus = [pyf.PrimaryHDU(header=header)]
+  for name, image in images:
+    if image is not None:
+      hdus.append(pyf.CompImageHDU(np.asarray(image, dtype=np.float32),
+                                   name=name, compression_type='GZIP_2',
+                                   quantize_level=0.0))
+  tmpName = fileName + '.tmp{}'.format(os.getpid())
+  pyf.HDUList(hdus).writeto(tmpName, overwrite=True)
+  os.rename(tmpName, fileName)
+
+
+def saveDiagnostics(inputName, level, header, Data, modelImage, removed,
+                    lookupTable, worker=None):
+  '''Save the diagnostic images of removeTSF at the given level.
+  With a worker (a BackgroundWorker), the arrays are copied (as float32)
+  and the write is queued rather than done here.'''
+  if level not in DIAGNOSTIC_LEVELS:
+    raise ValueError('Diagnostics level must be one of {}'.format(
+        '/'.join(DIAGNOSTIC_LEVELS)))
+  if level == 'none':
+    return
+  images = [('DATA', Data), ('MODEL', modelImage), ('REMOVED', removed)]
+  if level == 'full':
+    images.append(('LOOKUPTABLE', lookupTable))
+  if worker is None:
+    writeDiagnostics(diagnosticsFileName(inputName), header, images)
+  else:
+    images = [(name, None if image is None
+               else np.array(image, dtype=np.float32))
+              for name, image in images]
+    worker.submit(writeDiagnostics, diagnosticsFileName(inputName),
+                  header.copy(), images)
+
+
+# End of file.
+# Nothing to see here.
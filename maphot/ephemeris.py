@@ -0,0 +1,197 @@
+#!/usr/bin/python
+"""
+Predicted positions, rates and angles of a TNO, from one orbit fit per
+MPC file.
+
+Fitting an mp_ephem.BKOrbit and calling its predict method is slow, and
+maphot used to do it (once, plus two predictions) for every image of the
+same object. EphemerisService fits the orbit of an MPC file once, predicts
+the RA and Dec at the MJD of each frame (and of the frame + RATE_DT, for the
+rate), and saves that table to <mpcfile>.<hash>.<obscode>.ephem.npz (keyed
+by a hash of the MPC file, so editing the file invalidates it). Any maphot
+process of the same object then interpolates in the table, which it can do
+at any MJD less than MAX_GAP from predictions on either side; only MJDs that
+aren't covered are predicted and added to the table, under a lock, so that
+parallel runs keep each other's predictions.
+To fill the table for a whole sequence in one go, before running maphot:
+  ephemeris.py -c <MPCfile> -f '<fitsfileglob>' [-e <extension>]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import getopt
+import hashlib
+import numpy as np
+from appender import exclusiveLock
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+MAX_GAP = 10. / 1440.  # Widest gap interpolated across (days).
+RATE_DT = 1. / 24.  # Rates are the motion over one hour, as before.
+
+
+def mpcFileHash(mpcFile):
+  '''SHA1 hash of the contents of an MPC file.'''
+  with open(mpcFile, 'rb') as han:
+    return hashlib.sha1(han.read()).hexdigest()
+
+
+def headerMJDmid(fileName, extno=None):
+  '''MJD of the middle of the exposure, from the header of an image,
+  using the same keywords as maphot_functions.getDataHeader.'''
+  import astropy.io.fits as pyf
+  header = pyf.getheader(fileName, 0 if extno is None else extno)
+  for key in ('MJD', 'MJDATE', 'MJD-OBS'):  # Subaru, CFHT, Gemini/CFHT
+    if key in header:
+      return header[key] + header['EXPTIME'] / 172800.0
+  raise KeyError('No MJD keyword in {}'.format(fileName))
+
+
+class EphemerisService(object):
+  '''Batched ephemeris of the object in mpcFile, as seen from obsCode.
+  Usage:
+    ephemeris = EphemerisService('target.mpc')
+    ra, dec = ephemeris.predict(mjds)
+    coords, rates, angles = ephemeris.coordRateAngle(mjds, WCS)
+  '''
+
+  def __init__(self, mpcFile, obsCode=568, cacheDir=None):
+    self.mpcFile = mpcFile
+    self.obsCode = obsCode
+    self.hash = mpcFileHash(mpcFile)
+    cacheDir = os.path.dirname(mpcFile) if cacheDir is None else cacheDir
+    self.tableFile = os.path.join(cacheDir, '{}.{}.{}.ephem.npz'.format(
+        os.path.basename(mpcFile), self.hash[:12], obsCode))
+    self.table = None
+    self._orbit = None
+
+  def orbit(self):
+    '''Fit (once) and return the mp_ephem orbit.'''
+    if self._orbit is None:
+      import mp_ephem
+      from maphot_functions import getObservations
+      with open(self.mpcFile) as han:
+        self._orbit = mp_ephem.BKOrbit(getObservations(han.readlines()))
+    return self._orbit
+
+  def loadTable(self, reload=False):
+    '''Read the prediction table, if there is one. Tables written by
+    older versions (on a grid of MJDs) are ignored, and replaced.'''
+    if (reload or self.table is None) and os.path.isfile(self.tableFile):
+      with np.load(self.tableFile) as han:
+        if 'mjd' not in han.files:
+          return self.table
+        self.table = dict((key, han[key]) for key in ('mjd', 'ra', 'dec'))
+      # Unwrap RA, so that interpolation works across RA=0.
+      self.table['raUnwrapped'] = np.degrees(np.unwrap(np.radians(
+          self.table['ra'])))
+    return self.table
+
+  def uncovered(self, mjds):
+    '''Those of mjds that are neither in the prediction table nor less
+    than MAX_GAP from predictions on either side.'''
+    mjds = np.unique(mjds)
+    table = self.loadTable()
+    if table is None:
+      return mjds
+    after = np.searchsorted(table['mjd'], mjds)
+    exact = (after < len(table['mjd'])) & (
+        table['mjd'][np.minimum(after, len(table['mjd']) - 1)] == mjds)
+    inside = (after > 0) & (after < len(table['mjd']))
+    gaps = (table['mjd'][np.minimum(after, len(table['mjd']) - 1)]
+            - table['mjd'][np.maximum(after - 1, 0)])
+    return mjds[~(exact | (inside & (gaps <= MAX_GAP)))]
+
+  def precompute(self, mjds):
+    '''Predict the positions at those of mjds that the table doesn't
+    cover yet (see uncovered) and merge them into the saved table; for the
+    rates, a frame needs its MJD and its MJD + RATE_DT. mp_ephem's orbit
+    predicts one date per call, so this is still a loop, but only over the
+    uncovered MJDs.
+    The merge (read, add, write and rename) holds a lock on <table>.lock,
+    so that parallel runs don't lose each other's predictions.'''
+    self.loadTable(reload=True)
+    needed = self.uncovered(np.atleast_1d(mjds))
+    if len(needed):
+      orbit = self.orbit()
+      newRa, newDec = np.zeros([2, len(needed)])
+      for ii, mjd in enumerate(needed):
+        orbit.predict(mjd + 2400000.5, obs_code=self.obsCode)
+        newRa[ii] = orbit.coordinate.ra.degree
+        newDec[ii] = orbit.coordinate.dec.degree
+      with exclusiveLock(self.tableFile + '.lock'):
+        mjd, ra, dec = np.zeros([3, 0])
+        if self.loadTable(reload=True) is not None:
+          mjd, ra, dec = self.table['mjd'], self.table['ra'], self.table['dec']
+        # Sorted, keeping the table's entry of any MJD predicted twice.
+        mjd, unique = np.unique(np.concatenate([mjd, needed]),
+                                return_index=True)
+        tmpFile = self.tableFile[:-4] + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmpFile, mjd=mjd,
+                 ra=np.concatenate([ra, newRa])[unique] % 360.,
+                 dec=np.concatenate([dec, newDec])[unique])
+        os.rename(tmpFile, self.tableFile)
+    self.loadTable(reload=True)
+
+  def predict(self, mjds):
+    '''RA and Dec (degrees) at the given MJDs, interpolated in the table,
+    which is extended first if it doesn't cover them.'''
+    if len(self.uncovered(mjds)):
+      self.precompute(mjds)
+    ra = np.interp(mjds, self.table['mjd'], self.table['raUnwrapped']) % 360.
+    dec = np.interp(mjds, self.table['mjd'], self.table['dec'])
+    return ra, dec
+
+  def coordRateAngle(self, mjds, WCS):
+    '''Pixel coordinates (shape (n, 2)), rates (pix/hr) and angles (deg,
+    to x+, modulo 180) at the given MJDs, like
+    maphot_functions.coordRateAngle, but for all MJDs at once.'''
+    mjds = np.atleast_1d(mjds)
+    ra, dec = self.predict(np.concatenate([mjds, mjds + RATE_DT]))
+    coords = WCS.wcs_world2pix(np.array([ra, dec]).T, 1)
+    coords0, coords1 = coords[:len(mjds)], coords[len(mjds):]
+    delta = (coords1 - coords0) / (RATE_DT * 24.)
+    rates = (delta[:, 0] ** 2 + delta[:, 1] ** 2) ** 0.5
+    angles = (np.arctan2(delta[:, 1], delta[:, 0]) * 180. / np.pi) % 180
+    return coords0, rates, angles
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = "ephemeris -c <MPCfile> -f '<fitsglob>' [-e <extension>]"
+  mpcFile, fitsGlob, extno = None, None, None
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "c:f:e:h",
+                                   ["MPCfile=", "imagefiles=", "extension="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-c', '--MPCfile'):
+      mpcFile = arg
+    elif opt in ('-f', '--imagefiles'):
+      fitsGlob = arg
+    elif opt in ('-e', '--extension'):
+      extno = int(arg)
+  if (mpcFile is None) or (fitsGlob is None):
+    print(useage)
+    sys.exit(2)
+  return mpcFile, fitsGlob, extno
+
+
+if __name__ == '__main__':
+  MPCfile, imagefiles, extension = getArguments(sys.argv)
+  MJDs = np.array([headerMJDmid(image, extension)
+                   for image in sorted(glob.glob(imagefiles))])
+  service = EphemerisService(MPCfile)
+  service.precompute(np.concatenate([MJDs, MJDs + RATE_DT]))
+  print('Predicted {} at {} MJDs from {:.5f} to {:.5f} in {}'.format(
+      MPCfile, len(service.table['mjd']), service.table['mjd'][0],
+      service.table['mjd'][-1], service.tableFile))
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,360 @@
+#!/usr/bin/python
+"""
+A persistent index of the sky footprints of images and their extensions.
+
+The footprint (the four corners on the sky) of every image HDU is worked
+out from its header alone, so no pixels are read, and kept together with
+its exposure time and WCS in one npz file. A KD-tree of the footprint
+centres (as unit vectors) makes point ("which CCD is this on?"), cone and
+overlap queries over a whole dataset quick, so for example the Pan-STARRS
+catalog of a field can be fetched before any source detection is run.
+Usage:
+  footprints.py -f '<fitsfileglob>' [-o <indexfile>] [-p <ra>,<dec>]
+adds (or updates) the images in the index and optionally prints the
+image extensions that a point falls on.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import getopt
+import numpy as np
+from scipy.spatial import cKDTree
+import astropy.io.fits as pyf
+from astropy import wcs
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+FOOTPRINT_VERSION = 1
+MJD_KEYS = ('MJD', 'MJDATE', 'MJD-OBS')  # Subaru, CFHT, Gemini/CFHT
+COLUMNS = ['image', 'extno', 'mtime', 'mjdMid', 'naxis1', 'naxis2',
+           'corners', 'xyz', 'radius', 'wcsHeader']
+
+
+def radec2xyz(ra, dec):
+  '''Unit vectors (shape (..., 3)) of ra, dec in degrees.'''
+  ra, dec = np.radians(ra), np.radians(dec)
+  return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                   np.sin(dec)], axis=-1)
+
+
+def xyz2radec(xyz):
+  '''ra, dec in degrees of (not necessarily unit) vectors.'''
+  xyz = np.asarray(xyz, dtype=np.float64)
+  ra = np.degrees(np.arctan2(xyz[..., 1], xyz[..., 0])) % 360.
+  dec = np.degrees(np.arctan2(xyz[..., 2], np.hypot(xyz[..., 0],
+                                                      xyz[..., 1])))
+  return ra, dec
+
+
+def chord(angle):
+  '''Chord length on the unit sphere of an angle in radians.'''
+  return 2. * np.sin(np.minimum(angle, np.pi) / 2.)
+
+
+def gnomonic(centre, xyz):
+  '''Tangent-plane (gnomonic) coordinates of unit vectors xyz (shape
+  (..., 3)) around the unit vector centre. Only valid within 90 degrees.'''
+  east = np.cross([0., 0., 1.], centre)
+  if np.linalg.norm(east) < 1e-12:  # At a pole.
+    east = np.array([0., 1., 0.])
+  east = east / np.linalg.norm(east)
+  north = np.cross(centre, east)
+  depth = np.dot(xyz, centre)
+  return np.stack([np.dot(xyz, east) / depth, np.dot(xyz, north) / depth],
+                  axis=-1)
+
+
+def insidePolygon(polygon, points):
+  '''Whether 2D points (shape (n, 2)) are inside (or on the edge of) the
+  convex polygon with corners (in order) polygon (shape (m, 2)).'''
+  edges = np.roll(polygon, -1, axis=0) - polygon
+  relative = points[:, None, :] - polygon[None, :, :]
+  crosses = (edges[None, :, 0] * relative[:, :, 1]
+             - edges[None, :, 1] * relative[:, :, 0])
+  return np.all(crosses >= 0, axis=1) | np.all(crosses <= 0, axis=1)
+
+
+def polygonsOverlap(polygon1, polygon2):
+  '''Whether two convex 2D polygons overlap (separating axis test).'''
+  for polygon in (polygon1, polygon2):
+    edges = np.roll(polygon, -1, axis=0) - polygon
+    for normal in np.stack([-edges[:, 1], edges[:, 0]], axis=-1):
+      projection1, projection2 = np.dot(polygon1, normal), np.dot(polygon2,
+                                                                  normal)
+      if ((np.max(projection1) < np.min(projection2)) or
+          (np.max(projection2) < np.min(projection1))):
+        return False
+  return True
+
+
+def segmentDistances(polygon, point):
+  '''Distances from a 2D point to each edge of a 2D polygon.'''
+  start = polygon
+  edges = np.roll(polygon, -1, axis=0) - polygon
+  fraction = np.clip(np.sum((point - start) * edges, axis=1)
+                     / np.sum(edges ** 2, axis=1), 0., 1.)
+  closest = start + fraction[:, None] * edges
+  return np.hypot(*(closest - point).T)
+
+
+def edgeNormals(corners, centres):
+  '''Inward normals (shape (n, m, 3)) of the great circles through the
+  edges of n spherical polygons with corners (ra, dec in degrees, shape
+  (n, m, 2)). A point p is inside polygon i if all dot(normals[i], p) >= 0.
+  '''
+  cornersXYZ = radec2xyz(corners[..., 0], corners[..., 1])
+  normals = np.cross(cornersXYZ, np.roll(cornersXYZ, -1, axis=-2))
+  inward = np.sign(np.sum(normals * centres[:, None, :], axis=-1))
+  return normals * inward[..., None]
+
+
+def headerFootprints(imageFile):
+  '''The footprints of all image HDUs of imageFile, from the headers.
+  Returns a dictionary of lists, one entry per HDU, with the COLUMNS.'''
+  columns = dict((name, []) for name in COLUMNS)
+  with pyf.open(imageFile) as han:
+    primary = han[0].header
+    for extno, hdu in enumerate(han):
+      header = hdu.header
+      naxis1 = header.get('ZNAXIS1', header.get('NAXIS1', 0))
+      naxis2 = header.get('ZNAXIS2', header.get('NAXIS2', 0))
+      if (naxis1 == 0) or (naxis2 == 0) or ('CTYPE1' not in header):
+        continue
+      mjdKeys = [key for key in MJD_KEYS if key in header]
+      mjdHeader = header if mjdKeys else primary
+      mjdKeys = mjdKeys or [key for key in MJD_KEYS if key in primary]
+      exptime = header.get('EXPTIME', primary.get('EXPTIME', 0.))
+      WCS = wcs.WCS(header)
+      ra, dec = WCS.all_pix2world([0.5, naxis1 + 0.5, naxis1 + 0.5, 0.5,
+                                   (naxis1 + 1) / 2.],
+                                  [0.5, 0.5, naxis2 + 0.5, naxis2 + 0.5,
+                                   (naxis2 + 1) / 2.], 1)
+      xyz = radec2xyz(ra, dec)
+      columns['image'].append(imageFile)
+      columns['extno'].append(extno)
+      columns['mtime'].append(os.path.getmtime(imageFile))
+      columns['mjdMid'].append(mjdHeader[mjdKeys[0]] + exptime / 172800.
+                               if mjdKeys else np.nan)
+      columns['naxis1'].append(naxis1)
+      columns['naxis2'].append(naxis2)
+      columns['corners'].append(np.array([ra[:4], dec[:4]]).T)
+      columns['xyz'].append(xyz[4])
+      columns['radius'].append(np.max(np.arccos(np.clip(
+          np.dot(xyz[:4], xyz[4]), -1., 1.))))
+      columns['wcsHeader'].append(WCS.to_header_string(relax=True))
+  return columns
+
+
+class FootprintIndex(object):
+  '''The sky footprints of a set of image HDUs, one row per HDU.
+  Usage:
+    index = FootprintIndex('footprints.npz')
+    index.update(glob.glob('*.fits'))  # Only new/changed files are read.
+    index.save()
+    for hdu in index.point(ra, dec):
+      print(index.image[hdu], index.extno[hdu])
+  Row attributes (image, extno, mjdMid, naxis1, naxis2, corners (ra, dec
+  of the 4 corners), xyz (centre unit vector), radius (rad)) are arrays.
+  '''
+
+  def __init__(self, indexFile=None):
+    self.indexFile = indexFile
+    self.columns = dict((name, []) for name in COLUMNS)
+    if (indexFile is not None) and os.path.isfile(indexFile):
+      with np.load(indexFile) as han:
+        if int(han['version']) == FOOTPRINT_VERSION:
+          self.columns = dict((name, han[name]) for name in COLUMNS)
+    self._asArrays()
+
+  def _asArrays(self):
+    empty = {'corners': (0, 4, 2), 'xyz': (0, 3)}
+    for name in COLUMNS:
+      self.columns[name] = (np.array(self.columns[name])
+                            if len(self.columns[name])
+                            else np.zeros(empty.get(name, (0,))))
+    self._tree = None
+    self._normals = None
+    self._WCSs = {}
+
+  def __len__(self):
+    return len(self.columns['image'])
+
+  def __getattr__(self, name):
+    if name in COLUMNS:
+      return self.columns[name]
+    raise AttributeError(name)
+
+  def update(self, imageFiles):
+    '''Add imageFiles to the index, re-reading those that have changed.'''
+    known = dict(zip(self.columns['image'], self.columns['mtime']))
+    changed = [imageFile for imageFile in imageFiles
+               if known.get(imageFile) != os.path.getmtime(imageFile)]
+    if not changed:
+      return
+    keep = ~np.isin(self.columns['image'], changed)
+    columns = dict((name, list(self.columns[name][keep]))
+                   for name in COLUMNS)
+    for imageFile in changed:
+      for name, values in headerFootprints(imageFile).items():
+        columns[name] += values
+    self.columns = columns
+    self._asArrays()
+
+  def save(self, indexFile=None):
+    '''Save the index (atomically) to indexFile, or where it came from.'''
+    indexFile = self.indexFile if indexFile is None else indexFile
+    tmpFile = indexFile[:-4] + '.tmp{}.npz'.format(os.getpid())
+    np.savez(tmpFile, version=FOOTPRINT_VERSION, **self.columns)
+    os.rename(tmpFile, indexFile)
+
+  @property
+  def tree(self):
+    '''KD-tree of the footprint centres (unit vectors).'''
+    if self._tree is None:
+      self._tree = cKDTree(self.columns['xyz'])
+    return self._tree
+
+  @property
+  def normals(self):
+    '''Inward edge normals of the footprints (see edgeNormals).'''
+    if self._normals is None:
+      self._normals = edgeNormals(self.columns['corners'],
+                                  self.columns['xyz'])
+    return self._normals
+
+  def WCS(self, hdu):
+    '''The WCS of a row, from the stored header.'''
+    if hdu not in self._WCSs:
+      self._WCSs[hdu] = wcs.WCS(pyf.Header.fromstring(
+          str(self.columns['wcsHeader'][hdu])))
+    return self._WCSs[hdu]
+
+  def select(self, images=None, extno=None):
+    '''Boolean mask of the rows of the given images and/or extension.'''
+    mask = np.ones(len(self), dtype=bool)
+    if images is not None:
+      mask &= np.isin(self.columns['image'], images)
+    if extno is not None:
+      mask &= self.columns['extno'] == extno
+    return mask
+
+  def contains(self, hdu, ra, dec):
+    '''Whether the points ra, dec are inside the footprint of row hdu.'''
+    points = np.atleast_2d(radec2xyz(ra, dec))
+    return np.all(np.dot(points, self.normals[hdu].T) >= 0, axis=1)
+
+  def point(self, ra, dec, mask=None):
+    '''Rows whose footprint contains the point ra, dec (in degrees).'''
+    if len(self) == 0:
+      return np.zeros(0, dtype=int)
+    point = radec2xyz(ra, dec)
+    candidates = np.array(sorted(self.tree.query_ball_point(
+        point, chord(np.max(self.columns['radius'])))), dtype=int)
+    if mask is not None:
+      candidates = candidates[mask[candidates]]
+    return candidates[np.all(np.dot(self.normals[candidates], point) >= 0,
+                             axis=1)]
+
+  def cone(self, ra, dec, radius, mask=None):
+    '''Rows whose footprint overlaps a cone of radius (deg) around ra, dec.
+    '''
+    if len(self) == 0:
+      return np.zeros(0, dtype=int)
+    centre = radec2xyz(ra, dec)
+    radius = np.radians(radius)
+    candidates = self.tree.query_ball_point(
+        centre, chord(radius + np.max(self.columns['radius'])))
+    rows = []
+    for hdu in sorted(candidates):
+      if (mask is not None) and not mask[hdu]:
+        continue
+      corners = gnomonic(centre, radec2xyz(*self.columns['corners'][hdu].T))
+      if (insidePolygon(corners, np.zeros((1, 2)))[0] or
+          np.min(segmentDistances(corners, np.zeros(2))) <= np.tan(radius)):
+        rows.append(hdu)
+    return np.array(rows, dtype=int)
+
+  def overlaps(self, corners, mask=None):
+    '''Rows whose footprint overlaps the convex polygon with corners
+    (shape (m, 2), ra, dec in degrees, in order).'''
+    if len(self) == 0:
+      return np.zeros(0, dtype=int)
+    cornersXYZ = radec2xyz(*np.asarray(corners, dtype=np.float64).T)
+    centre = np.mean(cornersXYZ, axis=0)
+    centre = centre / np.linalg.norm(centre)
+    radius = np.max(np.arccos(np.clip(np.dot(cornersXYZ, centre), -1., 1.)))
+    candidates = self.tree.query_ball_point(
+        centre, chord(radius + np.max(self.columns['radius'])))
+    polygon = gnomonic(centre, cornersXYZ)
+    return np.array([hdu for hdu in sorted(candidates)
+                     if ((mask is None) or mask[hdu]) and polygonsOverlap(
+                         polygon, gnomonic(centre, radec2xyz(
+                             *self.columns['corners'][hdu].T)))], dtype=int)
+
+  def overlapPairs(self):
+    '''All pairs of rows (i < j) whose footprints overlap.'''
+    if len(self) == 0:
+      return []
+    pairs = []
+    for (ii, jj) in sorted(self.tree.query_pairs(
+        chord(2 * np.max(self.columns['radius'])))):
+      centre = self.columns['xyz'][ii] + self.columns['xyz'][jj]
+      centre = centre / np.linalg.norm(centre)
+      if polygonsOverlap(*[gnomonic(centre, radec2xyz(
+          *self.columns['corners'][hdu].T)) for hdu in (ii, jj)]):
+        pairs.append((ii, jj))
+    return pairs
+
+  def centre(self, images=None, extno=None):
+    '''ra, dec (deg) of the centre of the footprints of the given images
+    and/or extension, and the radius (deg) of a circle around them all.'''
+    mask = self.select(images, extno)
+    if not np.any(mask):
+      raise KeyError('No footprints of {} [{}] in the index.'.format(images,
+                                                                    extno))
+    centre = np.sum(self.columns['xyz'][mask], axis=0)
+    centre = centre / np.linalg.norm(centre)
+    corners = radec2xyz(*self.columns['corners'][mask].reshape(-1, 2).T)
+    radius = np.max(np.arccos(np.clip(np.dot(corners, centre), -1., 1.)))
+    ra, dec = xyz2radec(centre)
+    return ra, dec, np.degrees(radius)
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = ("footprints -f '<fitsglob>' [-o <indexfile> "
+            + "-p <ra>,<dec>]")
+  fitsGlob, indexFile, point = None, 'footprints.npz', None
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "f:o:p:h",
+                                   ["imagefiles=", "output=", "point="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-f', '--imagefiles'):
+      fitsGlob = arg
+    elif opt in ('-o', '--output'):
+      indexFile = arg
+    elif opt in ('-p', '--point'):
+      point = [float(value) for value in arg.split(',')]
+  return fitsGlob, indexFile, point
+
+
+if __name__ == '__main__':
+  imagefiles, indexfile, radec = getArguments(sys.argv)
+  INDEX = FootprintIndex(indexfile)
+  if imagefiles is not None:
+    INDEX.update(sorted(glob.glob(imagefiles)))
+    INDEX.save()
+  print('{} image extensions in {}'.format(len(INDEX), indexfile))
+  if radec is not None:
+    for row in INDEX.point(*radec):
+      print('{}\t{}'.format(INDEX.image[row], INDEX.extno[row]))
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+"""
+Find which known objects fall on which images and extensions.
+
+Given a directory of MPC files and a set of images, the sky footprint of
+every image extension is taken from a footprint index (see footprints.py),
+every orbit is predicted at every exposure time (see ephemeris.py) and the
+index finds the extensions each object is on.
+Every hit that really lands on the CCD is returned as
+  (object, MPC file, image, extno, x, y, rate, angle)
+and written out as maphot command lines, so nobody has to search 100 CCDs
+by hand.
+Usage:
+  locator.py -m <MPCdirectory> -f '<fitsfileglob>' [-o <commandfile>]
+             [-a '<extra maphot arguments>'] [-F <footprintindexfile>]
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import getopt
+import numpy as np
+from ephemeris import EphemerisService, RATE_DT
+from footprints import FootprintIndex
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+def locateObjects(mpcFiles, index, images=None):
+  '''Predict every object in mpcFiles at every exposure in the footprint
+  index (a FootprintIndex), or only those of images, and return a list of
+  (object, mpcFile, image, extno, x, y, rate, angle) tuples,
+  one for each time an object is on the silicon of an extension.'''
+  rows = index.select(images)
+  mjds, exposure = np.unique(index.mjdMid[rows], return_inverse=True)
+  exposureOf = np.full(len(index), -1)
+  exposureOf[rows] = exposure.ravel()
+  located = []
+  for mpcFile in mpcFiles:
+    objectName = os.path.basename(mpcFile).replace('.mpc', '')
+    ephemeris = EphemerisService(mpcFile)
+    ra, dec = ephemeris.predict(np.concatenate([mjds, mjds + RATE_DT]))
+    for ii in range(len(mjds)):
+      for hdu in index.point(ra[ii], dec[ii], mask=(exposureOf == ii)):
+        coords = index.WCS(hdu).wcs_world2pix([[ra[ii], dec[ii]],
+                                               [ra[ii + len(mjds)],
+                                                dec[ii + len(mjds)]]], 1)
+        delta = (coords[1] - coords[0]) / (RATE_DT * 24.)
+        located.append((objectName, mpcFile, str(index.image[hdu]),
+                        int(index.extno[hdu]), float(coords[0, 0]),
+                        float(coords[0, 1]),
+                        float(np.hypot(delta[0], delta[1])),
+                        float(np.degrees(np.arctan2(delta[1], delta[0]))
+                              % 180)))
+  return located
+
+
+def maphotCommands(located, extraArguments=''):
+  '''maphot command lines for located objects. Each run tags its output
+  files with the object's name (maphot -t), as one image (and extension)
+  can hold several objects.'''
+  return ['maphot.py -c {} -f {} -e {} -t {} {}'.format(
+      mpcFile, image, extno, name, extraArguments).strip()
+          for (name, mpcFile, image, extno, _, _, _, _) in located]
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = ("locator -m <MPCdirectory> -f '<fitsglob>' [-o <commandfile> "
+            + "-a '<extra maphot arguments>' -F <footprintindexfile>]")
+  mpcDir, fitsGlob, commandFile, extra = '.', None, 'maphot_commands.sh', ''
+  indexFile = 'footprints.npz'
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "m:f:o:a:F:h",
+                                   ["MPCdir=", "imagefiles=", "output=",
+                                    "arguments=", "footprints="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-m', '--MPCdir'):
+      mpcDir = arg
+    elif opt in ('-f', '--imagefiles'):
+      fitsGlob = arg
+    elif opt in ('-o', '--output'):
+      commandFile = arg
+    elif opt in ('-a', '--arguments'):
+      extra = arg
+    elif opt in ('-F', '--footprints'):
+      indexFile = arg
+  if fitsGlob is None:
+    print(useage)
+    sys.exit(2)
+  return mpcDir, fitsGlob, commandFile, extra, indexFile
+
+
+if __name__ == '__main__':
+  (MPCdir, imagefiles, commandfile, arguments, indexfile
+   ) = getArguments(sys.argv)
+  IMAGES = sorted(glob.glob(imagefiles))
+  INDEX = FootprintIndex(indexfile)
+  INDEX.update(IMAGES)
+  INDEX.save()
+  LOCATED = locateObjects(sorted(glob.glob(os.path.join(MPCdir, '*.mpc'))),
+                          INDEX, IMAGES)
+  print('object\timage\textno\tx\ty\trate\tangle')
+  for (name, _, image, extno, x, y, rate, angle) in LOCATED:
+    print('{}\t{}\t{}\t{:.2f}\t{:.2f}\t{:.3f}\t{:.2f}'.format(
+        name, image, extno, x, y, rate, angle))
+  with open(commandfile, 'w') as han:
+    han.write(''.join(line + '\n' for line in maphotCommands(LOCATED,
+                                                             arguments)))
+  print('{} maphot runs written to {}'.format(len(LOCATED), commandfile))
+
+
+# End of file.
+# Nothing to see here.
@@ -12,6 +12,36 @@ overrideSEx = False  # Change with '-o True' or '--override True'
 remove = True  # Change with '-r False' or '--remove False'
 aprad = 0.7  # Change with '-a 1.5' or '--aprad 1.5'
 sexparfile = 'sex.pars'  # Change with '-s filename' or '--sexparfile filename'
+policy = 'interactive'  # Change with '-p auto' or '--policy auto'
+psfcache = None  # Change with '-k psfcache' or '--psfcache psfcache'
+resultsstore = None  # Change with '-R results' or '--resultsstore results'
+diagnostics = 'full'  # Change with '-d stamps' or '--diagnostics stamps'
+precision = 'native'  # Change with '-P single' or '--precision single'
+tag = ''  # Change with '-t object' or '--tag object'
+With '-t <object>', _<object> is added to the names of all the files this
+run writes (.trippy, _psfStore.fits, _TNOmag.txt, ...), so that the runs of
+several objects on the same image and extension keep their own results;
+their MPC lines go to extnoNN_<object>.mpc, designated by the object.
+With '-p review', nothing is plotted or prompted for, but a montage of each
+image is saved for later review; see review.py.
+With '-k <directory>', the PSF stars and Moffat fits of each image are cached
+in <directory> and used to warm-start the PSF of the next image of the same
+field, filter, extension and seeing; see psfcache.py. Aperture corrections
+are cached there too, by trail geometry; see apercorr.py.
+The photometry of the catalog stars is cached in <directory>/starphot (or
+starphot next to the image) and reused whenever the same image is run
+again with the same stars and settings; see starphotcache.py.
+With '-R <directory>', the TNO and star photometry are also appended to the
+binary tables of a results store in <directory>; see resultsstore.py.
+The orbit in coordsfile is fitted once and its predictions are kept next to
+it, for all other images of the object; see ephemeris.py.
+The stamps around the TNO (and with '-d full' the PSF lookup table) are saved
+to one compressed <image>_diagnostics.fits; '-d none' saves nothing.
+With '-P single', images stored (or scaled) as 64-bit and the stamps around
+the TNO are kept in float32 (sums are still done in float64); '-P double'
+converts them to float64. Images already in float32, like HSC's, are left
+as they are. The image is converted a few rows at a time as it is read, so
+a 64-bit image is never held in both precisions at once.
 coordsfile is a file that contains:
 x1 y1 MJD1
 x2 y2 MJD2
@@ -21,25 +51,35 @@ in order to predict the location in that image.
 """
 
 from __future__ import print_function, division
+import os
 import sys
 from datetime import datetime
 import warnings
-import dill
 from six.moves import zip
 import numpy as np
-import mp_ephem
 #from astropy.io import fits
-from trippy import psf, pill
+from trippy import pill
 import best
-from maphot_functions import (getArguments, getObservations, coordRateAngle,
-                              getSExCatalog, predicted2catalog,
+from maphot_functions import (getArguments, getSExCatalog, predicted2catalog,
                               saveTNOMag, saveStarMag, saveTNOMag2,
                               getDataHeader, addPhotToCatalog, PS1_vs_SEx,
                               PS1_to_CFHT, CFHT_to_PS1, inspectStars,
-                              chooseCentroid, removeTSF,
-                              extractGoodStarCatalogue)
+                              chooseCentroid, removeTSF, measureTNO,
+                              extractGoodStarCatalogue, saveTrippySidecar,
+                              PRECISIONS)
 from __version__ import __version__
 from pix2world import pix2MPC
+from background import BackgroundWorker
+import review
+from psfcache import (estimateSeeing, psfCacheKey, loadPSFCache,
+                      savePSFCache, warmStartCatalogue)
+from psfstore import StoredPSF, savePSFStore
+from apercorr import getAperCorrs
+from ephemeris import EphemerisService
+from resultsstore import appendRecords, makeRecords, checkWidth, TNO_SCHEMA
+from starphotcache import (STARPHOT_QUANTITIES, starPhotKey, loadStarPhot,
+                           saveStarPhot)
+from metrics import RunMetrics, addCount
 
 __author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
               'mike.alexandersen@alumni.ubc.ca)')
@@ -50,28 +90,44 @@ print("You are using maphot version: ", __version__)
 useage = 'maphot -c <coordsfile> -f <fitsfile> -v False '\
          + '-. False -o False -r False -a 0.7'
 (inputFile, coordsfile, verbose, centroid, overrideSEx, remove,
- aprad, repfact, pxscale, roundAperRad, SExParFile, extno, ignoreWarnings
+ aprad, repfact, pxscale, roundAperRad, SExParFile, extno, ignoreWarnings,
+ policy, psfcache, resultsstore, diagnostics, precision, tag
  ) = getArguments(sys.argv)
+# With '-t <object>' every output file name of this run gets _<object> added,
+# so that the runs of several objects on one image don't overwrite each other.
+outputTag = '_' + tag if tag else ''
+# With '-P single' the image and the stamps around the TNO are kept in float32.
+stampDtype = PRECISIONS[precision]
 #Ignore all Python warnings.
 #This is generally a terrible idea, and should be turned off for de-bugging.
 if ignoreWarnings:
   warnings.filterwarnings("ignore")
+# Every stage is timed; with MAPHOT_METRICS=<directory> set, the timings are
+# written there (see metrics.py).
+runMetrics = RunMetrics.fromEnvironment(
+    os.path.basename(inputFile).replace('.fits', '')
+    + ('' if extno is None else '{0:02.0f}'.format(extno)) + outputTag)
 
 print("ifile =", inputFile, ", coords =", coordsfile, ", verbose =", verbose,
       ", centroid =", centroid, ", overrideSEx =", overrideSEx,
-      ", remove =", remove, ", aprad =", aprad)
+      ", remove =", remove, ", aprad =", aprad, ", policy =", policy)
+# With policy='auto' nothing is plotted and nobody is prompted.
+interactive = (policy == 'interactive')
 if verbose:
   print(np.array([centroid]).dtype, np.array([remove]).dtype)
   if centroid or remove:
     print("Will run MCMC centroiding")
 
 # Read in the image and get the data, header and keywords needed.
+runMetrics.lap('readImage')
 (data, header, EXPTIME, MAGZERO, MJD, MJDm, GAIN, NAXIS1, NAXIS2, WCS, FILTER
- ) = getDataHeader(inputFile, extno=extno)
+ ) = getDataHeader(inputFile, extno=extno, dtype=stampDtype)
+if resultsstore is not None:  # The image and object were checked already.
+  checkWidth('filter', FILTER, dict(TNO_SCHEMA)['filter'])
 
 # Set up an output file that has all sorts of information.
 # Preferably, whenever something is printed to screen, save it here too.
-inputName = inputFile.replace('.fits', '{0:02.0f}'.format(extno))
+inputName = inputFile.replace('.fits', '{0:02.0f}'.format(extno)) + outputTag
 outfile = open(inputName + '.trippy', 'w')
 print("############################")
 if extno is None:
@@ -83,15 +139,25 @@ if extno is None:
   outfile.write("\nWorking on {}.\n".format(inputFile))
 else:
   outfile.write("\nWorking on {}[{}].\n".format(inputFile, extno))
+# Review montages and diagnostic images are written in the background.
+if (policy == 'review') or (diagnostics != 'none'):
+  backgroundWorker = BackgroundWorker()
+else:
+  backgroundWorker = None
+if policy == 'review':
+  reviewOverride = review.readOverride(inputName)
+else:
+  reviewOverride = None
+centroidRecord = {}
 print("\nMJDm = ", MJDm)
 outfile.write("\nMJDm = {}\n".format(MJDm))
 
 #Get the object coordinates and rates of motion
-with open(coordsfile) as han:
-    mpc = han.readlines()
-observations = getObservations(mpc)
-TNOorbit = mp_ephem.BKOrbit(observations)
-TNOpred, rate, angle = coordRateAngle(TNOorbit, MJDm, WCS)
+#The orbit is only fitted if no earlier image of this MPC file has been run.
+runMetrics.lap('ephemeris')
+ephemeris = EphemerisService(coordsfile)
+TNOpreds, rates, angles = ephemeris.coordRateAngle(MJDm, WCS)
+TNOpred, rate, angle = TNOpreds[0], rates[0], angles[0]
 print('TNO predicted to be at {},\nmoving at '.format(TNOpred) +
       '{} pix/hr inclined {} deg (to x+).'.format(rate, angle))
 outfile.write('\nTNO predicted to be at {},\nmoving at '.format(TNOpred) +
@@ -99,11 +165,13 @@ outfile.write('\nTNO predicted to be at {},\nmoving at '.format(TNOpred) +
 xPred, yPred = TNOpred
 
 #Get the Source Extractor catalogue
+runMetrics.lap('sourceExtractor')
 if SExParFile is None:
   SEx_params = np.array([2.0, 2.0, 27.8, 10.0, 2.0, 2.0])
 else:
   SEx_params = np.genfromtxt(SExParFile)
 fullSExCat = getSExCatalog(inputFile, SEx_params, extno=extno)
+addCount('sources', len(fullSExCat['XWIN_IMAGE']))
 
 #Find the SourceExtractor source nearest to the predicted location.
 TNOSEx, centroidShift = predicted2catalog(fullSExCat, TNOpred)
@@ -123,6 +191,7 @@ print("xUse, yUse = ", xUse, yUse)
 outfile.write("\nxUse, yUse = {}, {}\n".format(xUse, yUse))
 
 # Read in catalogue of good stars
+runMetrics.lap('catalogMatch')
 bestCatName = ('best.cat' if extno is None
                else 'best{0:02.0f}.cat'.format(extno))
 try:
@@ -137,55 +206,92 @@ except IOError:
   raise IOError(bestCatName + ' missing. Run best.best')
 # Match phot stars to PS1 catalog
 catalog_psf = PS1_vs_SEx(bestCat, fullSExCat, maxDist=1.0, appendSEx=True)
+addCount('bestStars', len(bestCat))
+addCount('matchedStars', len(catalog_psf))
 
 # Restore PSF if exist, otherwise build it.
+runMetrics.lap('psf')
+# Files from older versions of maphot held a pickle of the whole PSF object.
+psfStoreName = inputName + '_psfStore.fits'
+goodStarPickleName = inputName + '_goodStars.pickle'
 try:
-  #goodPSF = psf.modelPSF(restore=inputName + '_psf.fits')
-  #fwhm = goodPSF.FWHM()
-  #print("fwhm = ", fwhm)
-  #outfile.write("\nfwhm = {}\n".format(fwhm))
-  goodStarFile = open(inputName + '_goodStars.pickle', 'rb')
-  (goodFits, goodMeds, goodSTDs, goodPSF, roundAperCorr
-   ) = dill.load(goodStarFile)
-  goodStarFile.close()
-  #goodPSF.fitted=False
-  print("PSF restored from file.")
-  outfile.write("\nPSF restored from file\n")
-  fwhm = goodPSF.FWHM()
-  print("fwhm = ", fwhm, ' restored')
-  outfile.write("\nfwhm = {}\n".format(fwhm))
-except IOError:
-  print("Could not restore PSF (Normal unless previously saved)")
-  print("Making new one.")
-  outfile.write("\nDid not restore PSF from file\n")
-  (goodFits, goodMeds, goodSTDs, goodPSF, fwhm
-   ) = inspectStars(data, catalog_psf, repfact, verbose=True)
-  fwhm = goodPSF.FWHM()
-  print(" fwhm = ", fwhm)
-  outfile.write("\ngoodFits={}".format(goodFits))
-  outfile.write("\ngoodMeds={}".format(goodMeds))
-  outfile.write("\ngoodSTDs={}".format(goodSTDs))
-  outfile.write("\n goodPSF = {}\n".format(goodPSF))
-  outfile.write("\n fwhm = {}\n".format(fwhm))
-  goodPSF.line(rate, angle, EXPTIME / 3600., pixScale=pxscale,
-               useLookupTable=True)
-  goodPSF.computeRoundAperCorrFromPSF(psf.extent(0.7 * fwhm, 4 * fwhm, 100),
-                                      display=False,
-                                      displayAperture=False,
-                                      useLookupTable=True)
-  roundAperCorr = goodPSF.roundAperCorr(roundAperRad * fwhm)
-  goodPSF.computeLineAperCorrFromTSF(psf.extent(0.1 * fwhm, 4 * fwhm, 100),
-                                     l=(EXPTIME / 3600.) * rate / pxscale,
-                                     a=angle, display=False,
-                                     displayAperture=False)
-  goodPSF.psfStore(inputName + '_psf.fits')
-  fwhm = goodPSF.FWHM()
-  print("  fwhm = ", fwhm)
-  outfile.write("\nfwhm = {}\n".format(fwhm))
-  goodStarFile = open(inputName + '_goodStars.pickle', 'wb')
-  dill.dump([goodFits, goodMeds, goodSTDs, goodPSF, roundAperCorr],
-            goodStarFile, dill.HIGHEST_PROTOCOL)
-  goodStarFile.close()
+  psfRestored = False
+  try:
+    if os.path.isfile(psfStoreName):
+      goodPSF = StoredPSF(psfStoreName)
+      goodFits, goodMeds, goodSTDs = (goodPSF.goodFits, goodPSF.goodMeds,
+                                      goodPSF.goodSTDs)
+      fwhm = goodPSF.FWHM()
+      roundAperCorr = goodPSF.roundAperCorr(roundAperRad * fwhm)
+      print("PSF restored from file.")
+      outfile.write("\nPSF restored from file\n")
+      print("fwhm = ", fwhm, ' restored')
+      outfile.write("\nfwhm = {}\n".format(fwhm))
+      psfRestored = True
+    elif os.path.isfile(goodStarPickleName):
+      import dill
+      goodStarFile = open(goodStarPickleName, 'rb')
+      (goodFits, goodMeds, goodSTDs, goodPSF, roundAperCorr
+       ) = dill.load(goodStarFile)
+      goodStarFile.close()
+      print("PSF restored from (old style) file.")
+      outfile.write("\nPSF restored from file\n")
+      fwhm = goodPSF.FWHM()
+      print("fwhm = ", fwhm, ' restored')
+      outfile.write("\nfwhm = {}\n".format(fwhm))
+      psfRestored = True
+  except (IOError, OSError, KeyError) as error:
+    # A store from another PSFSTVER, or a truncated or corrupt file.
+    print("Could not restore PSF: {}".format(error))
+    outfile.write("\nCould not restore PSF: {}\n".format(error))
+  if not psfRestored:
+    print("Could not restore PSF (Normal unless previously saved)")
+    print("Making new one.")
+    outfile.write("\nDid not restore PSF from file\n")
+    # Warm-start from a previous image of this field with similar seeing.
+    catalog_chooser, initAlpha, initBeta = catalog_psf, 3., 3.
+    visualSelection = interactive
+    if psfcache is not None:
+      cacheKey = psfCacheKey(header, FILTER, extno,
+                             estimateSeeing(catalog_psf))
+      cachedPSF = loadPSFCache(psfcache, cacheKey)
+      if cachedPSF is not None:
+        catalog_chooser = warmStartCatalogue(catalog_psf, cachedPSF)
+        initAlpha, initBeta = cachedPSF['goodMeds'][2:4]
+        visualSelection = False  # Stars were already chosen for that image.
+        print("Warm-starting PSF from cache with "
+              + "{} stars, alpha={}, beta={}".format(len(catalog_chooser),
+                                                     initAlpha, initBeta))
+        outfile.write("\nWarm-started PSF from cache {}\n".format(cacheKey))
+    (goodFits, goodMeds, goodSTDs, goodPSF, fwhm
+     ) = inspectStars(data, catalog_chooser, repfact, verbose=True,
+                      noVisualSelection=not visualSelection,
+                      initAlpha=initAlpha, initBeta=initBeta)
+    if psfcache is not None:
+      savePSFCache(psfcache, cacheKey, goodFits, goodMeds, goodSTDs,
+                   extractGoodStarCatalogue(catalog_psf, goodFits[:, 4],
+                                            goodFits[:, 5])['objName'])
+    fwhm = goodPSF.FWHM()
+    print(" fwhm = ", fwhm)
+    outfile.write("\ngoodFits={}".format(goodFits))
+    outfile.write("\ngoodMeds={}".format(goodMeds))
+    outfile.write("\ngoodSTDs={}".format(goodSTDs))
+    outfile.write("\n goodPSF = {}\n".format(goodPSF))
+    outfile.write("\n fwhm = {}\n".format(fwhm))
+    goodPSF.line(rate, angle, EXPTIME / 3600., pixScale=pxscale,
+                 useLookupTable=True)
+    if getAperCorrs(goodPSF, fwhm, (EXPTIME / 3600.) * rate / pxscale,
+                    angle, repfact,
+                    cacheDir=(None if psfcache is None
+                              else os.path.join(psfcache, 'apercorr'))):
+      print("Aperture corrections taken from cache.")
+      outfile.write("\nAperture corrections taken from cache\n")
+    roundAperCorr = goodPSF.roundAperCorr(roundAperRad * fwhm)
+    fwhm = goodPSF.FWHM()
+    print("  fwhm = ", fwhm)
+    outfile.write("\nfwhm = {}\n".format(fwhm))
+    savePSFStore(psfStoreName, goodPSF, goodFits, goodMeds, goodSTDs,
+                 rate, angle, EXPTIME / 3600., pxscale)
 except UnboundLocalError:
   print("Data error occurred!")
   outfile.write("\nData error occured!\n")
@@ -194,64 +300,79 @@ except UnboundLocalError:
 #print(goodStars)
 catalog_phot = extractGoodStarCatalogue(catalog_psf, goodFits[:, 4],
                                         goodFits[:, 5])
+addCount('psfStars', len(goodFits))
 #catalog_phot = catalog_psf
 
 
 # Do photometry for the trimmed catalog stars.
 # This will be used to find a set of non-variable stars, in order to
 # subtract fluctuations due to seeing, airmass, etc.
-bgStars = []
-magStars = []
-dmagStars = []
-fluxStars = []
-SNRStars = []
+# It doesn't depend on the TNO, so it is reused when this image is rerun
+# (unless the background regions are being chosen by hand).
+runMetrics.lap('starPhotometry', stars=len(catalog_phot['XWIN_IMAGE']))
+xStars = np.array(catalog_phot['XWIN_IMAGE'], dtype=np.float64)
+yStars = np.array(catalog_phot['YWIN_IMAGE'], dtype=np.float64)
+starPhotDir = (os.path.join(os.path.dirname(inputFile), 'starphot')
+               if psfcache is None else os.path.join(psfcache, 'starphot'))
+starPhotKeyHash = starPhotKey(inputFile, extno, bestCatName, fwhm,
+                              fwhm * roundAperRad, MAGZERO, EXPTIME, GAIN,
+                              repfact, xStars, yStars)
+handChosenBG = verbose & interactive
+cachedStarPhot = (None if handChosenBG else
+                  loadStarPhot(starPhotDir, inputFile, extno,
+                               starPhotKeyHash))
 print('Photometry of catalog stars')
 outfile.write("\n# Photometry of catalog stars\n")
-outfile.write("\n#   x       y   magnitude  dmagnitude")
-for xcat, ycat in np.array(list(zip(catalog_phot['XWIN_IMAGE'],
-                                    catalog_phot['YWIN_IMAGE']))):
-  starPhot = pill.pillPhot(data, repFact=repfact)
-  starPhot(xcat, ycat, radius=fwhm * roundAperRad, l=0.0, a=0.0,
-           exptime=EXPTIME,
-           #zpt=26.0, skyRadius=4 * fwhm, width=30.,
-           zpt=MAGZERO, skyRadius=4 * fwhm, width=30.,
-           enableBGSelection=verbose, display=verbose, backupMode="smart",
-           trimBGHighPix=3., zscale=False)
-  starPhot.SNR(gain=GAIN, useBGstd=True)
-  print("{0:13.8f} {1:13.8f} {2:13.10f} {3:13.10f}".format(
-        xcat, ycat, starPhot.magnitude - roundAperCorr, starPhot.dmagnitude))
-  outfile.write("\n{0:13.8f} {1:13.8f} {2:13.10f} {3:13.10f}".format(
-                xcat, ycat, starPhot.magnitude - roundAperCorr,
-                starPhot.dmagnitude))
-  magStars.append(starPhot.magnitude - roundAperCorr)
-  dmagStars.append(starPhot.dmagnitude)
-  fluxStars.append(starPhot.sourceFlux)
-  SNRStars.append(starPhot.snr)
-  bgStars.append(starPhot.bg)
+if cachedStarPhot is None:
+  cachedStarPhot = dict((name, np.zeros(len(xStars)))
+                        for name in STARPHOT_QUANTITIES)
+  for ii, (xcat, ycat) in enumerate(zip(xStars, yStars)):
+    starPhot = pill.pillPhot(data, repFact=repfact)
+    starPhot(xcat, ycat, radius=fwhm * roundAperRad, l=0.0, a=0.0,
+             exptime=EXPTIME,
+             #zpt=26.0, skyRadius=4 * fwhm, width=30.,
+             zpt=MAGZERO, skyRadius=4 * fwhm, width=30.,
+             enableBGSelection=handChosenBG, display=handChosenBG,
+             backupMode="smart", trimBGHighPix=3., zscale=False)
+    starPhot.SNR(gain=GAIN, useBGstd=True)
+    cachedStarPhot['mag'][ii] = starPhot.magnitude
+    cachedStarPhot['dmag'][ii] = starPhot.dmagnitude
+    cachedStarPhot['flux'][ii] = starPhot.sourceFlux
+    cachedStarPhot['snr'][ii] = starPhot.snr
+    cachedStarPhot['bg'][ii] = starPhot.bg
+  if not handChosenBG:
+    saveStarPhot(starPhotDir, inputFile, extno, starPhotKeyHash,
+                 cachedStarPhot)
+else:
+  addCount('cached')
+  print('(taken from the star-photometry cache)')
+  outfile.write("\n# (taken from the star-photometry cache)\n")
+magStars = list(cachedStarPhot['mag'] - roundAperCorr)
+dmagStars = list(cachedStarPhot['dmag'])
+fluxStars = list(cachedStarPhot['flux'])
+SNRStars = list(cachedStarPhot['snr'])
+bgStars = list(cachedStarPhot['bg'])
+starLines = ''.join("\n{0:13.8f} {1:13.8f} {2:13.10f} {3:13.10f}".format(
+    xcat, ycat, mag, dmag) for xcat, ycat, mag, dmag in zip(
+        xStars, yStars, magStars, dmagStars))
+print(starLines[1:])
+outfile.write("\n#   x       y   magnitude  dmagnitude" + starLines)
 
+runMetrics.lap('centroid')
 (xUse, yUse, centroidUsed
  ) = chooseCentroid(data, xUse, yUse, xPred, yPred, np.median(bgStars),
                     goodPSF, NAXIS1, NAXIS2, outfile=outfile, repfact=repfact,
-                    centroid=centroid, remove=remove)
+                    centroid=centroid, remove=remove, policy=policy,
+                    override=reviewOverride, record=centroidRecord,
+                    stampDtype=stampDtype)
 
+runMetrics.lap('tnoPhotometry')
 print('\nPhotometry of moving object')
 outfile.write("\nPhotometry of moving object\n")
-TNOPhot = pill.pillPhot(data, repFact=repfact)
-# Make sure to use IRAF coordinates not numpy/sextractor coordinates!
-if aprad > 0:
-  bestap = np.arange(aprad, aprad + 1)[0]  # stupid but wouldn't work otherwise
-else:  # Automatically identify best aperture.
-  apertures = np.arange(0.7, 2.0, 0.1)
-  linedmag = np.zeros(len(apertures))
-  for i, ap in enumerate(apertures):
-    TNOPhot(xUse, yUse, radius=fwhm * ap, l=(EXPTIME / 3600.) * rate / pxscale,
-            a=angle, skyRadius=4 * fwhm, width=6 * fwhm,
-            #zpt=26.0, exptime=EXPTIME, enableBGSelection=False, display=False,
-            zpt=MAGZERO, exptime=EXPTIME, enableBGSelection=False,
-            display=False, backupMode="smart", trimBGHighPix=3., zscale=False)
-    TNOPhot.SNR(gain=GAIN, verbose=False, useBGstd=True)
-    linedmag[i] = TNOPhot.dmagnitude
-  bestap = apertures[np.argmin(linedmag)]
+TNOPhot, bestap = measureTNO(data, xUse, yUse, fwhm, aprad,
+                             (EXPTIME / 3600.) * rate / pxscale, angle,
+                             EXPTIME, MAGZERO, GAIN, repfact=repfact,
+                             interactive=interactive)
 lineAperRad = bestap
 print("Aperture used= ", bestap)
 outfile.write("\nBest aperture = {}".format(bestap))
@@ -259,13 +380,6 @@ lineAperCorr = goodPSF.lineAperCorr(lineAperRad * fwhm)
 print("lineAperCorr, roundAperCorr = ", lineAperCorr, roundAperCorr, "\n")
 outfile.write("\nlineAperCorr,roundAperCorr={},{}".format(lineAperCorr,
                                                           roundAperCorr))
-TNOPhot(xUse, yUse, radius=fwhm * lineAperRad,
-        l=(EXPTIME / 3600.) * rate / pxscale,
-        a=angle, skyRadius=4 * fwhm, width=6 * fwhm,
-        #zpt=26.0, exptime=EXPTIME, enableBGSelection=True, display=True,
-        zpt=MAGZERO, exptime=EXPTIME, enableBGSelection=True, display=True,
-        backupMode="smart", trimBGHighPix=3., zscale=False)
-TNOPhot.SNR(gain=GAIN, verbose=True, useBGstd=True)
 
 # Print those values
 print("TNOPhot.magnitude = ", TNOPhot.magnitude)
@@ -293,6 +407,7 @@ outfile.write("{0:13.8f} {1:13.8f} {2:13.10f} {3:13.10f} {4:13.10f}\n".format(
               TNOPhot.dmagnitude, MAGZERO))
 
 # Add photometry to the star catalog
+runMetrics.lap('calibration')
 magKeyName = FILTER + 'MagTrippy' + str(bestap)
 PS1PhotCat = addPhotToCatalog(catalog_phot['XWIN_IMAGE'],
                               catalog_phot['YWIN_IMAGE'], catalog_phot,
@@ -301,7 +416,8 @@ PS1PhotCat = addPhotToCatalog(catalog_phot['XWIN_IMAGE'],
                                'TrippySourceFlux': np.array(fluxStars),
                                'TrippySNR': np.array(SNRStars),
                                'TrippyBG': np.array(bgStars)})
-# Convert star catalog's PS1 magnitudes to CFHT magnitudes
+# Convert star catalog's PS1 magnitudes to CFHT magnitudes, in all four
+# filters (for the _starmag.txt file); only this filter's is used below.
 finalCat = PS1_to_CFHT(PS1PhotCat)
 # Calculate magnitude calibration factor
 magCalibArray = (finalCat[FILTER + 'MeanPSFMag_CFHT']
@@ -311,6 +427,7 @@ magCalibration = np.nanmedian(magCalibArray)
 sigmaclip = [np.abs(magCalibArray - magCalibration) < 3 * dmagCalibration]
 magCalibration = np.nanmedian(magCalibArray[sigmaclip])
 dmagCalibration = np.nanstd(magCalibArray[sigmaclip])
+addCount('calibrationStars', int(np.sum(sigmaclip)))
 
 # Correct the TNO magnitude and zero point
 finalTNOphotCFHT = (TNOPhot.magnitude - lineAperCorr + magCalibration,
@@ -330,6 +447,7 @@ outfile.write("\n#{0:12} {1:13} {2:13} {3:13} {4:13}\n".format(
 outfile.write("{0:13.8f} {1:13.8f} {2:13.10f} {3:13.10f} {4:13.10f}\n".format(
               xUse, yUse, finalTNOphotPS1[0], finalTNOphotPS1[1], zptGood))
 
+runMetrics.lap('saveResults')
 TNOCoords = WCS.all_pix2world(xUse, yUse, 1)
 #Save TNO magnitudes neatly.
 timeNow = datetime.now().strftime('%Y-%m-%d/%H:%M:%S')
@@ -339,23 +457,76 @@ saveTNOMag(inputFile, coordsfile, MJD, MJDm, TNOCoords, xUse, yUse,
            MAGZERO, FILTER, fwhm, bestap, TNOPhot,
            magCalibration, dmagCalibration, finalTNOphotCFHT, zptGood,
            finalTNOphotPS1, timeNow, np.array(TNOPhot.bgSamplingRegion),
-           __version__, extno=extno)
+           __version__, extno=extno, tag=outputTag)
 saveStarMag(inputFile, finalCat[sigmaclip], timeNow, __version__,
-            MJD, extno=extno)
+            MJD, extno=extno, tag=outputTag)
+saveTrippySidecar(inputName, inputFile, extno, MJD, MJDm, MAGZERO,
+                  header.get('MAGZERO_RMS', np.nan), zptGood, FILTER,
+                  catalog_phot, {'mag': magStars, 'dmag': dmagStars,
+                                 'flux': fluxStars, 'snr': SNRStars,
+                                 'bg': bgStars}, xUse, yUse,
+                  finalTNOphotPS1,
+                  (TNOPhot.magnitude - lineAperCorr, TNOPhot.dmagnitude),
+                  __version__, dzptGood=dmagCalibration)
+if resultsstore is not None:
+  extnoStore = -1 if extno is None else extno
+  appendRecords(resultsstore, 'tno', makeRecords(
+      'tno', image=os.path.basename(inputFile), extno=extnoStore,
+      object=os.path.basename(coordsfile).replace('.mpc', ''),
+      mjd=MJD, mjdMid=MJDm, ra=TNOCoords[0], dec=TNOCoords[1],
+      x=xUse, y=yUse, filter=FILTER, fwhm=fwhm, aperture=bestap,
+      magRaw=TNOPhot.magnitude, dmagRaw=TNOPhot.dmagnitude, zptRaw=MAGZERO,
+      magCalibration=magCalibration, dmagCalibration=dmagCalibration,
+      magInst=finalTNOphotCFHT[0], dmagInst=finalTNOphotCFHT[1],
+      zptGood=zptGood, magPS1=finalTNOphotPS1[0],
+      dmagPS1=finalTNOphotPS1[1], flux=TNOPhot.sourceFlux,
+      snr=TNOPhot.snr, bg=TNOPhot.bg,
+      bgXMin=TNOPhot.bgSamplingRegion[0], bgXMax=TNOPhot.bgSamplingRegion[1],
+      bgYMin=TNOPhot.bgSamplingRegion[2], bgYMax=TNOPhot.bgSamplingRegion[3],
+      runTime=timeNow, version=__version__))
+  appendRecords(resultsstore, 'stars', makeRecords(
+      'stars', len(finalCat), image=os.path.basename(inputFile),
+      extno=extnoStore,
+      mjdMid=MJDm, objName=finalCat['objName'],
+      x=finalCat['XWIN_IMAGE'], y=finalCat['YWIN_IMAGE'],
+      ra=finalCat['raMean'], dec=finalCat['decMean'], filter=FILTER,
+      mag=finalCat[magKeyName], dmag=finalCat['d' + magKeyName],
+      flux=finalCat['TrippySourceFlux'], snr=finalCat['TrippySNR'],
+      bg=finalCat['TrippyBG'], refMag=finalCat[FILTER + 'MeanPSFMag_CFHT'],
+      refColour=finalCat['gMeanPSFMag'] - finalCat['iMeanPSFMag'],
+      calibStar=sigmaclip[0]))
 
 # You could stop here.
+runMetrics.lap('removal')
 # However, to confirm that things are working well,
 # let's generate the trailed PSF and subtract the object out of the image.
 #if centroid and (('e' in centroidUsed) or ('E' in centroidUsed) or
 #                 ('s' in centroidUsed) or ('S' in centroidUsed)):
 #  remove = True
-removeTSF(data, xUse, yUse, TNOPhot.bg, goodPSF, NAXIS1, NAXIS2, header,
-          inputName, outfile=outfile, repfact=repfact, remove=remove)
+TSFStamps = removeTSF(data, xUse, yUse, TNOPhot.bg, goodPSF, NAXIS1, NAXIS2,
+                      header, inputName, outfile=outfile, repfact=repfact,
+                      remove=remove, diagnostics=diagnostics,
+                      worker=backgroundWorker, stampDtype=stampDtype)
+if policy == 'review':
+  review.queueReview(backgroundWorker, inputName, sys.argv, TSFStamps,
+                     xUse, yUse, centroidUsed, centroidRecord,
+                     fwhm * lineAperRad, (EXPTIME / 3600.) * rate / pxscale,
+                     angle)
+# The jobs have their own copies (crops) of the stamps, so the image, the
+# stamps and the photometry objects holding the image are let go here,
+# before the jobs run, rather than when the run ends.
+data = TSFStamps = TNOPhot = starPhot = None
 
 #Run function to save photometry in MPC format
-pix2MPC(WCS, EXPTIME, MJD, finalTNOphotPS1[0], xUse, yUse, FILTER, extno)
+runMetrics.lap('finishOutputs')
+pix2MPC(WCS, EXPTIME, MJD, finalTNOphotPS1[0], xUse, yUse, FILTER, extno,
+        tag=tag)
 
+if backgroundWorker is not None:
+  backgroundWorker.close()
 print('Done with ' + inputFile + '!')
 outfile.close()
+runMetrics.finish()
+runMetrics.write()
 # End of file.
 # Nothing to see here.
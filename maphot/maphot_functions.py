@@ -18,28 +18,28 @@ x2 y2 MJD2
 ie. the position of the TNO at two times, and those times in MJD format.
 The script then reads the MJD keyword from the input files and extrapolates
 in order to predict the location in that image.
+The plotting (pylab, numdisplay), network (requests), orbit (mp_ephem) and
+fitting (trippy) modules are imported by the functions that need them, so
+importing maphot_functions is quick and a stage only pays for what it uses.
 """
 
 from __future__ import print_function, division
 import os
 import getopt
 import sys
+import json
 from six.moves import input
 import numpy as np
-import pylab as pyl
-import mp_ephem
-import requests
-import astropy.io.fits as pyf
-from astropy.visualization import interval
-from astropy.io.votable import parse_single_table
-from astropy.table import Column, Table
-from astropy import wcs
-from trippy import scamp, MCMCfit, psf, psfStarChooser
-from stsci import numdisplay  # pylint: disable=import-error
-from __version__ import __version__
+from appender import appendLocked, replaceLocked
+from phottransforms import addTransformedColumns, toPS1
+from diagnostics import DIAGNOSTIC_LEVELS, saveDiagnostics
+from metrics import addCount
 __author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
               'mike.alexandersen@alumni.ubc.ca)')
-print("You are using maphot version: ", __version__)
+
+# Precisions of the image data and stamps (maphot -P); None keeps the data
+# as stored and makes stamps the old way.
+PRECISIONS = {'native': None, 'single': np.float32, 'double': np.float64}
 
 
 def queryPanSTARRS(ra_deg, dec_deg, rad_deg=0.1, mindet=1, maxsources=10000,
@@ -58,6 +58,7 @@ def queryPanSTARRS(ra_deg, dec_deg, rad_deg=0.1, mindet=1, maxsources=10000,
               catalog_filename: the filename to save the catalog query to.
   returns: astropy.table object
   '''
+  import requests
   r = requests.get(server, params={'RA': ra_deg, 'DEC': dec_deg,
                                    'SR': rad_deg, 'max_records': maxsources,
                                    'outputformat': 'VOTable',
@@ -75,6 +76,7 @@ def readPanSTARRS(catalog_filename='panstarrs.xml', rMin=0, gMin=0,
   Read a PanSTARRS catalog from an xml file.
   Only include objects that have both g and r-band magnitudes.
   '''
+  from astropy.io.votable import parse_single_table
   # Read an xml file and parse it into an astropy.table object.
   PS1CatDataFull = parse_single_table(catalog_filename)
   PS1All = PS1CatDataFull.to_table(use_names_over_ids=True)
@@ -103,6 +105,7 @@ def PS1_vs_SEx(PS1Cat, SExCat, maxDist=1, appendSEx=True):
       PS1Args.append(ii)
   PS1SExCatalog = PS1Cat[PS1Args]
   if appendSEx:
+    from astropy.table import Column
     PS1SExCatalog.add_columns([Column(SExCat[key][SExArgs], key)
                                for key in SExCat.keys()])
   return PS1SExCatalog
@@ -150,6 +153,7 @@ def trimCatalog(cat, somedata, dcut, mcut, snrcut, shapecut, naxis1, naxis2):
 
 def getObservations(mpc_lines):
   '''Parces MPC lines and generates an mp_ephem observation.'''
+  import mp_ephem
   observationList = []
   for _, mpc_line in enumerate(mpc_lines):
     date = mpc_line[15:31]
@@ -193,6 +197,7 @@ def writeSExParFiles(imageFileName, minArea, threshold, zpt, aperture,
     sexFile = imageFileName.replace('.fits', '{0:02.0f}.sex'.format(extno))
   os.system('rm {}'.format(sexFile))
   os.system('rm def.param')
+  from trippy import scamp
   os.system('rm default.conv')
   if np.shape(aperture):
     aperture = list(aperture)
@@ -220,6 +225,7 @@ def runSExtractor(imageFileName, SExParams, extno=None):
                                            '{0:02.0f}.sex'.format(extno))
     catalogFile = imageFileName.replace('.fits', '{0:02.0f}.cat'.format(extno))
     imageFNE = imageFileName + '[{}]'.format(extno)
+  from trippy import scamp
   writeSExParFiles(imageFileName, *SExParams, extno=extno)
   try:
     scamp.runSex(SExtractorFile, imageFNE,
@@ -240,6 +246,7 @@ def getSExCatalog(imageFileName, SExParams, extno=None, verb=True):
     catalogFile = imageFileName.replace('.fits', '{0:02.0f}.cat'.format(extno))
   else:
     catalogFile = imageFileName.replace('.fits', '{0:02.0f}.cat'.format(extno))
+  from trippy import scamp
   try:
     fullcatalog = scamp.getCatalog(catalogFile, paramFile='def.param')
   except IOError:
@@ -259,14 +266,18 @@ def runMCMCCentroid(centPSF, centData, centxt, centyt, centm,
   """runMCMCCentroid runs an MCMC centroiding, fitting the TSF to the data.
   Returns the fitted centoid co-ordinates.
   """
+  from trippy import MCMCfit
   print("MCMC-fitting TSF to the moving object")
+  nWalkers, nBurn, nStep = 10, 20, 20
   centfitter = MCMCfit.MCMCfitter(centPSF, centData)
   centfitter.fitWithModelPSF(centdtransx + centxt - int(centxt),
                              centdtransy + centyt - int(centyt),
                              m_in=centm / repfact ** 2.,
-                             fitWidth=10, nWalkers=10,
-                             nBurn=20, nStep=20, bg=centbg, useLinePSF=True,
-                             verbose=True, useErrorMap=False)
+                             fitWidth=10, nWalkers=nWalkers,
+                             nBurn=nBurn, nStep=nStep, bg=centbg,
+                             useLinePSF=True, verbose=True,
+                             useErrorMap=False)
+  addCount('mcmcSteps', nWalkers * (nBurn + nStep))
   (centfitPars, centfitRange) = centfitter.fitResults(0.67)
 # Reverse the above coordinate transformation:
   xcentroid, ycentroid = centfitPars[0:2] \
@@ -279,7 +290,11 @@ def getArguments(sysargv):
   """Get arguments given when this is called from a command line"""
   useage = ('maphot -c <MPCfile> -f <imagefile> -e <extension>'
             + ' -i <ignoreWarnings> [-v <verbose>  -. <centroid> '
-            + '-o <overrideSEx> -r <remove> -a <aprad> -s <sexparfile>]')
+            + '-o <overrideSEx> -r <remove> -a <aprad> -s <sexparfile> '
+            + '-p <policy (interactive/auto/review)> -k <psfcachedir> '
+            + '-R <resultsstoredir> -d <diagnostics (none/stamps/full)> '
+            + '-P <precision (native/single/double)> '
+            + '-t <tag of the output file names, e.g. the object>]')
   AinputFile = 'a100.fits'  # Change with '-f <filename>' flag
   Acoordsfile = 'coords.in'  # Change with '-c <coordsfile>' flag
   Averbose = False  # Change with '-v True' or '--verbose True'
@@ -290,12 +305,22 @@ def getArguments(sysargv):
   Arepfact, Apxscale, = 10, 1.0
   Asexparfile, Aextno = None, None
   AignoreWarnings = False
+  Apolicy = 'interactive'  # Change with '-p auto' or '--policy auto'
+  Apsfcache = None  # Change with '-k psfcache' or '--psfcache psfcache'
+  Aresults = None  # Change with '-R results' or '--resultsstore results'
+  Adiagnostics = 'full'  # Change with '-d stamps' or '--diagnostics stamps'
+  Aprecision = 'native'  # Change with '-P single' or '--precision single'
+  Atag = ''  # Change with '-t object' or '--tag object'
   try:
-    options, dummy = getopt.getopt(sysargv[1:], "f:c:v:.:o:r:a:h:s:e:i:",
+    options, dummy = getopt.getopt(sysargv[1:],
+                                   "f:c:v:.:o:r:a:h:s:e:i:p:k:R:d:P:t:",
                                    ["imagefile=", "MPCfile=", "verbose=",
                                     "centroid=", "overrideSEx=",
                                     "remove=", "aprad=", "sexparfile=",
-                                    "extension=", "ignoreWarnings="])
+                                    "extension=", "ignoreWarnings=",
+                                    "policy=", "psfcache=",
+                                    "resultsstore=", "diagnostics=",
+                                    "precision=", "tag="])
     for opt, arg in options:
       if (opt in ("-v", "-verbose", "-.", "--centroid", "-o", "--overrideSEx",
                   "-r", "--remove", "-i", "--ignoreWarnings")):
@@ -329,15 +354,43 @@ def getArguments(sysargv):
         Aextno = int(arg)
       elif opt in ('-i', '--ignoreWarnings'):
         AignoreWarnings = arg
-  except TypeError as error:
+      elif opt in ('-p', '--policy'):
+        if arg not in ('interactive', 'auto', 'review'):
+          raise TypeError("-p flag must be followed by "
+                          + "interactive/auto/review")
+        Apolicy = arg
+      elif opt in ('-k', '--psfcache'):
+        Apsfcache = arg
+      elif opt in ('-R', '--resultsstore'):
+        Aresults = arg
+      elif opt in ('-d', '--diagnostics'):
+        if arg not in DIAGNOSTIC_LEVELS:
+          raise TypeError("-d flag must be followed by "
+                          + "/".join(DIAGNOSTIC_LEVELS))
+        Adiagnostics = arg
+      elif opt in ('-P', '--precision'):
+        if arg not in PRECISIONS:
+          raise TypeError("-P flag must be followed by "
+                          + "/".join(sorted(PRECISIONS)))
+        Aprecision = arg
+      elif opt in ('-t', '--tag'):
+        Atag = arg
+    if Aresults is not None:  # Rather than fail at the end of the run.
+      from resultsstore import checkWidth, TNO_SCHEMA
+      checkWidth('image', os.path.basename(AinputFile),
+                 dict(TNO_SCHEMA)['image'])
+      checkWidth('object', os.path.basename(Acoordsfile).replace('.mpc', ''),
+                 dict(TNO_SCHEMA)['object'])
+  except (TypeError, ValueError) as error:
     print(error)
-    sys.exit()
+    sys.exit(2)
   except getopt.GetoptError as error:
     print(" Input ERROR! \n", useage)
     sys.exit(2)
   return (AinputFile, Acoordsfile, Averbose, Acentroid,
           AoverrideSEx, Aremove, Aaprad, Arepfact, Apxscale, AroundAperRad,
-          Asexparfile, Aextno, AignoreWarnings)
+          Asexparfile, Aextno, AignoreWarnings, Apolicy, Apsfcache,
+          Aresults, Adiagnostics, Aprecision, Atag)
 
 
 def findTNO(xzero, yzero, fullcat, outfile):
@@ -393,8 +446,10 @@ def predicted2catalog(someCatalog, someCoords):
 def saveTNOMag(image_fn, mpc_fn, headerMJD, obsMJD, SExTNOCoord, x_tno, y_tno,
                zpt, obsFILTER, FWHM, aperMulti, TNOphot,
                magCalibration, dmagCalibration, finalTNOphotINST, zptGood,
-               finalTNOphotPS1, timeNow, TNObgRegion, version, extno=None):
-  '''Save the TNO magnitude and other information.'''
+               finalTNOphotPS1, timeNow, TNObgRegion, version, extno=None,
+               tag=''):
+  '''Save the TNO magnitude and other information.
+  tag is added to the file name (see maphot -t).'''
   filtStr = obsFILTER + 'RawMag'
   mag_heads = ''
   mag_strings = ''
@@ -411,10 +466,11 @@ def saveTNOMag(image_fn, mpc_fn, headerMJD, obsMJD, SExTNOCoord, x_tno, y_tno,
                                      TNOphot.dmagnitude)
   if extno is None:
     print('Warning: Treating this as a single extension file.')
-    TNOFileName = image_fn.replace('.fits', '_TNOmag.txt')
+    TNOFileName = image_fn.replace('.fits', tag + '_TNOmag.txt')
   else:
     TNOFileName = image_fn.replace('.fits',
-                                   '{0:02.0f}_TNOmag.txt'.format(extno))
+                                   '{0:02.0f}{1}_TNOmag.txt'.format(extno,
+                                                                    tag))
   TNOFile = open(TNOFileName, 'w')
   TNOFile.write('#Filename\tObject\tMJD\tMJD_middle\t' +
                 'RA(deg)\tDec(deg)\t' +
@@ -443,42 +499,53 @@ def saveTNOMag(image_fn, mpc_fn, headerMJD, obsMJD, SExTNOCoord, x_tno, y_tno,
 
 def saveTNOMag2(image_fn, mpc_fn, obsMJD, SExTNOCoord, x_tno, y_tno,
                 obsFILTER, FWHM, finalTNOphotPS1, timeNow, version,
-                extno=None):
-  '''Save the TNO magnitude and other information.'''
+                extno=None, replace=False):
+  '''Save the TNO magnitude and other information.
+  Many maphot runs may append to the same file at once, so the file is
+  locked while writing and the header is only written to an empty file.
+  With replace=True, earlier rows of the same image and object are removed
+  (see review.rerunOverride).'''
   if extno is None:
     print('Warning: Treating this as a single extension file.')
     TNOFileName = 'TNOmags.txt'
   else:
     TNOFileName = 'TNOmags{0:02.0f}.txt'.format(extno)
-  TNOFile = open(TNOFileName, 'a+')
-  TNOFile.write('#Filename\tObject\tMJDm\t' +
-                'RA(deg)\tDec(deg)\t' +
-                'x_pix\ty_pix\t' +
-                'Filter\tFWHM\t' +
-                'GoodMag_PS1\tdGoodMag_PS1\t' +
-                'RunTime\t' +
-                'maphot_version\n')
-  TNOFile.write(image_fn.replace('.fits','') + '\t' +
-                mpc_fn.replace('.mpc', '').replace('../MPC/', '') + '\t' +
-                '{}\t'.format(obsMJD) +
-                '{}\t{}\t'.format(SExTNOCoord[0], SExTNOCoord[1]) +
-                '{}\t{}\t'.format(x_tno, y_tno) +
-                '{}\t{}\t'.format(obsFILTER, FWHM) +
-                '{}\t{}\t'.format(finalTNOphotPS1[0], finalTNOphotPS1[1]) +
-                '{}\t'.format(timeNow) +
-                '{}\n'.format(version))
-  TNOFile.close()
+  imageObject = (image_fn.replace('.fits', '') + '\t' +
+                 mpc_fn.replace('.mpc', '').replace('../MPC/', '') + '\t')
+  row = (imageObject +
+         '{}\t'.format(obsMJD) +
+         '{}\t{}\t'.format(SExTNOCoord[0], SExTNOCoord[1]) +
+         '{}\t{}\t'.format(x_tno, y_tno) +
+         '{}\t{}\t'.format(obsFILTER, FWHM) +
+         '{}\t{}\t'.format(finalTNOphotPS1[0], finalTNOphotPS1[1]) +
+         '{}\t'.format(timeNow) +
+         '{}\n'.format(version))
+  header = ('#Filename\tObject\tMJDm\t' +
+            'RA(deg)\tDec(deg)\t' +
+            'x_pix\ty_pix\t' +
+            'Filter\tFWHM\t' +
+            'GoodMag_PS1\tdGoodMag_PS1\t' +
+            'RunTime\t' +
+            'maphot_version\n')
+  if replace:
+    replaceLocked(TNOFileName, row,
+                  lambda line: line.startswith(imageObject), header=header)
+  else:
+    appendLocked(TNOFileName, row, header=header)
   return
 
 
-def saveStarMag(image_fn, finalCat, timeNow, version, headerMJD, extno=None):
-  '''Save the star magnitudes and other information.'''
+def saveStarMag(image_fn, finalCat, timeNow, version, headerMJD, extno=None,
+                tag=''):
+  '''Save the star magnitudes and other information.
+  tag is added to the file name (see maphot -t).'''
   if extno is None:
     print('Warning: Treating this as a single extension file.')
-    starFileName = image_fn.replace('.fits', '_starmag.txt')
+    starFileName = image_fn.replace('.fits', tag + '_starmag.txt')
   else:
     starFileName = image_fn.replace('.fits',
-                                    '{0:02.0f}_starmag.txt'.format(extno))
+                                    '{0:02.0f}{1}_starmag.txt'.format(extno,
+                                                                      tag))
   starFile = open(starFileName, 'w')
   starFile.write('#Run time: {}\n'.format(timeNow))
   starFile.write('#Image name and MJD: {} {}\n'.format(image_fn, headerMJD))
@@ -492,74 +559,63 @@ def saveStarMag(image_fn, finalCat, timeNow, version, headerMJD, extno=None):
   return
 
 
+def saveTrippySidecar(inputName, image_fn, extno, headerMJD, obsMJD, zpt,
+                      zptErr, zptGood, obsFILTER, starCat, starPhot,
+                      x_tno, y_tno, finalTNOphotPS1, TNOMagRaw, version,
+                      dzptGood=None):
+  '''Save the numbers that photcor needs from the .trippy log
+  (star positions and magnitudes, MJD, zero point and the TNO result)
+  to a json sidecar, <inputName>.trippy.json, which is quick to read.
+  starPhot is a dictionary of the 'mag', 'dmag', 'flux', 'snr' and 'bg'
+  of the stars in starCat. dzptGood, the uncertainty of zptGood, lets
+  review.rerunOverride calibrate a new TNO measurement the same way.'''
+  sidecar = {'version': version, 'image': image_fn,
+             'extno': None if extno is None else int(extno),
+             'MJD': float(headerMJD), 'MJDm': float(obsMJD),
+             'MAGZERO': float(zpt), 'MAGZERO_RMS': float(zptErr),
+             'zptGood': float(zptGood),
+             'dzptGood': None if dzptGood is None else float(dzptGood),
+             'filter': obsFILTER,
+             'stars': {'objName': [str(name) for name in starCat['objName']],
+                       'x': np.array(starCat['XWIN_IMAGE'],
+                                     dtype=float).tolist(),
+                       'y': np.array(starCat['YWIN_IMAGE'],
+                                     dtype=float).tolist(),
+                       'mag': np.array(starPhot['mag'], dtype=float).tolist(),
+                       'dmag': np.array(starPhot['dmag'],
+                                        dtype=float).tolist(),
+                       'flux': np.array(starPhot['flux'],
+                                        dtype=float).tolist(),
+                       'snr': np.array(starPhot['snr'], dtype=float).tolist(),
+                       'bg': np.array(starPhot['bg'], dtype=float).tolist()},
+             'tno': {'x': float(x_tno), 'y': float(y_tno),
+                     'mag': float(finalTNOphotPS1[0]),
+                     'dmag': float(finalTNOphotPS1[1]),
+                     'magRaw': float(TNOMagRaw[0]),
+                     'dmagRaw': float(TNOMagRaw[1])}}
+  sidecarName = inputName + '.trippy.json'
+  with open(sidecarName + '.tmp', 'w') as sidecarFile:
+    json.dump(sidecar, sidecarFile)
+  os.rename(sidecarName + '.tmp', sidecarName)
+  return
+
+
 def PS1_to_Gemini(catalog):
-  '''Transform the PS1 magnitudes of catalog stars to Gemini magnitudes,
-  using the filter transforms from Schwamb et al 2018.'''
-  PS1rGemini = Column(catalog['rMeanPSFMag'] - 0.052 *
-                      (catalog['gMeanPSFMag'] - catalog['rMeanPSFMag']),
-                      name='rMeanPSFMag_Gemini',
-                      description=catalog['rMeanPSFMag'].description +
-                      ' transformed to Gemini filter')
-  PS1gGemini = Column(catalog['gMeanPSFMag'] + 0.0369 *
-                      (catalog['gMeanPSFMag'] - catalog['rMeanPSFMag']),
-                      name='gMeanPSFMag_Gemini',
-                      description=catalog['gMeanPSFMag'].description +
-                      ' transformed to Gemini filter')
-  GeminiCat = catalog.copy()
-  GeminiCat.add_columns((PS1rGemini, PS1gGemini))
-  return GeminiCat
+  '''A copy of catalog with the PS1 magnitudes of its stars transformed to
+  Gemini g and r (see phottransforms). The data are not copied.'''
+  return addTransformedColumns(catalog.copy(copy_data=False), 'Gemini', 'gr')
 
 
 def PS1_to_CFHT(catalog, filters='griz'):
-  '''Transform the PS1 magnitudes of catalog stars to CFHT magnitudes,
-  using the filter transforms from CADC:
-  http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/en/megapipe/docs/filt.html .
-  Note, these are for the new 2015 filter set.'''
-  PS1g = catalog['gMeanPSFMag']
-  PS1i = catalog['iMeanPSFMag']
-  PS1gi = PS1g - PS1i
-  conpars = {'g': [0.014, 0.059, -0.00313, -0.00178],
-             'r': [0.003, -0.050, 0.0125, -0.0069],
-             'i': [0.006, -0.024, 0.00627, -0.00523],
-             'z': [-0.016, -0.069, 0.0239, -0.0056]}
-  CFHTCat = catalog.copy()
-  new_columns = []
-  for key in CFHTCat.keys():
-    new_columns.append(CFHTCat[key])
-  for CFHfilt in filters:
-    c = conpars[CFHfilt]
-    PS1toCFHT = Column(catalog[CFHfilt + 'MeanPSFMag'] + c[0] + c[1] * PS1gi
-                       + c[2] * PS1gi ** 2 + c[3] * PS1gi ** 3,
-                       name=CFHfilt + 'MeanPSFMag_CFHT',
-                       description=catalog[CFHfilt + 'MeanPSFMag'].description
-                       + ' transformed to CFHT filter')
-    new_columns.append(PS1toCFHT)
-  newColumnsTable = Table(new_columns)
-  return newColumnsTable
+  '''A copy of catalog with the PS1 magnitudes of its stars transformed to
+  the given CFHT filters (see phottransforms). The data are not copied.'''
+  return addTransformedColumns(catalog.copy(copy_data=False), 'CFHT',
+                               filters)
 
 
 def CFHT_to_PS1(magnitude, mag_uncertainty, filter_name='r'):
-  '''Transform CFHT magnitude to PS1 magnitudes,
-  using the filter transforms from CADC:
-  http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/en/megapipe/docs/filt.html ,
-  and the median colours from Olef 2012:
-  http://iopscience.iop.org/article/10.1088/0004-637X/749/1/10/meta ,
-  converted to CFHT colours using the CHFT transforms.
-  Note, these are for the new 2015 filter set.'''
-  gr = (0.69, 0.17)  # g-r calculated from Olef 2012
-  ri = (0.28, 0.17)  # r-i
-  iz = (0.22, 0.20)  # i-z and std
-  conpars = {'g': [gr, -0.015, -0.067, 0],
-             'r': [ri, -0.002, +0.154, 0],
-             'i': [ri, -0.002, +0.087, 0],
-             'z': [iz, +0.001, +0.175, +0.013]}
-  c = conpars[filter_name]
-  conversion = c[1] + c[2] * c[0][0] + c[3] * c[0][0] ** 2
-  conv_uncertainty = (c[2] + 2 * c[3] * c[0][0]) * c[0][1]
-  print(mag_uncertainty, conv_uncertainty)
-  PS1mag = magnitude + conversion
-  PS1mag_uncertainty = (mag_uncertainty ** 2 + conv_uncertainty ** 2) ** 0.5
-  return PS1mag, PS1mag_uncertainty
+  '''Transform CFHT magnitude to PS1 magnitudes (see phottransforms).'''
+  return toPS1(magnitude, mag_uncertainty, 'CFHT', filter_name)
 
 
 def addPhotToCatalog(X, Y, catTable, photDict):
@@ -567,6 +623,7 @@ def addPhotToCatalog(X, Y, catTable, photDict):
   Trims the catalog and adds the columns for our photometry.
   Since the X and Y coordinates should already come from the catalog,
   maching should be unique '''
+  from astropy.table import Column
   tableArgs = []
   photDictArgs = []
   for i, XYi in enumerate(catTable['XWIN_IMAGE', 'YWIN_IMAGE']):
@@ -580,17 +637,39 @@ def addPhotToCatalog(X, Y, catTable, photDict):
   return bestCat
 
 
-def getDataHeader(inputFile, extno=None):
+def readConverted(inputFile, extno, dtype, rows=256):
+  '''The image of a fits file extension in dtype, read and converted a few
+  rows at a time, so that the whole image is never held in both precisions
+  at once.'''
+  import astropy.io.fits as pyf
+  # Not memory mapped, so that each section is read from the file, rather
+  # than paged in (and kept) in its stored precision.
+  with pyf.open(inputFile, memmap=False) as han:
+    hdu = han[extno]
+    data = np.empty(hdu.shape, dtype=dtype)
+    for row in range(0, hdu.shape[0], rows):
+      data[row:row + rows] = hdu.section[row:row + rows]
+  return data
+
+
+def getDataHeader(inputFile, extno=None, dtype=None):
   '''Reads in a fits file (or a given extension of one).
-  Returns the image data, the header, and a few useful keyword values.'''
+  Returns the image data, the header, and a few useful keyword values.
+  With a dtype (see PRECISIONS), images of another size of float are
+  converted to it, as they are read (see readConverted); ones already that
+  size (in either byte order) are left as they are, rather than copied.'''
+  import astropy.io.fits as pyf
+  from astropy import wcs
   with pyf.open(inputFile) as han:
     if extno is None:
       print('Warning: Treating this as a single extension file.')
-      data = han.data
-      header = han.header
+      extno = 0
+    header = han[extno].header
+    if (dtype is not None) and (han[extno].section[0:1].dtype.itemsize
+                                != np.dtype(dtype).itemsize):
+      data = readConverted(inputFile, extno, dtype)
     else:
       data = han[extno].data
-      header = han[extno].header
     EXPTIME = header['EXPTIME']
     try:
       MAGZERO = header['MAGZERO']  # Subaru Hyper-Suprime
@@ -624,12 +703,17 @@ def getDataHeader(inputFile, extno=None):
 
 def inspectStars(data, catalogue, repfactor, **kwargs):
   """Run psfStarChooser, inspect stars, generate PSF and lookup table.
+  initAlpha and initBeta are the starting Moffat parameters of the fits,
+  which can be warm-started from a previous image (see psfcache).
   """
   SExCatalogue = kwargs.pop('SExCatalogue', False)
   noVisualSelection = kwargs.pop('noVisualSelection', False)
   verbose = kwargs.pop('verbose', False)
+  initAlpha = kwargs.pop('initAlpha', 3.)
+  initBeta = kwargs.pop('initBeta', 3.)
   if kwargs:
     raise TypeError('Unexpected **kwargs: %r' % kwargs)
+  from trippy import psf, psfStarChooser
   print(np.shape(data))
   try:
     starChooser = psfStarChooser.starChooser(data, catalogue['XWIN_IMAGE'],
@@ -638,7 +722,7 @@ def inspectStars(data, catalogue, repfactor, **kwargs):
                                              catalogue['FLUXERR_AUTO'])
     (goodFits, goodMeds, goodSTDs
      ) = starChooser(30, 100,  # (box size, min SNR)
-                     initAlpha=3., initBeta=3.,
+                     initAlpha=initAlpha, initBeta=initBeta,
                      repFact=repfactor,
                      includeCheesySaturationCut=False,
                      noVisualSelection=noVisualSelection,
@@ -770,8 +854,104 @@ def findSharedPS1Catalogue(catalogueArray, **kwargs):
   return sharedCatalogue
 
 
+def backgroundStamp(data, xt, yt, bg, halfWidth, NAXIS1, NAXIS2,
+                    dtype=None):
+  '''The stamp of data within halfWidth pixels of xt, yt, minus bg, and
+  the y and x of int(yt), int(xt) in it (less one, as the TSF fits use).
+  With a dtype (e.g. np.float32) the stamp is made in it, without a
+  float64 intermediate; otherwise it has the precision of data - bg.'''
+  ylow = np.max([0, int(yt) - halfWidth])
+  xlow = np.max([0, int(xt) - halfWidth])
+  cutout = data[ylow:np.min([NAXIS2 - 1, int(yt) + halfWidth]),
+                xlow:np.min([NAXIS1 - 1, int(xt) + halfWidth])]
+  if dtype is None:
+    stamp = cutout - bg
+  else:
+    stamp = np.subtract(cutout, bg, dtype=dtype)
+  return stamp, int(yt) - ylow - 1, int(xt) - xlow - 1
+
+
+def scoreCentroid(goodPSF, Data, xd, yd, boxSize=15):
+  '''Score a candidate centroid (given in the coordinates of the stamp Data)
+  by fitting the amplitude of the TSF there with linear least squares.
+  Returns the reduced chi-square of the residual and the matched-filter SNR,
+  both using a robust (MAD) estimate of the background noise in Data.
+  The sums are accumulated in float64, also for float32 stamps.
+  '''
+  noise = 1.4826 * np.nanmedian(np.abs(Data - np.nanmedian(Data)))
+  ny, nx = np.shape(Data)
+  xl, xh = np.max([0, int(xd) - boxSize]), np.min([nx, int(xd) + boxSize])
+  yl, yh = np.max([0, int(yd) - boxSize]), np.min([ny, int(yd) + boxSize])
+  box = Data[yl:yh, xl:xh]
+  model = goodPSF.plant(xd - xl, yd - yl, 1.0, np.zeros(np.shape(box)),
+                        addNoise=False, useLinePSF=True, returnModel=True)
+  modelNorm = np.nansum(model ** 2, dtype=np.float64)
+  if (modelNorm <= 0) | (noise <= 0) | (np.size(box) == 0):
+    return np.inf, 0.0
+  amplitude = np.nansum(box * model, dtype=np.float64) / modelNorm
+  residual = box - amplitude * model
+  chi2 = (np.nansum((residual / noise) ** 2, dtype=np.float64)
+          / np.max([1, np.size(box) - 1]))
+  snr = amplitude * modelNorm ** 0.5 / noise
+  return chi2, snr
+
+
+def autoChooseCentroid(candidates, scores, x0, y0, outfile=None,
+                       maxShift=15., agreeTol=1.0, minSNR=3.0):
+  '''Headless replacement for the centroid prompt in chooseCentroid.
+  candidates is a dictionary of {'S': (x, y), 'M': (x, y), 'e': (x, y)}
+  holding the SExtractor, MCMC and estimated (predicted) centroids, the former
+  two only if available. scores holds (chi2, snr) from scoreCentroid for each.
+  The rules, in order, are:
+  1) centroids shifted more than maxShift pixels from the prediction are out;
+  2) centroids with SNR < minSNR are out;
+  3) if SExtractor and MCMC agree to within agreeTol pixels, use SExtractor;
+  4) otherwise use the candidate with the lowest residual chi-square;
+  5) if nothing is left, use the estimate.
+  Returns the chosen key and a list of reasons, also written to outfile.
+  '''
+  reasons = []
+  useable = []
+  for key in ['S', 'M', 'e']:
+    if key not in candidates:
+      continue
+    xc, yc = candidates[key]
+    shift = ((xc - x0) ** 2 + (yc - y0) ** 2) ** 0.5
+    chi2, snr = scores[key]
+    reasons.append('{}: x,y={:.3f},{:.3f} shift={:.2f}pix chi2={:.3f} '
+                   'snr={:.1f}'.format(key, xc, yc, shift, chi2, snr))
+    if key == 'e':  # The estimate is only ever used as the fallback.
+      continue
+    elif shift > maxShift:
+      reasons.append('{} rejected: shift > {}'.format(key, maxShift))
+    elif snr < minSNR:
+      reasons.append('{} rejected: snr < {}'.format(key, minSNR))
+    else:
+      useable.append(key)
+  if ('S' in useable) & ('M' in useable):
+    agreement = ((candidates['S'][0] - candidates['M'][0]) ** 2 +
+                 (candidates['S'][1] - candidates['M'][1]) ** 2) ** 0.5
+    reasons.append('S and M differ by {:.2f}pix'.format(agreement))
+    if agreement < agreeTol:
+      useable = ['S']
+      reasons.append('S and M agree, using S')
+  if useable:
+    yn = useable[np.argmin([scores[key][0] for key in useable])]
+    reasons.append('{} has lowest chi2 of {}'.format(yn, useable))
+  else:
+    yn = 'e'
+    reasons.append('No acceptable centroid, using estimate')
+  print("\n".join(["Centroid policy: " + reason for reason in reasons]))
+  if outfile is not None:
+    outfile.write("".join(["\nCentroid policy: " + reason
+                           for reason in reasons]))
+  return yn, reasons
+
+
 def chooseCentroid(data, xt, yt, x0, y0, bg, goodPSF, NAXIS1, NAXIS2,
-                   repfact=10, outfile=None, centroid=False, remove=False):
+                   repfact=10, outfile=None, centroid=False, remove=False,
+                   policy='interactive', override=None, record=None,
+                   stampDtype=None):
   ''' Choose between SExtractor position and predicted position.
   If desirable, use MCMC to fit the TSF to the object, thus centroiding on it.
   This is often NOT better than the SExtractor location, especially when the
@@ -779,30 +959,43 @@ def chooseCentroid(data, xt, yt, x0, y0, bg, goodPSF, NAXIS1, NAXIS2,
   (near something bright).
   This fit is also used to remove the object from the image, later.
   fit takes time proportional to nWalkers*(2+nBurn+nStep).
+  policy='auto' never plots or prompts, but picks a centroid using
+  autoChooseCentroid, which allows running without a person at the keyboard.
+  policy='review' does the same, but first checks for a reviewer's
+  override=(choice, x, y), given by review.readOverride.
+  If a record dictionary is given, the automatic policy fills it with the
+  candidate centroids and the reasons for its choice.
+  The stamps are made in stampDtype, if given (see backgroundStamp).
   '''
+  if (policy == 'review') & (override is not None):
+    yn, xt, yt = override
+    print("Coordinates chosen by reviewer: {} {} {}".format(yn, xt, yt))
+    if outfile is not None:
+      outfile.write("\nCoordinates chosen by reviewer: {}".format(yn))
+    return xt, yt, yn
+  if policy in ('auto', 'review'):
+    return chooseCentroidAuto(data, xt, yt, x0, y0, bg, goodPSF,
+                              NAXIS1, NAXIS2, repfact=repfact,
+                              outfile=outfile, centroid=centroid,
+                              remove=remove, record=record,
+                              stampDtype=stampDtype)
+  import pylab as pyl
   if (x0 == xt) & (y0 == yt):  # if SExtractor not find TNO, run centroid
     centroid = True
     SExFoundIt = False
   else:
     SExFoundIt = True
-  Data = (data[np.max([0, int(yt) - 200]):np.min([NAXIS2 - 1, int(yt) + 200]),
-               np.max([0, int(xt) - 200]):np.min([NAXIS1 - 1, int(xt) + 200])]
-          - bg)
-  dtransy, dtransx = (int(yt) - np.max([0, int(yt) - 200]) - 1,
-                      int(xt) - np.max([0, int(xt) - 200]) - 1)
-  Zoom = (data[np.max([0, int(yt) - 15]):np.min([NAXIS2 - 1, int(yt) + 15]),
-               np.max([0, int(xt) - 15]):np.min([NAXIS1 - 1, int(xt) + 15])]
-          - bg)
-  zy, zx = (int(yt) - np.max([0, int(yt) - 15]) - 1,
-            int(xt) - np.max([0, int(xt) - 15]) - 1)
+  Data, dtransy, dtransx = backgroundStamp(data, xt, yt, bg, 200, NAXIS1,
+                                           NAXIS2, stampDtype)
+  Zoom, zy, zx = backgroundStamp(data, xt, yt, bg, 15, NAXIS1, NAXIS2,
+                                 stampDtype)
   m_obj = np.max(data[np.max([0, int(yt) - 5]):
                       np.min([NAXIS2 - 1, int(yt) + 5]),
                       np.max([0, int(xt) - 5]):
                       np.min([NAXIS1 - 1, int(xt) + 5])])
   xt0, yt0 = xt, yt
   while True:  # Breaks once a centroid has been selected.
-    (z1, z2) = numdisplay.zscale.zscale(Zoom)
-    normer = interval.ManualInterval(z1, z2)
+    normer = zscaleNormer(Zoom)
     pyl.imshow(normer(Zoom), origin='lower')
     pyl.plot([zx + x0 - int(xt0)], [zy + y0 - int(yt0)], 'k*', ms=10)
     if SExFoundIt:
@@ -873,26 +1066,120 @@ def chooseCentroid(data, xt, yt, x0, y0, bg, goodPSF, NAXIS1, NAXIS2,
   return xt, yt, yn
 
 
+def chooseCentroidAuto(data, xt, yt, x0, y0, bg, goodPSF, NAXIS1, NAXIS2,
+                       repfact=10, outfile=None, centroid=False, remove=False,
+                       record=None, stampDtype=None):
+  '''Non-interactive version of chooseCentroid.
+  Runs the MCMC centroid under the same conditions as chooseCentroid would,
+  scores all available centroids and lets autoChooseCentroid pick one.
+  '''
+  SExFoundIt = not ((x0 == xt) & (y0 == yt))
+  Data, dtransy, dtransx = backgroundStamp(data, xt, yt, bg, 200, NAXIS1,
+                                           NAXIS2, stampDtype)
+  m_obj = np.max(data[np.max([0, int(yt) - 5]):
+                      np.min([NAXIS2 - 1, int(yt) + 5]),
+                      np.max([0, int(xt) - 5]):
+                      np.min([NAXIS1 - 1, int(xt) + 5])])
+  candidates = {'e': (x0, y0)}
+  if SExFoundIt:
+    candidates['S'] = (xt, yt)
+  if centroid or remove or not SExFoundIt:
+    xcent, ycent, fitPars, fitRange = runMCMCCentroid(goodPSF, Data, x0, y0,
+                                                      m_obj, bg,
+                                                      dtransx, dtransy,
+                                                      repfact)
+    print("\nfitPars = ", fitPars, "\nfitRange = ", fitRange, "\n")
+    if outfile is not None:
+      outfile.write("\nfitPars={}".format(fitPars) +
+                    "\nfitRange={}".format(fitRange))
+    candidates['M'] = (xcent, ycent)
+  scores = {}
+  for key in candidates:
+    scores[key] = scoreCentroid(goodPSF, Data,
+                                dtransx + candidates[key][0] - int(xt),
+                                dtransy + candidates[key][1] - int(yt))
+  yn, reasons = autoChooseCentroid(candidates, scores, x0, y0,
+                                   outfile=outfile)
+  if record is not None:
+    record['candidates'] = candidates
+    record['reasons'] = reasons
+  xt, yt = candidates[yn]
+  print("Coordinates chosen from this centroid: {}".format(yn))
+  if outfile is not None:
+    outfile.write("\nCoordinates chosen from this centroid: {}".format(yn))
+  return xt, yt, yn
+
+
+def measureTNO(data, xUse, yUse, fwhm, aprad, trailLength, angle, EXPTIME,
+               MAGZERO, GAIN, repfact=10, interactive=False):
+  '''Trailed aperture photometry of the TNO at (xUse, yUse), in an aperture
+  of aprad * fwhm, or (with aprad <= 0) the one of 0.7 to 1.9 * fwhm that
+  gives the smallest uncertainty. Returns the pillPhot object and the
+  aperture used (in units of fwhm).'''
+  from trippy import pill
+  TNOPhot = pill.pillPhot(data, repFact=repfact)
+  # Make sure to use IRAF coordinates not numpy/sextractor coordinates!
+  if aprad > 0:
+    bestap = np.arange(aprad, aprad + 1)[0]  # stupid but wouldn't work else
+  else:  # Automatically identify best aperture.
+    apertures = np.arange(0.7, 2.0, 0.1)
+    linedmag = np.zeros(len(apertures))
+    for i, ap in enumerate(apertures):
+      TNOPhot(xUse, yUse, radius=fwhm * ap, l=trailLength,
+              a=angle, skyRadius=4 * fwhm, width=6 * fwhm,
+              zpt=MAGZERO, exptime=EXPTIME, enableBGSelection=False,
+              display=False, backupMode="smart", trimBGHighPix=3.,
+              zscale=False)
+      TNOPhot.SNR(gain=GAIN, verbose=False, useBGstd=True)
+      linedmag[i] = TNOPhot.dmagnitude
+    bestap = apertures[np.argmin(linedmag)]
+    addCount('apertures', len(apertures))
+  TNOPhot(xUse, yUse, radius=fwhm * bestap, l=trailLength,
+          a=angle, skyRadius=4 * fwhm, width=6 * fwhm,
+          zpt=MAGZERO, exptime=EXPTIME, enableBGSelection=interactive,
+          display=interactive,
+          backupMode="smart", trimBGHighPix=3., zscale=False)
+  TNOPhot.SNR(gain=GAIN, verbose=True, useBGstd=True)
+  return TNOPhot, bestap
+
+
+def zscaleNormer(image):
+  '''An interval that scales images to the zscale limits of image.'''
+  from astropy.visualization import interval
+  from stsci import numdisplay  # pylint: disable=import-error
+  (z1, z2) = numdisplay.zscale.zscale(image)
+  return interval.ManualInterval(z1, z2)
+
+
 def removeTSF(data, xt, yt, bg, goodPSF, NAXIS1, NAXIS2, header, inputName,
-              outfile=None, repfact=10, remove=True, verbose=False):
+              outfile=None, repfact=10, remove=True, verbose=False,
+              diagnostics='full', worker=None, stampDtype=None):
   '''Remove a TSF.
-  If remove=False, will not remove, just saves postage-stamp around xt, yt.'''
-  Data = (data[np.max([0, int(yt) - 200]):np.min([NAXIS2 - 1, int(yt) + 200]),
-               np.max([0, int(xt) - 200]):np.min([NAXIS1 - 1, int(xt) + 200])]
-          - bg)
-  dtransy = int(yt) - np.max([0, int(yt) - 200]) - 1
-  dtransx = int(xt) - np.max([0, int(xt) - 200]) - 1
+  If remove=False, will not remove, just saves postage-stamp around xt, yt.
+  The stamps are saved at the given diagnostics level (see diagnostics.py),
+  in the background if a worker (BackgroundWorker) is given.
+  Returns the stamp, the model and the removed (residual) stamp (the latter
+  two are None if remove=False) and the position of xt, yt in the stamp.
+  With a stampDtype, all three stamps are kept in it.'''
+  if verbose:
+    import pylab as pyl
+  Data, dtransy, dtransx = backgroundStamp(data, xt, yt, bg, 200, NAXIS1,
+                                           NAXIS2, stampDtype)
   m_obj = np.max(data[np.max([0, int(yt) - 5]):
                       np.min([NAXIS2 - 1, int(yt) + 5]),
                       np.max([0, int(xt) - 5]):
                       np.min([NAXIS1 - 1, int(xt) + 5])])
+  modelImage, removed = None, None
   if remove:
     print("Should I be doing this?")
+    from trippy import MCMCfit
+    nWalkers, nBurn, nStep = 10, 10, 10
     fitter = MCMCfit.MCMCfitter(goodPSF, Data)
     fitter.fitWithModelPSF(dtransx + xt - int(xt), dtransy + yt - int(yt),
-                           m_in=m_obj / repfact ** 2., fitWidth=2, nWalkers=10,
-                           nBurn=10, nStep=10, bg=bg, useLinePSF=True,
-                           verbose=True, useErrorMap=False)
+                           m_in=m_obj / repfact ** 2., fitWidth=2,
+                           nWalkers=nWalkers, nBurn=nBurn, nStep=nStep, bg=bg,
+                           useLinePSF=True, verbose=True, useErrorMap=False)
+    addCount('mcmcSteps', nWalkers * (nBurn + nStep))
     (fitPars, fitRange) = fitter.fitResults(0.67)
     print("\nfitPars = ", fitPars, "\n")
     print("\nfitRange = ", fitRange, "\n")
@@ -901,12 +1188,14 @@ def removeTSF(data, xt, yt, bg, goodPSF, NAXIS1, NAXIS2, header, inputName,
       outfile.write("\nfitRange={}".format(fitRange))
     removed = goodPSF.remove(fitPars[0], fitPars[1], fitPars[2],
                              Data, useLinePSF=True)
-    (z1, z2) = numdisplay.zscale.zscale(removed)
-    normer = interval.ManualInterval(z1, z2)
     modelImage = goodPSF.plant(fitPars[0], fitPars[1], fitPars[2], Data,
                                addNoise=False, useLinePSF=True,
                                returnModel=True)
+    if stampDtype is not None:
+      removed = removed.astype(stampDtype, copy=False)
+      modelImage = modelImage.astype(stampDtype, copy=False)
     if verbose:
+      normer = zscaleNormer(removed)
       pyl.imshow(normer(goodPSF.lookupTable), origin='lower')
       pyl.show()
       pyl.imshow(normer(modelImage), origin='lower')
@@ -915,27 +1204,16 @@ def removeTSF(data, xt, yt, bg, goodPSF, NAXIS1, NAXIS2, header, inputName,
       pyl.show()
       pyl.imshow(normer(removed), origin='lower')
       pyl.show()
-    hdu = pyf.PrimaryHDU(modelImage, header=header)
-    list = pyf.HDUList([hdu])
-    list.writeto(inputName + '_modelImage.fits', overwrite=True)
-    hdu = pyf.PrimaryHDU(removed, header=header)
-    list = pyf.HDUList([hdu])
-    list.writeto(inputName + '_removed.fits', overwrite=True)
-  else:
-    (z1, z2) = numdisplay.zscale.zscale(Data)
-    normer = interval.ManualInterval(z1, z2)
-    if verbose:
-      pyl.imshow(normer(goodPSF.lookupTable), origin='lower')
-      pyl.show()
-      pyl.imshow(normer(Data), origin='lower')
-      pyl.show()
-  hdu = pyf.PrimaryHDU(goodPSF.lookupTable, header=header)
-  list = pyf.HDUList([hdu])
-  list.writeto(inputName + '_lookupTable.fits', overwrite=True)
-  hdu = pyf.PrimaryHDU(Data, header=header)
-  list = pyf.HDUList([hdu])
-  list.writeto(inputName + '_Data.fits', overwrite=True)
-  return
+  elif verbose:
+    normer = zscaleNormer(Data)
+    pyl.imshow(normer(goodPSF.lookupTable), origin='lower')
+    pyl.show()
+    pyl.imshow(normer(Data), origin='lower')
+    pyl.show()
+  saveDiagnostics(inputName, diagnostics, header, Data, modelImage, removed,
+                  goodPSF.lookupTable, worker=worker)
+  return (Data, modelImage, removed,
+          (dtransx + xt - int(xt), dtransy + yt - int(yt)))
 
 
 # End of file.
@@ -0,0 +1,218 @@
+"""
+Stage-level timing and metrics of maphot, best and photcor runs.
+
+A RunMetrics records, for every stage of a run, the wall time, the CPU
+time (of this process and of its children, such as Source Extractor), the
+peak resident memory (RSS) and counts such as the number of sources,
+matched stars or MCMC steps. Stages are timed with
+  with stage('inspectStars') as counts:
+    ...
+    counts['psfStars'] = len(goodFits)
+or, in a script that runs from top to bottom, with laps, each of which ends
+the previous one:
+  runMetrics.lap('sourceExtractor')
+Code deeper down adds to whatever stage is running with addCount('mcmcSteps',
+400); without a current run, stage and addCount do nothing.
+Nothing is written unless the MAPHOT_METRICS environment variable names a
+directory, so production runs can be measured without changing any code:
+  MAPHOT_METRICS=metrics maphot.py ...
+writes metrics/<run>.metrics.json, and with MAPHOT_PROFILE=1 also a cProfile
+dump of every top-level stage, metrics/<run>.<stage>.prof, for pstats or
+snakeviz. The file is also written at exit if the run stops early, with the
+stages that never ended marked 'unfinished'.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import atexit
+import socket
+import cProfile
+from contextlib import contextmanager
+from datetime import datetime
+from timeit import default_timer
+try:
+  import resource
+except ImportError:  # There is no resource module on Windows.
+  resource = None
+from __version__ import __version__
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+METRICS_ENV = 'MAPHOT_METRICS'
+PROFILE_ENV = 'MAPHOT_PROFILE'
+RSS_UNIT = 1. if sys.platform == 'darwin' else 1024.  # ru_maxrss in bytes/kB
+
+CURRENT = [None]  # The current RunMetrics, if any.
+
+
+def peakRSS():
+  '''The peak resident memory of this process so far (MB), or None.'''
+  if resource is None:
+    return None
+  return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+          / 1024. ** 2)
+
+
+def cpuTimes():
+  '''The user + system CPU time (s) of this process and of its (finished)
+  children.'''
+  times = os.times()
+  return times[0] + times[1], times[2] + times[3]
+
+
+class RunMetrics(object):
+  '''The stages of one run, written to <directory>/<runName>.metrics.json.
+  Creating one makes it the current run, which stage and addCount use.'''
+
+  def __init__(self, runName, directory=None, profile=False):
+    self.runName = runName
+    self.directory = directory
+    self.profile = profile and (directory is not None)
+    self.stages = []
+    self.openStages = []
+    self.lapStage = None
+    self.profiler = None
+    self.names = {}
+    self.written = False
+    self.started = datetime.now().isoformat()
+    self.start = (default_timer(), cpuTimes())
+    CURRENT[0] = self
+    if directory is not None:
+      atexit.register(self.write)
+
+  @classmethod
+  def fromEnvironment(cls, runName):
+    '''A RunMetrics that writes to the MAPHOT_METRICS directory (if set),
+    with cProfile dumps if MAPHOT_PROFILE is set (to anything but 0).'''
+    return cls(runName, os.environ.get(METRICS_ENV) or None,
+               os.environ.get(PROFILE_ENV, '0') not in ('', '0'))
+
+  def openStage(self, name, counts):
+    '''Start timing a stage; returns its record.'''
+    self.names[name] = self.names.get(name, 0) + 1
+    if self.names[name] > 1:  # Repeated stages get numbered.
+      name = '{}.{}'.format(name, self.names[name])
+    record = {'name': name, 'counts': dict(counts), 'status': 'running',
+              'parent': (self.openStages[-1]['name'] if self.openStages
+                         else None),
+              'profile': None}
+    if self.profile and (self.profiler is None):
+      self.makeDirectory()
+      self.profiler = cProfile.Profile()
+      record['profile'] = os.path.join(
+          self.directory, '{}.{}.prof'.format(self.runName, name))
+      self.profiler.enable()
+    record['begin'] = (default_timer(), cpuTimes(), peakRSS())
+    self.openStages.append(record)
+    self.stages.append(record)
+    return record
+
+  def closeStage(self, record, status='ok'):
+    '''Stop timing a stage (and any stages still open inside it).'''
+    while record in self.openStages:
+      inner = self.openStages.pop()
+      wall, (cpu, childCPU), rss = inner.pop('begin')
+      nowCPU, nowChildCPU = cpuTimes()
+      inner.update(wall=default_timer() - wall, cpu=nowCPU - cpu,
+                   childCPU=nowChildCPU - childCPU, peakRSS=peakRSS(),
+                   status=status if inner is record else 'unfinished')
+      inner['rssGrowth'] = (None if rss is None
+                            else inner['peakRSS'] - rss)
+      if inner['profile'] is not None:
+        self.profiler.disable()
+        self.profiler.dump_stats(inner['profile'])
+        self.profiler = None
+
+  @contextmanager
+  def stage(self, name, **counts):
+    '''Time the with block as a stage; yields its (writable) counts.'''
+    record = self.openStage(name, counts)
+    try:
+      yield record['counts']
+    except BaseException:
+      self.closeStage(record, 'failed')
+      raise
+    self.closeStage(record)
+
+  def lap(self, name, **counts):
+    '''End the previous lap (if any) and start timing the next one.
+    Returns its (writable) counts.'''
+    if self.lapStage is not None:
+      self.closeStage(self.lapStage)
+    self.lapStage = self.openStage(name, counts)
+    return self.lapStage['counts']
+
+  def finish(self):
+    '''End the last lap.'''
+    if self.lapStage is not None:
+      self.closeStage(self.lapStage)
+      self.lapStage = None
+
+  def addCount(self, name, value=1):
+    '''Add value to the count name of the innermost running stage.'''
+    if self.openStages:
+      counts = self.openStages[-1]['counts']
+      counts[name] = counts.get(name, 0) + value
+
+  def makeDirectory(self):
+    '''Make the metrics directory, if it doesn't exist yet.'''
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+
+  def summary(self):
+    '''The run and its stages, as a dictionary.'''
+    nowCPU, nowChildCPU = cpuTimes()
+    stages = [dict((key, value) for key, value in record.items()
+                   if key != 'begin') for record in self.stages]
+    return {'run': self.runName, 'version': __version__,
+            'argv': sys.argv, 'host': socket.gethostname(),
+            'pid': os.getpid(), 'started': self.started,
+            'status': ('ok' if all(record['status'] == 'ok'
+                                   for record in stages) else 'unfinished'),
+            'wall': default_timer() - self.start[0],
+            'cpu': nowCPU - self.start[1][0],
+            'childCPU': nowChildCPU - self.start[1][1],
+            'peakRSS': peakRSS(), 'stages': stages}
+
+  def write(self):
+    '''Write the metrics file (once), ending any stages that are still
+    open as unfinished. Returns its name, or None if there is no
+    directory to write to.'''
+    if (self.directory is None) or self.written:
+      return None
+    for record in self.openStages[:1]:
+      self.closeStage(record, 'unfinished')
+    self.makeDirectory()
+    fileName = os.path.join(self.directory,
+                            self.runName + '.metrics.json')
+    tmpFile = fileName + '.tmp{}'.format(os.getpid())
+    with open(tmpFile, 'w') as han:
+      json.dump(self.summary(), han, indent=1, default=float)
+    os.rename(tmpFile, fileName)
+    self.written = True
+    if hasattr(atexit, 'unregister'):  # Python 3; workers run many runs.
+      atexit.unregister(self.write)
+    return fileName
+
+
+@contextmanager
+def stage(name, **counts):
+  '''Time the with block as a stage of the current run (if there is one);
+  yields its (writable) counts.'''
+  if CURRENT[0] is None:
+    yield dict(counts)
+  else:
+    with CURRENT[0].stage(name, **counts) as stageCounts:
+      yield stageCounts
+
+
+def addCount(name, value=1):
+  '''Add value to the count name of the running stage of the current run,
+  if there is one.'''
+  if CURRENT[0] is not None:
+    CURRENT[0].addCount(name, value)
+
+
+# End of file.
+# Nothing to see here.
@@ -11,42 +11,117 @@ structure as a result of this. Sorry.
 A lot has been added and edited since that time, but at least the functions
 with an "aperture" or "naperture" argument should still work with
 multiple apertures, if that's ever of interest.
+
+photcor can be imported: calibrate() takes a list of .trippy files (or a
+results store and an object name) and returns the calibrated light curve
+without plotting anything; matplotlib and astroquery are only imported when
+plotting or querying SDSS/USNO.
+Usage:
+  photcor.py                   calibrates ./a???.trippy, interactively;
+  photcor.py -n 8 dir1 dir2 .. calibrates many object directories in
+                               parallel, without plots or questions;
+  photcor.py -R <resultsstore> -O <object> calibrates from a results store.
 '''
 from __future__ import print_function, division
+import os
 import re
+import sys
 import glob
+import json
+import getopt
+from functools import partial
+from multiprocessing import Pool
+from six.moves import input
 import numpy as np
-import matplotlib.pyplot as plt
-from astropy import coordinates as coords
-from astropy.table.table import Table as AstroTable
-from astropy.wcs import WCS
-from astropy.io import fits
-from astroquery.sdss import SDSS
-from astroquery.vizier import Vizier
-#import uncertainties as u
-from uncertainties import unumpy as unp
+from photdiagnostics import (scatterStatistics, drawScatter, drawLightcurve,
+                             renderScatter, renderLightcurve, queueRender)
+from background import BackgroundWorker
+from zpsolver import solveZeroPoints
+from phottransforms import toPS1
+from metrics import RunMetrics, stage
 __author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
               'mike.alexandersen@alumni.ubc.ca)')
 
+MAGLINE = re.compile(
+    r'....\......... ....\......... ..\...........  .\...........')
+MJDLINE = re.compile('MJD = ')
+
+
+def readtrippysidecar(filename):
+  '''Read the json sidecar that maphot writes next to a .trippy file.
+     Returns None if there is no sidecar (files from older maphot).'''
+  try:
+    with open(filename + '.json') as sidecarFile:
+      return json.load(sidecarFile)
+  except IOError:
+    return None
+
+
 def readtrippyfile(filename):
   '''Use this function to read in trippy files.
-     Returns a bunch of stuff.'''
-  file = open(filename, 'r')
-  maglines = [line for line in file if re.match(re.compile(
-              r'....\......... ....\......... ..\...........  .\...........'
-              ), line)]
-  file.close()
-  file = open(filename, 'r')
-  MJDline = [line for line in file if re.match(re.compile('MJD = '), line)]
+     Returns a bunch of stuff.
+     Reads the json sidecar if there is one, otherwise parses the log.
+     The TNO magnitude from a sidecar is the uncalibrated (but aperture
+     corrected) one, like the star magnitudes, so that the zero points of
+     photcor are applied to it only once.'''
+  sidecar = readtrippysidecar(filename)
+  if sidecar is not None:
+    stars, tno = sidecar['stars'], sidecar['tno']
+    return (tno['x'], tno['y'], tno['magRaw'], tno['dmagRaw'],
+            np.array(stars['x']), np.array(stars['y']),
+            np.array(stars['mag']), np.array(stars['dmag']), sidecar['MJDm'])
+  maglines, MJDline = [], []
+  with open(filename, 'r') as file:
+    for line in file:
+      if MAGLINE.match(line):
+        maglines.append(line)
+      elif MJDLINE.match(line):
+        MJDline.append(line)
   xcoord, ycoord, magni, dmagni = np.genfromtxt(maglines,
                                                 usecols=(0, 1, 2, 3),
                                                 unpack=True)
   mjdate = np.genfromtxt(MJDline, usecols=(2), unpack=True)
-  file.close()
   return (xcoord[-1], ycoord[-1], magni[-1], dmagni[-1],
           xcoord[0:-1], ycoord[0:-1], magni[0:-1], dmagni[0:-1], mjdate)
 
 
+def readcube(cubedir, filenames, dzero):
+  '''Read the star photometry of filenames from the frames x stars cube in
+     cubedir, (re)building the cube from the json sidecars if it is missing,
+     older than any of them or lacks any of their frames. Stars are matched
+     by PS1 objName, so there is no positional matching. Returns xccd, yccd,
+     mag, magerr like trimcatalog_unwrap (stars x frames, only stars
+     measured in all frames), with dzero added to mag, or None if any file
+     lacks a sidecar.'''
+  import photcube
+  sidecarfiles = [filename + '.json' for filename in filenames]
+  if not all(os.path.isfile(sidecar) for sidecar in sidecarfiles):
+    return None
+  starsfile = os.path.join(cubedir, 'stars.npy')
+  if ((not os.path.isfile(starsfile)) or
+      (os.path.getmtime(starsfile) <
+       max(os.path.getmtime(sidecar) for sidecar in sidecarfiles))):
+    photcube.buildCube(cubedir, photcube.starsFromSidecars(filenames))
+  sidecars = [readtrippysidecar(filename) for filename in filenames]
+  images = [sidecar['image'] for sidecar in sidecars]
+  extnos = [sidecar['extno'] for sidecar in sidecars]
+  cube = photcube.loadCube(cubedir)
+  try:
+    frames = photcube.frameOrder(cube, images, extnos)
+  except KeyError:  # The cube was built from another set of files.
+    del cube  # Release the memory maps before overwriting their files.
+    photcube.buildCube(cubedir, photcube.starsFromSidecars(filenames))
+    cube = photcube.loadCube(cubedir)
+    frames = photcube.frameOrder(cube, images, extnos)
+  complete = np.all(np.isfinite(cube['mag'][frames]), axis=0)
+  magtrim = cube['mag'][frames][:, complete].T + dzero
+  dmagtrim = cube['dmag'][frames][:, complete].T
+  xtrim = cube['stars']['x'][complete]
+  ytrim = cube['stars']['y'][complete]
+  idx = np.argsort(np.mean(magtrim, 1))
+  return xtrim[idx], ytrim[idx], magtrim[idx], dmagtrim[idx]
+
+
 def readmagfile(filename, nobject, naperture):
   '''I don't remember what this does...
      It's not currently used.'''
@@ -76,6 +151,7 @@ def plotapcor(allobjects, useobject, aperture, magnitude,
               magerror, meanmag, meanerror):
   '''Plot the apperture correction.
      Not currently used.'''
+  import matplotlib.pyplot as plt
   fig1, ax1 = plt.subplots()
   fig2, ax2 = plt.subplots()
   fig1 = fig1  # This is just here to make pylint shut up!
@@ -91,18 +167,16 @@ def plotapcor(allobjects, useobject, aperture, magnitude,
 
 def printscatter(useobject, x, y, relmagnitude):
   '''Print the scatter of each star across exposures'''
-  maxi, maxstd, numsource = 0, 0, 0
   useindex = np.arange(len(useobject))[useobject]
-  for ii in useindex:
-    numsource += 1
-    print(" {0:3d} | {1:4.0f} {2:4.0f} |".format(ii, x[ii], y[ii]), end='')
-    for jj in np.arange(len(relmagnitude[0, 0, :])):
-      stdrelmag = np.std(relmagnitude[:, ii, jj])
-      print("{0:3.0f}".format(stdrelmag * 1000), end='')
-    if stdrelmag > maxstd:
-      maxstd = stdrelmag
-      maxi = ii
-    print(" ")
+  numsource = len(useindex)
+  stdrelmag = scatterStatistics(relmagnitude, useobject)['starstd'][useindex]
+  print(''.join(" {0:3d} | {1:4.0f} {2:4.0f} |".format(ii, x[ii], y[ii])
+                + ''.join("{0:3.0f}".format(std * 1000) for std in stds)
+                + " \n" for ii, stds in zip(useindex, stdrelmag)), end='')
+  maxi, maxstd = 0, 0
+  if numsource:
+    maxi = useindex[np.argmax(stdrelmag[:, -1])]
+    maxstd = np.max(stdrelmag[:, -1])
   print("----------------------")
   print(" {0:3d} | {1:4.0f} {2:4.0f} |".format(maxi, x[maxi], y[maxi]) +
         " {0:3.0f} <- Max scatter".format(maxstd * 1000) +
@@ -112,35 +186,18 @@ def printscatter(useobject, x, y, relmagnitude):
 
 def plotscatter(aperture, alltimes, relmagnitude, useobject,
                 magerror, x, y, verbosity=True):
-  '''Plot the scatter'''
-  scattererr = np.zeros([len(alltimes), len(aperture)])
+  '''Plot the scatter (see photdiagnostics.drawScatter), one figure per
+     aperture. Returns the scatter of the stars in use in each frame.'''
+  import matplotlib.pyplot as plt
   for jj in np.arange(len(aperture)):
-    ax3 = plt.subplot2grid((2, 3), (1, 0), colspan=2)
-    ax4 = plt.subplot2grid((2, 3), (0, 0), colspan=2)
-    ax5 = plt.subplot2grid((2, 3), (0, 2), rowspan=2)
-    useindex = np.arange(len(useobject))[useobject]
-    [ax3.plot(alltimes, relmagnitude[:, ii, jj], lw=useobject[ii]
-              ) for ii in useindex]
-    ax3.set_xlabel(aperture[jj])
-    scattermag = np.array([relmagnitude[:, ii, jj] -
-                           np.mean(relmagnitude[:, ii, jj])
-                           for ii in np.arange(len(useobject))]).T
-    [ax4.errorbar(alltimes, scattermag[:, ii], magerror[:, ii, jj],
-                  lw=useobject[ii], zorder=2) for ii in useindex]
-    scattererr[:, jj] = [np.nanstd(scattermag[tt, useindex])
-                         for tt in np.arange(len(alltimes))]
-    ax4.errorbar(alltimes, np.zeros(len(alltimes)), scattererr[:, jj], lw=0,
-                 capsize=20, elinewidth=0, color='k', zorder=1)
-    ax4.set_xlabel(aperture[jj])
-    [ax5.plot(x[ii], y[ii], 'o', ms=np.std(scattermag[:, ii]) * 300, alpha=0.3
-              ) for ii in useindex]
-    ax5.axis([0, 2048, 0, 4176])
+    stats = drawScatter(plt.figure(figsize=(15, 8)), alltimes, relmagnitude,
+                        useobject, magerror, x, y, aperture=jj)
+    plt.gcf().axes[0].set_xlabel(aperture[jj])
     if verbosity:
-      print("Mean |           | {0:3.0f}"
-            .format(np.mean(scattererr[:]) * 1000))
-      print("Max  |           | {0:3.0f}".format(np.max(scattererr[:]) * 1000))
+      print("Mean |           | {0:3.0f}".format(stats['mean'] * 1000))
+      print("Max  |           | {0:3.0f}".format(stats['max'] * 1000))
     plt.show()
-  return scattererr
+  return scatterStatistics(relmagnitude, useobject)['epochstd']
 
 
 def trimcatalog(xstar, ystar, magstar, dmagstar):
@@ -180,13 +237,17 @@ def trimcatalog_unwrap(xstar, ystar, magstar, dmagstar):
   return xtrim[idx], ytrim[idx], magtrim[idx], dmagtrim[idx]
 
 
-def sdss_check(x, y):
+def sdss_check(x, y, wcsfile='a100.fits'):
   """
   Check whether stars are in the SDSS catalogue.
   This function accepts either a single x and y coordinate,
-  or an array of each.
+  or an array of each, on the image wcsfile.
   """
-  w = WCS('a100.fits')
+  from astropy import coordinates as coords
+  from astropy.table.table import Table as AstroTable
+  from astropy.wcs import WCS
+  from astroquery.sdss import SDSS
+  w = WCS(wcsfile)
   sfilt = []
   # Check which format x and y are given in.
   if not (isinstance(x, (np.ndarray, list, float, int)) &
@@ -222,13 +283,17 @@ def sdss_check(x, y):
   return sfilt
 
 
-def usno_check(x, y):
+def usno_check(x, y, wcsfile='a100.fits'):
   """
   Check whether stars are in the USNO catalogue.
   This function accepts either a single x and y coordinate,
-  or an array of each.
+  or an array of each, on the image wcsfile.
   """
-  w = WCS('a100.fits')
+  from astropy import coordinates as coords
+  from astropy.table.table import Table as AstroTable
+  from astropy.wcs import WCS
+  from astroquery.vizier import Vizier
+  w = WCS(wcsfile)
   sfilt = []
   # Check which format x and y are given in.
   if not (isinstance(x, (np.ndarray, list, float, int)) &
@@ -300,51 +365,49 @@ def print_tno_file(objname, odometer, julian, corrected,
   calfile.close()
 
 
+def meanwitherror(values, errors, axis=-1):
+  '''The mean of values along axis and its error, sqrt(sum(errors**2))/N,
+     as the uncertainties package would propagate it (for independent
+     errors), but for whole arrays at once.'''
+  values, errors = np.asarray(values), np.asarray(errors)
+  return (np.mean(values, axis=axis),
+          np.sqrt(np.sum(errors ** 2, axis=axis)) / np.shape(values)[axis])
+
+
 def print_stars_file(calstarfile, useobjects,
                      xcoord, ycoord, r_magnitude, r_magerr,
                      c_magnitude, c_magerr,
                      sdss_magnitude=None, sdss_magerror=None):
   '''
   Print the file with the calibration stars used.
+  The magnitudes are (stars x frames) arrays; each star gets its mean over
+  the frames, with the propagated error (see meanwitherror).
   '''
-  calfile = open(calstarfile, 'w')
-  if (np.sum(sdss_magnitude) is not None) & \
-     (np.sum(sdss_magerror is not None)):
-    print("#xcoo            ycoo             mag              dmag        " +
-          "     calibrated_mag   calibrated_dmag  sdss_mag         sdss_dmag")
-    calfile.write("#xcoo            ycoo             ccd_mag          " +
-                  "ccd_dmag         calibrated_mag   calibrated_dmag  " +
-                  "sdss_mag         sdss_dmag\n")
-  else:
-    print("#xcoo            ycoo             mag              dmag        " +
-          "     calibrated_mag   calibrated_dmag")
-    calfile.write("#xcoo            ycoo             ccd_mag          " +
-                  "ccd_dmag         calibrated_mag   calibrated_dmag\n")
-  for j in useobjects:
-    r_u = np.mean(unp.uarray(r_magnitude[j], r_magerr[j])).s
-    r_m = np.mean(unp.uarray(r_magnitude[j], r_magerr[j])).n
-    c_u = np.mean(unp.uarray(c_magnitude[j], c_magerr[j])).s
-    c_m = np.mean(unp.uarray(c_magnitude[j], c_magerr[j])).n
-    if (np.sum(sdss_magnitude) is not None) & \
-       (np.sum(sdss_magerror is not None)):
-      print("{0:16.11f} {1:16.11f} ".format(xcoord[j], ycoord[j]) +
-            "{0:16.13f} {1:16.13f} ".format(r_m, r_u) +
-            "{0:16.13f} {1:16.13f} ".format(c_m, c_u) +
-            "{0:16.13f} {1:16.13f}".format(sdss_magnitude[j],
-                                           sdss_magerror[j]))
-      calfile.write("{0:16.11f} {1:16.11f} {2:16.13f} {3:16.13f} "
-                    .format(xcoord[j], ycoord[j], r_m, r_u) +
-                    "{0:16.13f} {1:16.13f} ".format(c_m, c_u) +
-                    "{0:16.13f} {1:16.13f}\n".format(sdss_magnitude[j],
-                                                     sdss_magerror[j]))
-    else:
-      print("{0:16.11f} {1:16.11f} ".format(xcoord[j], ycoord[j]) +
-            "{0:16.13f} {1:16.13f} ".format(r_m, r_u) +
-            "{0:16.13f} {1:16.13f} ".format(c_m, c_u))
-      calfile.write("{0:16.11f} {1:16.11f} {2:16.13f} {3:16.13f} "
-                    .format(xcoord[j], ycoord[j], r_m, r_u) +
-                    "{0:16.13f} {1:16.13f}\n".format(c_m, c_u))
-  calfile.close()
+  usesdss = (sdss_magnitude is not None) and (sdss_magerror is not None)
+  useobjects = np.asarray(useobjects, dtype=int)
+  r_m, r_u = meanwitherror(np.asarray(r_magnitude)[useobjects],
+                           np.asarray(r_magerr)[useobjects])
+  c_m, c_u = meanwitherror(np.asarray(c_magnitude)[useobjects],
+                           np.asarray(c_magerr)[useobjects])
+  columns = [np.asarray(xcoord)[useobjects], np.asarray(ycoord)[useobjects],
+             r_m, r_u, c_m, c_u]
+  rowformat = ("{0:16.11f} {1:16.11f} {2:16.13f} {3:16.13f} "
+               + "{4:16.13f} {5:16.13f}")
+  screenheader = ("#xcoo            ycoo             mag              dmag"
+                  + "             calibrated_mag   calibrated_dmag")
+  fileheader = ("#xcoo            ycoo             ccd_mag          "
+                + "ccd_dmag         calibrated_mag   calibrated_dmag")
+  if usesdss:
+    columns += [np.asarray(sdss_magnitude)[useobjects],
+                np.asarray(sdss_magerror)[useobjects]]
+    rowformat += " {6:16.13f} {7:16.13f}"
+    screenheader += "  sdss_mag         sdss_dmag"
+    fileheader += "  sdss_mag         sdss_dmag"
+  rows = [rowformat.format(*row) for row in np.array(columns).T]
+  print(screenheader)
+  print(''.join(row + '\n' for row in rows), end='')
+  with open(calstarfile, 'w') as calfile:
+    calfile.write(fileheader + '\n' + ''.join(row + '\n' for row in rows))
 
 
 def calculate_corrected_TNO_mags(reduced_star_mags, ccd_average,
@@ -371,47 +434,95 @@ def calculate_corrected_TNO_mags(reduced_star_mags, ccd_average,
   return tno_corrected, tnoerr_corrected, tno_corrected_err
 
 
+def robustStarSelection(magnitude, useobject, maxstd=0.025, minstars=25,
+                        nsigma=3., batchfraction=0.05, maxiter=100):
+  '''
+  Iteratively reject variable stars, many at a time.
+  The scatter of each star is the standard deviation over the frames of its
+  magnitude minus the mean magnitude (per frame) of the stars in use, which
+  is kept as running sums, updated only for the rejected stars.
+  Each iteration rejects all stars scattering more than maxstd that are also
+  nsigma outliers (median + nsigma * 1.4826 * MAD of the scatters) or, if
+  there are none, the batchfraction of the stars in use with the largest
+  scatter above maxstd. Stops when no star scatters more than maxstd or
+  only minstars stars are left (like the old one-star-at-a-time autokill).
+  Returns the new useobject and the number of iterations.
+  '''
+  useobject = np.array(useobject, dtype=bool)
+  magnitude = np.asarray(magnitude, dtype=np.float64)
+  magsum = np.sum(magnitude[useobject], axis=0)
+  nuse = np.sum(useobject)
+  iteration = -1  # Without any iterations (maxiter=0), nothing is rejected.
+  for iteration in np.arange(maxiter):
+    useindex = np.arange(len(useobject))[useobject]
+    scatter = np.std(magnitude[useindex] - magsum / nuse, axis=1)
+    candidates = scatter > maxstd
+    if (not np.any(candidates)) or (nuse <= minstars):
+      break
+    median = np.median(scatter)
+    clip = median + nsigma * 1.4826 * np.median(np.abs(scatter - median))
+    kill = candidates & (scatter > clip)
+    if not np.any(kill):
+      nkill = min(np.sum(candidates),
+                  max(1, int(batchfraction * nuse)))
+      kill = np.zeros(len(scatter), dtype=bool)
+      kill[np.argsort(scatter)[::-1][:nkill]] = True
+    # Never go below minstars, rejecting the worst stars first.
+    worstfirst = np.argsort(np.where(kill, -scatter, np.inf))
+    kill[worstfirst[nuse - minstars:]] = False
+    useobject[useindex[kill]] = False
+    magsum -= np.sum(magnitude[useindex[kill]], axis=0)
+    nuse -= np.sum(kill)
+  return useobject, iteration
+
+
 def StarInspector(useobject, xstar, ystar, julian, magnitude, magerror,
-                  autokill=False):
+                  autokill=False, interactive=True, plotfile=None,
+                  worker=None):
   '''
   Allow user to weed out any variable stars.
-  autokill=True automatically kills the most variable star iteratively until
-  there are less than 25 stars or the maximum stddev is <=0.025 mag.
+  autokill=True first automatically rejects variable stars (see
+  robustStarSelection) until there are 25 stars left or the maximum stddev
+  is <=0.025 mag.
+  interactive=False skips the plots and questions.
+  With a plotfile, the final scatter plot is saved there as a PNG,
+  rendered on worker (a BackgroundWorker) if one is given.
   '''
-  yn = 'Yes'
-  while not ('n' in yn) | ('N' in yn):
+  useobject = np.array(useobject, dtype=bool)
+  if autokill:
+    useobject, niter = robustStarSelection(magnitude, useobject)
+    print("Automatic selection kept {} stars ".format(np.sum(useobject))
+          + "after {} iterations.".format(niter + 1))
+  while interactive:
     average = np.mean(magnitude[useobject], 0)
     reduced_mag = (magnitude - average).T
     print("Star |  x    y   | Standard deviation (milli-mags)")
-    imax, stdmax, nsource = printscatter(useobject, xstar, ystar,
-                                         np.array([reduced_mag.T]).T)
-    if not ('n' in yn) | ('N' in yn):
-      if autokill & (nsource > 25) & (stdmax > 0.025):
-        killobj = imax
+    printscatter(useobject, xstar, ystar, np.array([reduced_mag.T]).T)
+    plotscatter([1], julian, np.array([reduced_mag.T]).T, useobject,
+                np.array([magerror]).T, xstar, ystar)
+    killobj = input("Which star would you like to kill? " +
+                    "(# above,  n for none) ")
+    try:
+      useobject[int(killobj)] = False
+    except (ValueError, IndexError):
+      if ('n' in killobj) | ('N' in killobj):
+        break
       else:
-        scattererr = plotscatter([1], mjd, np.array([reduced_mag.T]).T,
-                                 useobject, np.array([magerror]).T,
-                                 xstar, ystar)
-        killobj = raw_input("Which star would you like to kill? " +
-                            "(# above,  n for none) ")
-      try:
-        kobj = int(killobj)
-        useobject[kobj] = False
-        magnitude[kobj, :] = np.nan
-        magerror[kobj, :] = np.nan
-        continue
-      except ValueError:
-        if ('n' in killobj) | ('N' in killobj):
-          break
-        else:
-          print("That's not a valid number!")
-          continue
-  average = np.mean(magnitude[useobj], 0)
+        print("That's not a valid number!")
+  average = np.mean(magnitude[useobject], 0)
   reduced_mag = (magnitude - average).T
   print("Star |  x    y   | Standard deviation (milli-mags)")
   printscatter(useobject, xstar, ystar, np.array([reduced_mag.T]).T)
-  scattererr = plotscatter([1], julian, np.array([reduced_mag.T]).T, useobject,
-                           np.array([magerr]).T, xccd, yccd)
+  if interactive:
+    scattererr = plotscatter([1], julian, np.array([reduced_mag.T]).T,
+                             useobject, np.array([magerror]).T, xstar, ystar)
+  else:
+    scattererr = scatterStatistics(np.array([reduced_mag.T]).T,
+                                   useobject)['epochstd']
+  if plotfile is not None:
+    queueRender(worker, renderScatter, plotfile, julian,
+                np.array([reduced_mag.T]).T, useobject,
+                np.array([magerror]).T, xstar, ystar)
   return useobject, scattererr, average, reduced_mag
 
 
@@ -419,6 +530,7 @@ def readzeropoint(filename):
   '''
   Reads the zeropoint of a file.
   '''
+  from astropy.io import fits
   hdulist = fits.open(filename)
   magzero = hdulist[0].header['MAGZERO']
   magzeroerr = hdulist[0].header['MAGZERO_RMS']
@@ -426,123 +538,347 @@ def readzeropoint(filename):
   return magzero, magzeroerr
 
 
-###############################################################################
-## Functions above here. ######################################################
-###############################################################################
-## Main below here. ###########################################################
-###############################################################################
-
-verbose = True
-files = glob.glob("./a???.trippy")
-files.sort()
-ntimes = len(files)
-xcoo = list(np.zeros(ntimes))
-ycoo, mag, magerr, rmag = xcoo[:], xcoo[:], xcoo[:], xcoo[:]
-magin, magerrin = xcoo[:], xcoo[:]
-avmag = np.zeros(ntimes)
-mjd = avmag.copy()
-zeros = avmag.copy()
-zeroserr = avmag.copy()
-xobj, yobj, magobj, magerrobj, rmagobj = np.zeros([5, ntimes])
-avmagobj, avmagerrobj = np.zeros([2, ntimes])
-zeros_default = 26.0
-usesdss = False
-
-for t, infile in enumerate(files):
-  print(infile)
-  (xobj[t], yobj[t], magobj[t], magerrobj[t], xcoo[t], ycoo[t],
-   magin[t], magerrin[t], mjd[t]) = readtrippyfile(infile)
-  zeros[t], zeroserr[t] = readzeropoint(infile[:-7] + '.fits')
-
-if zeros_default == 'None':
-  zeros_default = zeros
-
-'''
-Fix the zeropoint (don't use the default 26.0) # needed because I was stupid
-'''
-dzero = zeros - zeros_default  # So real mag = measured + dzero
-magobj += dzero
-magin = (np.array(magin).T + dzero).T
-zeroserr[np.argwhere(zeroserr < 0.01)] = 0.01
-
-'''
-Don't use any stars that don't have magnitudes in all frames.
-'''
-xccd, yccd, mag, magerr = trimcatalog_unwrap(xcoo, ycoo, magin, magerrin)
-useobj = mag[:, 0] < 30
-nobj = np.shape(mag)[0]
-objects = np.arange(nobj)
-
-'''
-Check whether the stars are in the SDSS catalogue.
-If enough are, stop using those that are not.
-'''
-if usesdss:
-  sdss = sdss_check(xccd, yccd)
-  sdss_mag = np.array(sdss['psfMag_r'])
-  sdss_magerr = np.array(sdss['psfMagErr_r'])
-  insdss = sdss['nDetect'] > 0
-  nsdss = len(np.where(insdss)[0])
-  if nsdss >= 10:
-    usesdss = False
-    useobj[np.invert(insdss)] = False
+def readtrippyfiles(files, cubedir='photcube', zeros_default=26.0):
+  '''Read the TNO and star photometry of a sequence of .trippy files.
+     Returns a dictionary with the per-frame arrays odometer, mjd, xobj,
+     yobj, magobj, magerrobj, zeros, zeroserr and dzero, and the star arrays
+     xccd, yccd, mag and magerr (stars x frames, only stars that were
+     measured in all frames), all corrected to the image zero points, and
+     refmag and refcolour (NaN, as .trippy files have no catalogue
+     magnitudes). filter is the filter of each frame, or None for .trippy
+     files without a sidecar.'''
+  ntimes = len(files)
+  xcoo = list(np.zeros(ntimes))
+  ycoo, magin, magerrin = xcoo[:], xcoo[:], xcoo[:]
+  mjd, zeros, zeroserr = np.zeros([3, ntimes])
+  xobj, yobj, magobj, magerrobj = np.zeros([4, ntimes])
+  filters = [None] * ntimes
+  for t, infile in enumerate(files):
+    print(infile)
+    (xobj[t], yobj[t], magobj[t], magerrobj[t], xcoo[t], ycoo[t],
+     magin[t], magerrin[t], mjd[t]) = readtrippyfile(infile)
+    sidecar = readtrippysidecar(infile)
+    if sidecar is None:
+      zeros[t], zeroserr[t] = readzeropoint(infile[:-7] + '.fits')
+    else:
+      zeros[t], zeroserr[t] = sidecar['MAGZERO'], sidecar['MAGZERO_RMS']
+      filters[t] = sidecar['filter']
+  '''
+  Fix the zeropoint (don't use the default 26.0) # needed because I was stupid
+  '''
+  dzero = zeros - zeros_default  # So real mag = measured + dzero
+  magobj += dzero
+  magin = (np.array(magin).T + dzero).T
+  '''
+  Don't use any stars that don't have magnitudes in all frames.
+  Use the photometry cube if maphot wrote sidecars for all files,
+  otherwise match the stars by position.
+  '''
+  cubestars = readcube(cubedir, files, dzero)
+  if cubestars is None:
+    xccd, yccd, mag, magerr = trimcatalog_unwrap(xcoo, ycoo, magin, magerrin)
   else:
-    usesdss = True
-print("Using SDSS stars: " + str(usesdss))
-print("Using {0:3.0f} of {1:3.0f} stars.".format(len(useobj[useobj]),
-                                                 len(useobj)))
-
-'''
-Inspect the stars and get rid of any variable ones.
-'''
-useobj, scaterr, avmag, rmag = StarInspector(useobj, xccd, yccd, mjd,
-                                             mag, magerr, True)
+    xccd, yccd, mag, magerr = cubestars
+  return {'odometer': list(files), 'mjd': mjd, 'xobj': xobj, 'yobj': yobj,
+          'magobj': magobj, 'magerrobj': magerrobj, 'zeros': zeros,
+          'zeroserr': zeroserr, 'dzero': dzero, 'filter': filters,
+          'xccd': xccd, 'yccd': yccd, 'mag': mag, 'magerr': magerr,
+          'refmag': np.full(len(xccd), np.nan),
+          'refcolour': np.full(len(xccd), np.nan)}
+
+
+def readresultsstore(storedir, objectname, zeros_default=26.0):
+  '''Read the TNO and star photometry of one object from a results store
+     (see resultsstore.py), as a dictionary like readtrippyfiles returns.
+     If an image was measured more than once, the last measurement is used.
+     The TNO magnitude is the aperture-corrected but uncalibrated one
+     (magInst - magCalibration), which is what the .trippy.json sidecars
+     hold as magRaw, and dzero is added to it and to the star magnitudes
+     just as readtrippyfiles does, so that both give the same light curve.
+     The store has no zero-point uncertainties, so zeroserr is set to the
+     0.01 mag floor that calibrate uses anyway.'''
+  import photcube
+  from resultsstore import readTable
+  tno = np.array(readTable(storedir, 'tno'))
+  tno = tno[tno['object'] == np.bytes_(objectname)]
+  keys = np.char.add(tno['image'], tno['extno'].astype('S6'))
+  _, last = np.unique(keys[::-1], return_index=True)
+  tno = tno[len(tno) - 1 - last]
+  tno = tno[np.argsort(tno['mjdMid'])]
+  stars = photcube.starsFromStore(storedir)
+  inframes = np.isin(np.char.add(stars['image'],
+                                 stars['extno'].astype('S6')), keys)
+  cube = photcube.assembleCube(dict((name, values[inframes]) for
+                                    name, values in stars.items()))
+  frames = photcube.frameOrder(cube, tno['image'], tno['extno'])
+  complete = np.all(np.isfinite(cube['mag'][frames]), axis=0)
+  dzero = tno['zptRaw'] - zeros_default  # So real mag = measured + dzero
+  mag = cube['mag'][frames][:, complete].T + dzero
+  idx = np.argsort(np.mean(mag, 1))
+  return {'odometer': [image.decode() for image in tno['image']],
+          'mjd': tno['mjdMid'], 'xobj': tno['x'], 'yobj': tno['y'],
+          'magobj': tno['magInst'] - tno['magCalibration'] + dzero,
+          'magerrobj': tno['dmagRaw'], 'zeros': tno['zptRaw'],
+          'zeroserr': np.full(len(tno), 0.01), 'dzero': dzero,
+          'filter': [band.decode() for band in tno['filter']],
+          'xccd': cube['stars']['x'][complete][idx],
+          'yccd': cube['stars']['y'][complete][idx],
+          'mag': mag[idx],
+          'magerr': cube['dmag'][frames][:, complete].T[idx],
+          'refmag': cube['stars']['refMag'][complete][idx],
+          'refcolour': cube['stars']['refColour'][complete][idx]}
+
+
+def framesToPS1(magobj, magerrobj, filters):
+  '''Transform the calibrated TNO magnitudes (in the system of the
+     telescope) of each frame to PS1, in the filter of that frame (see
+     phottransforms). Frames whose filter is None are left as they are.'''
+  magobj, magerrobj = np.array(magobj), np.array(magerrobj)
+  for t, band in enumerate(filters):
+    if band is not None:
+      magobj[t], magerrobj[t] = toPS1(magobj[t], magerrobj[t], 'CFHT', band)
+  return magobj, magerrobj
+
+
+def calibrate(files=None, storedir=None, objectname=None,
+              cubedir='photcube', autokill=True, interactive=False,
+              usesdss=False, wcsfile='a100.fits', zeros_default=26.0,
+              plotdir=None, worker=None, anchor=False):
+  '''Calibrate the TNO photometry of a sequence relative to the stars that
+     are visible in all frames.
+     The zero points of all frames are solved for together with the star
+     magnitudes (see zpsolver); with anchor=True the star magnitudes are
+     tied to the catalogue (PS1) magnitudes, if there are any, so the zero
+     points become absolute rather than relative.
+     Takes a list of .trippy files, or a results store and an object name.
+     With interactive=False (the default) nothing is plotted or asked.
+     Returns a dictionary with the measurements (see readtrippyfiles) and
+     the calibrated light curve (magobj_done, magerrobj_done, transformed
+     to PS1 in frames whose filter is known,
+     systematic_err, zeros_corrected), the stars used (useobj) and their
+     calibrated magnitudes (mag_done, magerr_done).
+     With a plotdir, the star scatter and the light curve are saved there as
+     photcor_scatter.png and photcor_lightcurve.png, rendered on worker (a
+     BackgroundWorker) if one is given, so plotting doesn't hold this up.'''
+  with stage('readPhotometry') as counts:
+    if files is not None:
+      result = readtrippyfiles(files, cubedir, zeros_default)
+    else:
+      result = readresultsstore(storedir, objectname, zeros_default)
+    counts['frames'], counts['stars'] = len(result['mjd']), len(result['mag'])
+  result['zeroserr'][np.argwhere(result['zeroserr'] < 0.01)] = 0.01
+  xccd, yccd, mag, magerr = (result['xccd'], result['yccd'], result['mag'],
+                             result['magerr'])
+  useobj = mag[:, 0] < 30
+  result['objects'] = np.arange(np.shape(mag)[0])
+  result['sdss_mag'], result['sdss_magerr'] = None, None
+  '''
+  Check whether the stars are in the SDSS catalogue.
+  If enough are, stop using those that are not.
+  '''
+  if usesdss:
+    sdss = sdss_check(xccd, yccd, wcsfile)
+    result['sdss_mag'] = np.array(sdss['psfMag_r'])
+    result['sdss_magerr'] = np.array(sdss['psfMagErr_r'])
+    insdss = sdss['nDetect'] > 0
+    nsdss = len(np.where(insdss)[0])
+    if nsdss >= 10:
+      usesdss = False
+      useobj[np.invert(insdss)] = False
+    else:
+      usesdss = True
+  result['usesdss'] = usesdss
+  print("Using SDSS stars: " + str(usesdss))
+  print("Using {0:3.0f} of {1:3.0f} stars.".format(len(useobj[useobj]),
+                                                   len(useobj)))
+  '''
+  Inspect the stars and get rid of any variable ones.
+  '''
+  plotfile = (None if plotdir is None
+              else os.path.join(plotdir, 'photcor_scatter.png'))
+  with stage('starSelection') as counts:
+    useobj, scaterr, avmag, _ = StarInspector(useobj, xccd, yccd,
+                                              result['mjd'], mag, magerr,
+                                              autokill, interactive, plotfile,
+                                              worker)
+    counts['usedStars'] = int(np.sum(useobj))
+  '''
+  Solve for the zero-point corrections of all frames at once.
+  '''
+  anchored = anchor and np.any(np.isfinite(result['refmag'][useobj]))
+  if anchor and not anchored:
+    print("No catalogue magnitudes to anchor to, so relative zero points.")
+  with stage('zeroPoints') as counts:
+    zpsolution = solveZeroPoints(mag.T, magerr.T, useobj,
+                                 refMag=(result['refmag'] if anchored
+                                         else None),
+                                 refColour=result['refcolour'])
+    counts['iterations'] = int(zpsolution['niter'])
+  ddzero = -zpsolution['offset']
+  print("Zero-point calibration from " +
+        ("PS1-anchored" if anchored else "relative") + " photometry:")
+  print(ddzero)
+  # Systematic error is technically not from averaging the zero points,
+  # but this should be pretty close.
+  systematic_err = meanwitherror(result['zeros'], result['zeroserr'])[1]
+  magobjdone, magerrobjdone = framesToPS1(
+      result['magobj'] + ddzero,
+      (result['magerrobj'] ** 2 + scaterr[:, 0] ** 2) ** 0.5,
+      result['filter'])
+  result.update({
+      'useobj': useobj, 'scaterr': scaterr, 'avmag': avmag,
+      'ddzero': ddzero, 'ddzeroerr': zpsolution['offsetErr'],
+      'zpsolution': zpsolution, 'systematic_err': systematic_err,
+      'zeros_corrected': zeros_default + result['dzero'] + ddzero,
+      'magobj_done': magobjdone, 'magerrobj_done': magerrobjdone,
+      'mag_done': mag + ddzero,
+      'magerr_done': ((magerr ** 2 + scaterr[:, 0] ** 2) ** 0.5
+                      + systematic_err)})
+  if plotdir is not None:
+    queueRender(worker, renderLightcurve,
+                os.path.join(plotdir, 'photcor_lightcurve.png'),
+                *lightcurvearrays(result))
+  return result
+
+
+def lightcurvearrays(result):
+  '''The arrays of a calibrate result that drawLightcurve takes.'''
+  return (result['mjd'], result['magobj'], result['magerrobj'],
+          result['avmag'], result['scaterr'][:, 0], result['magobj_done'],
+          result['magerrobj_done'])
+
+
+def plotlightcurve(result):
+  '''Plot the raw and calibrated TNO photometry of a calibrate result.'''
+  import matplotlib.pyplot as plt
+  drawLightcurve(plt.figure(figsize=(15, 6)), *lightcurvearrays(result))
+  plt.show()
 
-'''
-Calculate the zero-point correction.
-'''
-ddzero = np.mean(avmag) - avmag
-zeros_corrected = zeros_default + dzero + ddzero
-magobj_corrected = magobj + ddzero
-magerrobj_corrected = (magerrobj ** 2 + scaterr[:, 0] ** 2) ** 0.5
-print("Zero-point calibration from relative photometry:")
-print(ddzero)
 
-'''
-Now read in measured object and correct it.
-'''
-plt.errorbar(mjd, magobj[:], magerrobj[:], fmt='--')
-plt.errorbar(mjd, avmag[:], scaterr[:, 0])
-correltnomag = np.array([(magobj - avmag)[t] for t, time in enumerate(mjd)])
-plt.errorbar(mjd, magobj_corrected, magerrobj_corrected,
-             lw=1, capsize=10, elinewidth=2)
-plt.gca().invert_yaxis()
-
-plt.figure()
-plt.errorbar(mjd, magobj_corrected, magerrobj_corrected, marker='+', lw=0,
-             capsize=10, elinewidth=2, label='TRIPPy')
-plt.gca().invert_yaxis()
-plt.legend(loc='best')
-plt.xlabel('Time (MJD)')
-plt.ylabel(r'$\Delta \mathrm{mag}$ (mag-mean)')
-plt.show()
-
-magobj_done = magobj_corrected.copy()
-magerrobj_done = magerrobj_corrected.copy()
-systematic_err = np.mean(unp.uarray(zeros, zeroserr)).std_dev
-# Systematic error is technically not from averaging the zero points,
-# but this should be pretty close.
-mag_done = mag + ddzero
-magerr_done = (magerr ** 2 + scaterr[:, 0] ** 2) ** 0.5 + systematic_err
-
-print_tno_file('calibratedmags', files, mjd, magobj_done,
-               magerrobj_done, systematic_err, zeros_corrected)
-
-if usesdss:
-  print_stars_file('calibrationstars.txt', objects[useobj],
-                   xccd, yccd, mag, magerr, mag_done, magerr_done,
-                   sdss_mag, sdss_magerr)
-else:
-  print_stars_file('calibrationstars.txt', objects[useobj],
-                   xccd, yccd, mag, magerr, mag_done, magerr_done)
-#
+def writeresults(result, directory='.'):
+  '''Write calibratedmags.txt/.tex and calibrationstars.txt to directory.'''
+  print_tno_file(os.path.join(directory, 'calibratedmags'),
+                 result['odometer'], result['mjd'], result['magobj_done'],
+                 result['magerrobj_done'], result['systematic_err'],
+                 result['zeros_corrected'])
+  useobj = result['useobj']
+  if result['usesdss']:
+    print_stars_file(os.path.join(directory, 'calibrationstars.txt'),
+                     result['objects'][useobj], result['xccd'],
+                     result['yccd'], result['mag'], result['magerr'],
+                     result['mag_done'], result['magerr_done'],
+                     result['sdss_mag'], result['sdss_magerr'])
+  else:
+    print_stars_file(os.path.join(directory, 'calibrationstars.txt'),
+                     result['objects'][useobj], result['xccd'],
+                     result['yccd'], result['mag'], result['magerr'],
+                     result['mag_done'], result['magerr_done'])
+
+
+def calibratedirectory(directory, interactive=False, usesdss=False,
+                       anchor=False):
+  '''Calibrate the a???.trippy files of an object directory and write the
+     results there. Returns the calibrate result.
+     Without interactive, the plots are saved as PNGs in directory instead,
+     rendered in the background while the results are written.'''
+  files = sorted(glob.glob(os.path.join(directory, 'a???.trippy')))
+  worker = None if interactive else BackgroundWorker()
+  try:
+    result = calibrate(files, cubedir=os.path.join(directory, 'photcube'),
+                       interactive=interactive, usesdss=usesdss,
+                       wcsfile=os.path.join(directory, 'a100.fits'),
+                       plotdir=None if interactive else directory,
+                       worker=worker, anchor=anchor)
+    if interactive:
+      plotlightcurve(result)
+    with stage('writeResults'):
+      writeresults(result, directory)
+  finally:
+    if worker is not None:
+      worker.close()
+  return result
+
+
+def calibratebatch(directory, anchor=False):
+  '''calibratedirectory without plots or questions, for a Pool of workers.
+     Returns the directory and the number of frames or the error.
+     Each directory is a run of its own in the metrics (see metrics.py).'''
+  runMetrics = RunMetrics.fromEnvironment('photcor_' + os.path.basename(
+      os.path.abspath(directory)))
+  try:
+    return directory, len(calibratedirectory(directory,
+                                             anchor=anchor)['mjd'])
+  except Exception as error:  # pylint: disable=broad-except
+    return directory, error
+  finally:
+    runMetrics.write()
+
+
+def getArguments(sysargv):
+  '''Get arguments given when this is called from a command line'''
+  useage = ('photcor [-i <interactive> -s <usesdss> -n <nprocesses> '
+            + '-R <resultsstore> -O <object> -a <anchor>] [directory ...]')
+  interactive, usesdss, nprocesses, anchor = None, False, 1, False
+  storedir, objectname = None, None
+  try:
+    options, directories = getopt.getopt(sysargv[1:], "i:s:n:R:O:a:h",
+                                         ["interactive=", "usesdss=",
+                                          "nprocesses=", "resultsstore=",
+                                          "object=", "anchor="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt in ("-i", "--interactive", "-s", "--usesdss", "-a", "--anchor"):
+      if arg not in ('0', 'False', '1', 'True'):
+        print("-i, -s and -a flags must be followed by 0/False/1/True")
+        sys.exit(2)
+      arg = arg in ('1', 'True')
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-i', '--interactive'):
+      interactive = arg
+    elif opt in ('-s', '--usesdss'):
+      usesdss = arg
+    elif opt in ('-n', '--nprocesses'):
+      nprocesses = int(arg)
+    elif opt in ('-R', '--resultsstore'):
+      storedir = arg
+    elif opt in ('-O', '--object'):
+      objectname = arg
+    elif opt in ('-a', '--anchor'):
+      anchor = arg
+  directories = directories or ['.']
+  if interactive is None:  # Interactive only for a single directory.
+    interactive = (len(directories) == 1) and (storedir is None)
+  return (directories, interactive, usesdss, nprocesses, storedir,
+          objectname, anchor)
+
+
+if __name__ == '__main__':
+  (DIRECTORIES, INTERACTIVE, USESDSS, NPROCESSES, STOREDIR, OBJECTNAME,
+   ANCHOR) = getArguments(sys.argv)
+  RUNMETRICS = RunMetrics.fromEnvironment('photcor')
+  if STOREDIR is not None:
+    RESULT = calibrate(storedir=STOREDIR, objectname=OBJECTNAME,
+                       interactive=INTERACTIVE, anchor=ANCHOR)
+    if INTERACTIVE:
+      plotlightcurve(RESULT)
+    writeresults(RESULT)
+  elif (len(DIRECTORIES) == 1) or INTERACTIVE:
+    for DIRECTORY in DIRECTORIES:
+      calibratedirectory(DIRECTORY, INTERACTIVE, USESDSS, ANCHOR)
+  else:
+    POOL = Pool(NPROCESSES)
+    for DIRECTORY, OUTCOME in POOL.imap_unordered(
+        partial(calibratebatch, anchor=ANCHOR), DIRECTORIES):
+      print('{}: {}'.format(DIRECTORY, OUTCOME if isinstance(OUTCOME,
+                                                             Exception)
+                            else '{} frames calibrated'.format(OUTCOME)))
+    POOL.close()
+    POOL.join()
+  RUNMETRICS.write()
+
+
+# End of file.
+# Nothing to see here.
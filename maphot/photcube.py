@@ -0,0 +1,176 @@
+#!/usr/bin/python
+"""
+A dense frames x stars cube of the star photometry of a sequence.
+
+maphot measures the same PS1 stars (from best.cat) in every frame and keys
+them by their PS1 objName, so the frames can be combined without any
+positional matching. buildCube collects the per-frame star photometry, from
+a results store (see resultsstore.py) or from the .trippy.json sidecars, and
+writes one .npy file per quantity, each of shape (nframes, nstars):
+  mag, dmag, flux, snr, bg
+plus frames.npy (image, extno, mjdMid) and stars.npy (objName, x, y, refMag,
+refColour). loadCube memory-maps them, so loading takes no time at all.
+Stars that were not measured in a frame are NaN there.
+Usage:
+  photcube.py -R <resultsstoredir> -o <cubedir>
+  photcube.py -t '<trippyfileglob>' -o <cubedir>
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import json
+import getopt
+import warnings
+import numpy as np
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+CUBE_QUANTITIES = ['mag', 'dmag', 'flux', 'snr', 'bg']
+FRAME_DTYPE = [('image', 'S64'), ('extno', 'i2'), ('mjdMid', 'f8')]
+STAR_DTYPE = [('objName', 'S32'), ('x', 'f8'), ('y', 'f8'),
+              ('refMag', 'f8'), ('refColour', 'f8')]
+
+
+def starsFromStore(storeDir):
+  '''Read the per-star, per-frame photometry from a results store,
+  as a dictionary of equally long (one entry per star per frame) arrays.'''
+  from resultsstore import readTable
+  stars = readTable(storeDir, 'stars')
+  return dict((name, np.array(stars[name])) for name in stars.dtype.names)
+
+
+def starsFromSidecars(trippyFiles):
+  '''Read the per-star, per-frame photometry from .trippy.json sidecars,
+  as a dictionary of equally long (one entry per star per frame) arrays.'''
+  from resultsstore import checkWidth
+  columns = dict((name, []) for name in ['image', 'extno', 'mjdMid',
+                                         'objName', 'x', 'y']
+                 + CUBE_QUANTITIES)
+  for trippyFile in trippyFiles:
+    with open(trippyFile + '.json') as sidecarFile:
+      sidecar = json.load(sidecarFile)
+    nstars = len(sidecar['stars']['objName'])
+    columns['image'] += [sidecar['image']] * nstars
+    columns['extno'] += [-1 if sidecar['extno'] is None
+                         else sidecar['extno']] * nstars
+    columns['mjdMid'] += [sidecar['MJDm']] * nstars
+    for name in ['objName', 'x', 'y'] + CUBE_QUANTITIES:
+      columns[name] += sidecar['stars'][name]
+  columns = dict((name, np.array(values)) for name, values in columns.items())
+  for name, dtype in [FRAME_DTYPE[0], STAR_DTYPE[0]]:
+    checkWidth(name, columns[name], dtype)
+    columns[name] = columns[name].astype(dtype)
+  return columns
+
+
+def assembleCube(starColumns):
+  '''Assemble the frames x stars cube from starColumns (as returned by
+  starsFromStore or starsFromSidecars), in memory, as a dictionary like
+  the one loadCube returns. Frames are ordered by time. If a frame was
+  processed more than once, the last measurement of each star is used.'''
+  frameKeys = np.array(list(zip(starColumns['image'], starColumns['extno'])),
+                       dtype=[('image', 'S64'), ('extno', 'i2')])
+  frameKeys, frameIndex = np.unique(frameKeys, return_inverse=True)
+  starNames, starIndex = np.unique(starColumns['objName'],
+                                   return_inverse=True)
+  frameIndex, starIndex = frameIndex.ravel(), starIndex.ravel()
+  frameMJD = np.full(len(frameKeys), np.nan)
+  frameMJD[frameIndex] = starColumns['mjdMid']
+  order = np.argsort(frameMJD)
+  frameIndex = np.argsort(order)[frameIndex]
+  frames = np.zeros(len(frameKeys), dtype=FRAME_DTYPE)
+  frames['image'] = frameKeys['image'][order]
+  frames['extno'] = frameKeys['extno'][order]
+  frames['mjdMid'] = frameMJD[order]
+  stars = np.zeros(len(starNames), dtype=STAR_DTYPE)
+  stars['objName'] = starNames
+  for name in ['x', 'y', 'refMag', 'refColour']:
+    if name in starColumns:  # Median over frames, ignoring NaNs.
+      values = np.full((len(frames), len(stars)), np.nan)
+      values[frameIndex, starIndex] = starColumns[name]
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        stars[name] = np.nanmedian(values, axis=0)
+    else:
+      stars[name] = np.nan
+  cube = {'frames': frames, 'stars': stars}
+  for name in CUBE_QUANTITIES:
+    cube[name] = np.full((len(frames), len(stars)), np.nan)
+    cube[name][frameIndex, starIndex] = starColumns[name]
+  return cube
+
+
+def buildCube(cubeDir, starColumns):
+  '''Assemble the frames x stars cube from starColumns (see assembleCube)
+  and save it to cubeDir.'''
+  cube = assembleCube(starColumns)
+  if not os.path.isdir(cubeDir):
+    os.makedirs(cubeDir)
+  for name in CUBE_QUANTITIES + ['frames', 'stars']:
+    np.save(os.path.join(cubeDir, name + '.npy'), cube[name])
+  print('Cube of {} frames x {} stars saved to {}'.format(
+      len(cube['frames']), len(cube['stars']), cubeDir))
+
+
+def loadCube(cubeDir):
+  '''Memory-map a cube saved by buildCube. Returns a dictionary holding
+  frames, stars and the (nframes, nstars) arrays of CUBE_QUANTITIES.'''
+  cube = {}
+  for name in CUBE_QUANTITIES + ['frames', 'stars']:
+    cube[name] = np.load(os.path.join(cubeDir, name + '.npy'), mmap_mode='r')
+  return cube
+
+
+def completeStars(cube):
+  '''Boolean mask of the stars that have a magnitude in every frame.'''
+  return np.all(np.isfinite(cube['mag']), axis=0)
+
+
+def frameOrder(cube, images, extnos=None):
+  '''The cube frame indices of the given images (and extensions),
+  so that cube arrays can be put in the same order as another list.'''
+  extnos = [-1] * len(images) if extnos is None else extnos
+  lookup = dict(((image, extno), ii) for ii, (image, extno)
+                in enumerate(zip(cube['frames']['image'],
+                                 cube['frames']['extno'])))
+  # Not cut to the width of the cube's names, so longer ones never match.
+  images = np.array(images).astype(bytes)
+  return np.array([lookup[(image, -1 if extno is None else extno)]
+                   for image, extno in zip(images, extnos)])
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = "photcube -R <resultsstoredir> | -t '<trippyglob>' -o <cubedir>"
+  storeDir, trippyGlob, cubeDir = None, None, 'photcube'
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "R:t:o:h",
+                                   ["resultsstore=", "trippyfiles=",
+                                    "output="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-R', '--resultsstore'):
+      storeDir = arg
+    elif opt in ('-t', '--trippyfiles'):
+      trippyGlob = arg
+    elif opt in ('-o', '--output'):
+      cubeDir = arg
+  return storeDir, trippyGlob, cubeDir
+
+
+if __name__ == '__main__':
+  results, trippyfiles, output = getArguments(sys.argv)
+  if results is not None:
+    buildCube(output, starsFromStore(results))
+  else:
+    buildCube(output, starsFromSidecars(sorted(glob.glob(
+        './a???.trippy' if trippyfiles is None else trippyfiles))))
+
+
+# End of file.
+# Nothing to see here.
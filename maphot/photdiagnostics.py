@@ -0,0 +1,153 @@
+"""
+Scatter statistics and diagnostic plots of the photcor star calibration.
+
+scatterStatistics computes the scatter of every star over the frames and of
+the stars in use in every frame in a few array operations (no loops over
+stars). The plots are drawn with one collection per panel (a LineCollection
+for all light curves, a single scatter for the stars on the CCD) rather than
+one artist per star, and with at most MAX_STARS light curves. renderScatter
+and renderLightcurve draw them on an Agg canvas, without pyplot, and write
+PNG files, so they can run on a BackgroundWorker while photcor carries on:
+  queueRender(worker, renderScatter, 'scatter.png', julian, relmag, ...)
+"""
+from __future__ import print_function, division
+import os
+import numpy as np
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+MAX_STARS = 100  # Maximum number of light curves drawn per panel.
+CCD_AXIS = [0, 2048, 0, 4176]  # x and y range of the star map.
+
+
+def scatterStatistics(relmagnitude, useobject):
+  '''Scatter statistics of relmagnitude, of shape (frames, stars,
+  apertures), the star magnitudes relative to the mean of each frame.
+  Returns a dictionary of
+    scattermag: relmagnitude minus the mean of each star (same shape);
+    starstd:    the standard deviation of each star over the frames
+                (stars, apertures);
+    epochstd:   the standard deviation of the stars in use in each frame
+                (frames, apertures);
+    mean, max:  the mean and maximum of epochstd.'''
+  useobject = np.asarray(useobject, dtype=bool)
+  scattermag = relmagnitude - np.mean(relmagnitude, axis=0)
+  epochstd = np.nanstd(scattermag[:, useobject, :], axis=1)
+  return {'scattermag': scattermag,
+          'starstd': np.std(relmagnitude, axis=0),
+          'epochstd': epochstd,
+          'mean': np.mean(epochstd), 'max': np.max(epochstd)}
+
+
+def worstStars(useobject, starstd, maxstars=MAX_STARS):
+  '''Indices of the (at most maxstars) stars in use with the largest
+  scatter, which are the ones worth looking at.'''
+  useindex = np.arange(len(useobject))[np.asarray(useobject, dtype=bool)]
+  return useindex[np.argsort(starstd[useindex])[::-1][:maxstars]]
+
+
+def drawScatter(fig, alltimes, relmagnitude, useobject, magerror, x, y,
+                aperture=0, maxstars=MAX_STARS):
+  '''Draw the light curves (bottom left), the light curves around their
+  means with the scatter of each frame (top left) and the stars on the CCD,
+  sized by their scatter (right), for one aperture index, on fig.'''
+  from matplotlib.collections import LineCollection
+  stats = scatterStatistics(relmagnitude, useobject)
+  relmag = relmagnitude[:, :, aperture]
+  scattermag = stats['scattermag'][:, :, aperture]
+  starstd = stats['starstd'][:, aperture]
+  show = worstStars(useobject, starstd, maxstars)
+  alltimes = np.asarray(alltimes, dtype=np.float64)
+  times = np.broadcast_to(alltimes, (len(show), len(alltimes)))
+  grid = fig.add_gridspec(2, 3)
+  ax3 = fig.add_subplot(grid[1, 0:2])
+  ax4 = fig.add_subplot(grid[0, 0:2], sharex=ax3)
+  ax5 = fig.add_subplot(grid[:, 2])
+  colours = np.arange(len(show))
+  curves = LineCollection(np.stack([times, relmag[:, show].T], axis=-1),
+                          array=colours, cmap='viridis', lw=1)
+  ax3.add_collection(curves)
+  ax3.autoscale_view()
+  ax3.set_xlabel('Time (MJD)')
+  ax4.add_collection(LineCollection(
+      np.stack([times, scattermag[:, show].T], axis=-1),
+      array=colours, cmap='viridis', lw=1, zorder=2))
+  errors = magerror[:, show, aperture].T.ravel()
+  middle = scattermag[:, show].T.ravel()
+  ax4.add_collection(LineCollection(
+      np.stack([np.stack([times.ravel(), middle - errors], axis=-1),
+                np.stack([times.ravel(), middle + errors], axis=-1)],
+               axis=1), colors='0.6', lw=0.5, zorder=1))
+  ax4.errorbar(alltimes, np.zeros(len(alltimes)),
+               stats['epochstd'][:, aperture], lw=0, capsize=20,
+               elinewidth=0, color='k', zorder=3)
+  ax4.autoscale_view()
+  ax4.set_title('{} of {} stars in use shown'.format(
+      len(show), np.sum(useobject)))
+  useindex = np.arange(len(useobject))[np.asarray(useobject, dtype=bool)]
+  ax5.scatter(x[useindex], y[useindex], s=(starstd[useindex] * 300) ** 2,
+              alpha=0.3)
+  ax5.axis(CCD_AXIS)
+  return stats
+
+
+def drawLightcurve(fig, mjd, magobj, magerrobj, avmag, scaterr,
+                   magobj_done, magerrobj_done):
+  '''Draw the raw TNO photometry, the mean of the stars and the calibrated
+  TNO photometry (left) and just the calibrated photometry (right).'''
+  ax1 = fig.add_subplot(1, 2, 1)
+  ax1.errorbar(mjd, magobj, magerrobj, fmt='--', label='Raw')
+  ax1.errorbar(mjd, avmag, scaterr, label='Stars')
+  ax1.errorbar(mjd, magobj_done, magerrobj_done, lw=1, capsize=10,
+               elinewidth=2, label='Calibrated')
+  ax1.invert_yaxis()
+  ax1.legend(loc='best')
+  ax2 = fig.add_subplot(1, 2, 2)
+  ax2.errorbar(mjd, magobj_done, magerrobj_done, marker='+', lw=0,
+               capsize=10, elinewidth=2, label='TRIPPy')
+  ax2.invert_yaxis()
+  ax2.legend(loc='best')
+  for ax in (ax1, ax2):
+    ax.set_xlabel('Time (MJD)')
+  ax1.set_ylabel('mag')
+
+
+def savePNG(fig, fileName):
+  '''Render fig with the Agg backend (no pyplot, so this is safe on a
+  background thread) and write it to fileName.'''
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  FigureCanvasAgg(fig)
+  tmpName = fileName[:-4] + '.tmp{}.png'.format(os.getpid())
+  fig.savefig(tmpName, dpi=100)
+  os.rename(tmpName, fileName)
+
+
+def renderScatter(fileName, *args, **kwargs):
+  '''drawScatter(*args, **kwargs) on a new figure, saved to fileName.'''
+  from matplotlib.figure import Figure
+  fig = Figure(figsize=(15, 8))
+  drawScatter(fig, *args, **kwargs)
+  savePNG(fig, fileName)
+
+
+def renderLightcurve(fileName, *args):
+  '''drawLightcurve(*args) on a new figure, saved to fileName.'''
+  from matplotlib.figure import Figure
+  fig = Figure(figsize=(15, 6))
+  drawLightcurve(fig, *args)
+  savePNG(fig, fileName)
+
+
+def queueRender(worker, function, fileName, *args, **kwargs):
+  '''Run one of the render functions on worker (a BackgroundWorker), on
+  copies of the arrays, or right here if worker is None.'''
+  if worker is None:
+    function(fileName, *args, **kwargs)
+  else:
+    args = [np.array(arg) if isinstance(arg, np.ndarray) else arg
+            for arg in args]
+    worker.submit(function, fileName, *args, **kwargs)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,134 @@
+"""
+Photometric system transforms, defined as data.
+
+Every transform from PS1 to an instrument's filter is a polynomial in one
+PS1 colour:
+  mag_system = mag_PS1[fromBand] + sum_k c_k * (colour)^k
+kept in TRANSFORMS, keyed by (system, band). Transforms from an instrument
+back to PS1, which have to assume a median colour (with its spread) as the
+object's colour is unknown, are kept in TO_PS1 the same way.
+Adding an instrument is a data entry:
+  registerTransform('LBT', 'r', 'r', ('g', 'r'), [c0, c1], 'reference')
+No LBT or Subaru (HSC) transforms are included yet; register them once
+there are published coefficients, rather than guessing.
+Only the bands that are asked for are computed, each in one polynomial
+evaluation, and they are added to the catalog in place, without copying it.
+"""
+from __future__ import print_function, division
+import numpy as np
+from numpy.polynomial import polynomial
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+CADC = ('CADC MegaPipe, new (2015) filter set: http://www.cadc-ccda.hia-iha.'
+        'nrc-cnrc.gc.ca/en/megapipe/docs/filt.html')
+SCHWAMB = 'Schwamb et al 2018'
+OFEK = ('CADC MegaPipe with the median colours of Ofek 2012: '
+        'http://iopscience.iop.org/article/10.1088/0004-637X/749/1/10/meta')
+
+TRANSFORMS = {
+    ('CFHT', 'g'): {'fromBand': 'g', 'colour': ('g', 'i'),
+                    'coefficients': [0.014, 0.059, -0.00313, -0.00178],
+                    'reference': CADC},
+    ('CFHT', 'r'): {'fromBand': 'r', 'colour': ('g', 'i'),
+                    'coefficients': [0.003, -0.050, 0.0125, -0.0069],
+                    'reference': CADC},
+    ('CFHT', 'i'): {'fromBand': 'i', 'colour': ('g', 'i'),
+                    'coefficients': [0.006, -0.024, 0.00627, -0.00523],
+                    'reference': CADC},
+    ('CFHT', 'z'): {'fromBand': 'z', 'colour': ('g', 'i'),
+                    'coefficients': [-0.016, -0.069, 0.0239, -0.0056],
+                    'reference': CADC},
+    ('Gemini', 'g'): {'fromBand': 'g', 'colour': ('g', 'r'),
+                      'coefficients': [0., 0.0369], 'reference': SCHWAMB},
+    ('Gemini', 'r'): {'fromBand': 'r', 'colour': ('g', 'r'),
+                      'coefficients': [0., -0.052], 'reference': SCHWAMB},
+}
+
+TO_PS1 = {
+    ('CFHT', 'g'): {'colour': (0.69, 0.17), 'coefficients': [-0.015, -0.067],
+                    'reference': OFEK},  # g-r
+    ('CFHT', 'r'): {'colour': (0.28, 0.17), 'coefficients': [-0.002, 0.154],
+                    'reference': OFEK},  # r-i
+    ('CFHT', 'i'): {'colour': (0.28, 0.17), 'coefficients': [-0.002, 0.087],
+                    'reference': OFEK},  # r-i
+    ('CFHT', 'z'): {'colour': (0.22, 0.20),
+                    'coefficients': [0.001, 0.175, 0.013],
+                    'reference': OFEK},  # i-z
+}
+
+
+def registerTransform(system, band, fromBand, colour, coefficients,
+                      reference=''):
+  '''Add (or replace) the transform of PS1 magnitudes to band of system:
+  mag = PS1 fromBand + polynomial(coefficients) of the colour, a pair of
+  PS1 bands such as ('g', 'i').'''
+  if len(colour) != 2:
+    raise ValueError('colour must be a pair of PS1 bands, like ("g", "i")')
+  TRANSFORMS[(system, band)] = {'fromBand': fromBand, 'colour': tuple(colour),
+                                'coefficients': list(coefficients),
+                                'reference': reference}
+
+
+def getTransform(system, band, table=None):
+  '''The transform of band of system, with a helpful error if there is
+  none.'''
+  table = TRANSFORMS if table is None else table
+  if (system, band) not in table:
+    raise KeyError('No {} {} transform; known are {}'.format(
+        system, band, sorted(table)))
+  return table[(system, band)]
+
+
+def transformedName(system, band):
+  '''The catalog column name of the band transformed to system.'''
+  return '{}MeanPSFMag_{}'.format(band, system)
+
+
+def transformedMagnitude(catalog, system, band):
+  '''The PS1 magnitudes of catalog (a table with <band>MeanPSFMag columns)
+  transformed to band of system, in one polynomial evaluation.
+  Masks of the catalog columns are kept.'''
+  transform = getTransform(system, band)
+  bandA, bandB = transform['colour']
+  colour = (catalog[bandA + 'MeanPSFMag'] - catalog[bandB + 'MeanPSFMag'])
+  return (catalog[transform['fromBand'] + 'MeanPSFMag']
+          + polynomial.polyval(colour, transform['coefficients']))
+
+
+def addTransformedColumns(catalog, system, bands):
+  '''Add the PS1 magnitudes transformed to the given bands (a string or
+  list of band names) of system to catalog (an astropy Table), in place,
+  as <band>MeanPSFMag_<system> columns. Other bands are not computed.
+  Returns the same catalog.'''
+  from astropy.table import Column, MaskedColumn
+  for band in bands:
+    fromBand = getTransform(system, band)['fromBand'] + 'MeanPSFMag'
+    magnitude = transformedMagnitude(catalog, system, band)
+    columnClass = MaskedColumn if hasattr(magnitude, 'mask') else Column
+    column = columnClass(magnitude, name=transformedName(system, band),
+                         description=(catalog[fromBand].description or '')
+                         + ' transformed to {} filter'.format(system))
+    if column.name in catalog.colnames:
+      catalog.replace_column(column.name, column, copy=False)
+    else:
+      catalog.add_column(column, copy=False)
+  return catalog
+
+
+def toPS1(magnitude, uncertainty, system, band):
+  '''Transform magnitudes of band of system to PS1, assuming the median
+  colour in TO_PS1, whose spread is added to the uncertainty.'''
+  transform = getTransform(system, band, TO_PS1)
+  colour, colourSpread = transform['colour']
+  coefficients = transform['coefficients']
+  conversion = polynomial.polyval(colour, coefficients)
+  conversionUncertainty = (polynomial.polyval(colour,
+                                              polynomial.polyder(coefficients))
+                           * colourSpread)
+  return (magnitude + conversion,
+          np.sqrt(uncertainty ** 2 + conversionUncertainty ** 2))
+
+
+# End of file.
+# Nothing to see here.
@@ -1,40 +1,141 @@
 """
 This function converts a bunch of inputs to a nicely formatted MPC line.
+mpcLines does the same for whole arrays of detections at once, without any
+per-detection astropy objects, and writeMPCReport writes them in one go.
 """
 from __future__ import print_function, division
-import datetime
-from astropy import units as u
-from astropy.coordinates import Angle
-from astropy.time import Time
+import numpy as np
+from appender import appendLocked, replaceLocked
+
+MJD_TO_JDN = 2400001  # Julian day number of the (noon-based) day of MJD 0.5
+
+
+def civilDate(mjd):
+  '''Year, month and day (integer arrays) of the dates of the given MJDs,
+  from the Julian day number (Fliegel & Van Flandern 1968).'''
+  jdn = np.floor(mjd).astype(np.int64) + MJD_TO_JDN
+  ell = jdn + 68569
+  n = 4 * ell // 146097
+  ell = ell - (146097 * n + 3) // 4
+  i = 4000 * (ell + 1) // 1461001
+  ell = ell - 1461 * i // 4 + 31
+  j = 80 * ell // 2447
+  day = ell - 2447 * j // 80
+  ell = j // 11
+  month = j + 2 - 12 * ell
+  year = 100 * (n - 49) + i + ell
+  return year, month, day
+
+
+def joinStrings(*columns):
+  '''Element-wise concatenation of string arrays (and single strings).'''
+  joined = columns[0]
+  for column in columns[1:]:
+    joined = np.char.add(joined, column)
+  return joined
+
+
+def mpcDateStrings(mjd):
+  '''"YYYY MM DD.ddddd" strings of the given MJDs.
+  The MJDs are rounded to 1e-5 days first, so a day never reads 32.00000.'''
+  mjd = np.round(np.asarray(mjd, dtype=np.float64), 5)
+  year, month, day = civilDate(mjd)
+  return joinStrings(np.char.mod('%4d', year), np.char.mod(' %02d ', month),
+                     np.char.mod('%08.5f', day + (mjd - np.floor(mjd))))
+
+
+def sexagesimalStrings(ra, dec):
+  '''"HH MM SS.sss" and "sDD MM SS.ss" strings of ra and dec (in degrees).
+  Rounding is done on integer milliseconds of time and centi-arcseconds,
+  so it carries properly (no 60.000 seconds).'''
+  ms = np.round((np.asarray(ra, dtype=np.float64) % 360.) * 240000.
+                ).astype(np.int64) % 86400000
+  raString = joinStrings(np.char.mod('%02d', ms // 3600000),
+                         np.char.mod(' %02d', ms // 60000 % 60),
+                         np.char.mod(' %02d', ms // 1000 % 60),
+                         np.char.mod('.%03d', ms % 1000))
+  dec = np.asarray(dec, dtype=np.float64)
+  cas = np.round(np.abs(dec) * 360000.).astype(np.int64)
+  decString = joinStrings(np.where(dec < 0, '-', '+'),
+                          np.char.mod('%02d', cas // 360000),
+                          np.char.mod(' %02d', cas // 6000 % 60),
+                          np.char.mod(' %02d', cas // 100 % 60),
+                          np.char.mod('.%02d', cas % 100))
+  return raString, decString
+
+
+def mpcLines(names, mjdMid, ra, dec, mag, filtr, observatory=568):
+  """
+  Format many detections as MPC lines at once.
+  names (up to 7 characters), mjdMid (MJD of the middle of the exposure),
+  ra and dec (degrees), mag and filtr can be arrays or single values,
+  which are broadcast against each other.
+  Returns an array of MPC formatted lines.
+  """
+  (names, mjdMid, ra, dec, mag, filtr, observatory) = [
+      np.ravel(column) for column in np.broadcast_arrays(
+          np.asarray(names, dtype=str), mjdMid, ra, dec, mag,
+          np.asarray(filtr, dtype=str), np.asarray(observatory, dtype=str))]
+  raString, decString = sexagesimalStrings(ra, dec)
+  return joinStrings('     ', np.char.ljust(names, 7), '  C',
+                     mpcDateStrings(mjdMid), ' ', raString, decString,
+                     '         ', np.char.mod('%4.1f',
+                                              mag.astype(np.float64)),
+                     ' ', np.char.ljust(filtr.astype('U1'), 1), '      ',
+                     np.char.rjust(observatory, 3))
+
+
+def writeMPCReport(fileName, lines, mode='a', replace=None):
+  '''Write (append, by default) MPC lines to fileName in one write.
+  Appending is locked, as many maphot runs share a report; lines given in
+  replace are removed from the report first.'''
+  text = ''.join(line + '\n' for line in lines)
+  if replace is not None:
+    replaced = set(line + '\n' for line in replace)
+    replaceLocked(fileName, text, lambda line: line in replaced)
+  elif mode == 'a':
+    appendLocked(fileName, text)
+  else:
+    with open(fileName, mode) as wf:
+      wf.write(text)
+
+
+def pix2MPCBatch(WCS, aEXPTIME, aMJD, mag, xcoo, ycoo, filtr, names,
+                 observatory=568):
+  """
+  Converts arrays of x-y pixel coordinates in one image (with WCS) to RA and
+  Dec, and the start times of the exposures to the middle of the exposures.
+  Returns an array of MPC formatted lines.
+  """
+  ra, dec = WCS.all_pix2world(np.atleast_1d(xcoo), np.atleast_1d(ycoo), 1)
+  mjdMid = np.asarray(aMJD, dtype=np.float64) + aEXPTIME / 2. / 86400.
+  return mpcLines(names, mjdMid, ra, dec, mag, filtr, observatory)
+
+
+def mpcReportName(extn, tag=''):
+  '''The designation and the report file of the MPC lines of extension extn.
+  With a tag (maphot -t, e.g. the object), the designation is the tag (cut
+  to the 7 characters MPC lines allow) and the file extnoNN_<tag>.mpc, so
+  that several objects on one CCD get reports of their own.'''
+  if tag:
+    return tag[:7], 'extno{0:02.0f}_{1}.mpc'.format(extn, tag)
+  return 'extno{0:02.0f}'.format(extn), 'extno{0:02.0f}.mpc'.format(extn)
+
 
 def pix2MPC(WCS, aEXPTIME, aMJD, mag, xcoo, ycoo, filtr, extn,
-            observatory=568):
+            observatory=568, replace=None, tag=''):
   """
   This function takes variables (given in maphot.py),
   then converts an x-y pixel coordinate to a RA and Dec.
   Also converts the time of observation to an MPC friendly format.
+  The line is appended to extnoNN.mpc (see mpcReportName for a tag),
+  replacing the line replace, if given.
   Returns an MPC formatted line.
   """
-  name = 'extno{0:02.0f}'.format(extn)
-  #Convert pixel coordinates to world coordinates
-  ra, dec = WCS.all_pix2world(xcoo, ycoo, 1)
-  #Convert the ra/dec (which is in degrees) to sexagesimals
-  raString = Angle(str(ra) + 'degrees').to_string(unit=u.hour,
-                                                  sep=' ', pad=True)
-  decString = Angle(str(dec) + 'degrees').to_string(unit=u.degree, sep=' ',
-                                                    pad=True, alwayssign=True)
-  #Calculate time of the middle of the image & convert to year month day.dd
-  mT = (Time(aMJD, format='mjd').datetime +
-        datetime.timedelta(seconds=aEXPTIME / 2.))
-  decimalday = (mT.day + (mT.hour + (mT.minute +
-                (mT.second + mT.microsecond / 1.e6) / 60.) / 60.) / 24.)
-  midTimeString = '{0:4.0f} {1:02.0f} '.format(mT.year, mT.month) +\
-                  '{0:08.5f}'.format(decimalday)
-  #Put it all together in an MPC line
-  MPCString = ('     ' + name + '  C' + midTimeString[:16] + ' ' +
-               raString[:12] + decString[:12] +
-               '         {0:4.1f} '.format(mag) + filtr[:1] +
-               '      {0:3.0f}'.format(observatory))
-  wf = open("{}.mpc".format(name), "a+")
-  wf.write("{}\n".format(MPCString))
+  name, reportFile = mpcReportName(extn, tag)
+  MPCString = pix2MPCBatch(WCS, aEXPTIME, aMJD, mag, xcoo, ycoo, filtr,
+                           name, observatory)[0]
+  writeMPCReport(reportFile, [MPCString],
+                 replace=None if replace is None else [replace])
   print(MPCString)
+  return MPCString
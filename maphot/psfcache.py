@@ -0,0 +1,87 @@
+"""
+A cache of PSF star selections and Moffat fits, shared between the images
+of a sequence.
+
+Consecutive frames of a field usually have nearly the same seeing, so the
+stars that were good PSF stars in one frame, and their median Moffat
+parameters, are a very good starting point for the next frame.
+Entries are keyed by field, filter, extension and a seeing bin, where the
+seeing is estimated from the SExtractor catalogue before any PSF fitting.
+"""
+from __future__ import print_function, division
+import os
+import zipfile
+import numpy as np
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+
+def estimateSeeing(catalogue):
+  '''Estimate the seeing FWHM (pixels) of an image from its SExtractor
+  catalogue, without fitting anything.'''
+  if 'FWHM_IMAGE' in catalogue.keys():
+    return np.nanmedian(catalogue['FWHM_IMAGE'])
+  return 2.3548 * np.nanmedian((np.array(catalogue['AWIN_IMAGE'])
+                                * np.array(catalogue['BWIN_IMAGE'])) ** 0.5)
+
+
+def psfCacheKey(header, FILTER, extno, seeing, binWidth=0.25):
+  '''The (field, filter, extno, seeing bin) key of an image.
+  The field is the OBJECT keyword, or the pointing if there is none.'''
+  try:
+    field = str(header['OBJECT']).strip().replace(' ', '_')
+  except KeyError:
+    field = '{0:05.1f}_{1:+04.1f}'.format(header['CRVAL1'], header['CRVAL2'])
+  return (field, FILTER, -1 if extno is None else int(extno),
+          int(np.round(seeing / binWidth)))
+
+
+def psfCacheFile(cacheDir, key):
+  '''The file name of a cache entry.'''
+  return os.path.join(cacheDir, '{}_{}_{:02d}_{:03d}.npz'.format(*key))
+
+
+def loadPSFCache(cacheDir, key, searchBins=1):
+  '''Load the cache entry for key. If there is none, the nearest entry
+  within searchBins seeing bins is used instead.
+  Returns a dictionary with goodFits, goodMeds, goodSTDs and objName,
+  or None if nothing was found. Truncated or corrupt entries, and ones
+  written by another version, are skipped like missing ones.'''
+  field, FILTER, extno, seeingBin = key
+  for dbin in sorted(np.arange(-searchBins, searchBins + 1), key=abs):
+    cacheFile = psfCacheFile(cacheDir, (field, FILTER, extno,
+                                        seeingBin + dbin))
+    try:
+      with np.load(cacheFile) as han:
+        return dict((name, han[name]) for name in han.files)
+    except (IOError, EOFError, ValueError, KeyError, zipfile.BadZipfile):
+      continue
+  return None
+
+
+def savePSFCache(cacheDir, key, goodFits, goodMeds, goodSTDs, objNames):
+  '''Save the PSF stars and fits of an image to the cache.
+  The file is written under a temporary name and then renamed, so that
+  parallel workers never read a half-written entry.'''
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  cacheFile = psfCacheFile(cacheDir, key)
+  tmpFile = cacheFile[:-4] + '.tmp{}.npz'.format(os.getpid())
+  np.savez(tmpFile, goodFits=np.array(goodFits), goodMeds=np.array(goodMeds),
+           goodSTDs=np.array(goodSTDs),
+           objName=np.array(objNames, dtype=str))
+  os.rename(tmpFile, cacheFile)
+
+
+def warmStartCatalogue(catalogue, cached, minStars=5):
+  '''Trim catalogue down to the stars that were good PSF stars in the cached
+  image, matching on the PS1 objName.
+  Returns the full catalogue if fewer than minStars of them are present.'''
+  keep = np.isin(np.array(catalogue['objName'], dtype=str), cached['objName'])
+  if np.sum(keep) < minStars:
+    return catalogue
+  return catalogue[keep]
+
+
+# End of file.
+# Nothing to see here.
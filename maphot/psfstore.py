@@ -0,0 +1,157 @@
+"""
+A compact, versioned file format for the PSF of an image.
+
+Instead of pickling the whole trippy PSF object (which is large, slow to load
+and breaks whenever trippy changes), only the things needed to use or rebuild
+the PSF are stored, in one FITS file:
+  primary header: schema version, Moffat alpha/beta, repFact, FWHM,
+                  and the rate/angle/exposure time of the trailed PSF;
+  LOOKUPTABLE:    the lookup table, as float32;
+  APERCORR:       the round aperture-correction curve;
+  LINEAPERCORR:   the trailed (line) aperture-correction curve;
+  GOODFITS, GOODMEDS, GOODSTDS: the fits of the good PSF stars.
+StoredPSF reads this lazily, memory-maps the lookup table and only rebuilds
+a full trippy PSF if something (like the MCMC fitter) actually needs one.
+"""
+from __future__ import print_function, division
+import os
+import numpy as np
+import astropy.io.fits as pyf
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+PSF_STORE_VERSION = 1
+
+
+def setAperCorrs(goodPSF, aperCorrRadii, aperCorrs,
+                 lineAperCorrRadii, lineAperCorrs):
+  '''Give a trippy PSF aperture-correction curves without computing them,
+  setting the same attributes that computeRoundAperCorrFromPSF and
+  computeLineAperCorrFromTSF would have set.'''
+  from scipy import interpolate
+  goodPSF.aperCorrRadii = np.array(aperCorrRadii, dtype=np.float64)
+  goodPSF.aperCorrs = np.array(aperCorrs, dtype=np.float64)
+  goodPSF.aperCorrFunc = interpolate.interp1d(goodPSF.aperCorrRadii,
+                                              goodPSF.aperCorrs)
+  goodPSF.lineAperCorrRadii = np.array(lineAperCorrRadii, dtype=np.float64)
+  goodPSF.lineAperCorrs = np.array(lineAperCorrs, dtype=np.float64)
+  goodPSF.lineAperCorrFunc = interpolate.interp1d(goodPSF.lineAperCorrRadii,
+                                                  goodPSF.lineAperCorrs)
+
+
+def savePSFStore(fileName, goodPSF, goodFits, goodMeds, goodSTDs,
+                 rate, angle, dt, pxscale):
+  '''Write the compact PSF file for a trippy PSF that has its lookup table,
+  trailed PSF and both aperture corrections computed.'''
+  header = pyf.Header()
+  header['PSFSTVER'] = (PSF_STORE_VERSION, 'maphot PSF store schema version')
+  header['ALPHA'] = (float(goodPSF.alpha), 'Moffat alpha')
+  header['BETA'] = (float(goodPSF.beta), 'Moffat beta')
+  header['REPFACT'] = (int(goodPSF.repFact), 'Supersampling factor')
+  header['PSFSIZE'] = (int(np.shape(goodPSF.lookupTable)[0]
+                           // goodPSF.repFact), 'PSF box size (pixels)')
+  header['FWHM'] = (float(goodPSF.FWHM()), 'FWHM including lookup table')
+  header['RATE'] = (float(rate), 'Rate of trailed PSF (pix/hr)')
+  header['ANGLE'] = (float(angle), 'Angle of trailed PSF (deg)')
+  header['DT'] = (float(dt), 'Exposure time of trailed PSF (hr)')
+  header['PIXSCALE'] = (float(pxscale), 'Pixel scale of trailed PSF')
+  hdus = [pyf.PrimaryHDU(header=header),
+          pyf.ImageHDU(np.array(goodPSF.lookupTable, dtype=np.float32),
+                       name='LOOKUPTABLE')]
+  for name, radii, corrs in [('APERCORR', goodPSF.aperCorrRadii,
+                              goodPSF.aperCorrs),
+                             ('LINEAPERCORR', goodPSF.lineAperCorrRadii,
+                              goodPSF.lineAperCorrs)]:
+    hdus.append(pyf.BinTableHDU.from_columns(
+        [pyf.Column(name='RADIUS', format='D', array=np.array(radii)),
+         pyf.Column(name='CORR', format='D', array=np.array(corrs))],
+        name=name))
+  for name, array in [('GOODFITS', goodFits), ('GOODMEDS', goodMeds),
+                      ('GOODSTDS', goodSTDs)]:
+    hdus.append(pyf.ImageHDU(np.array(array, dtype=np.float64), name=name))
+  tmpName = fileName + '.tmp{}'.format(os.getpid())
+  pyf.HDUList(hdus).writeto(tmpName, overwrite=True)
+  os.rename(tmpName, fileName)
+
+
+class StoredPSF(object):
+  '''A PSF read back from a file written by savePSFStore.
+  FWHM, roundAperCorr and lineAperCorr work straight from the file.
+  Anything else (plant, remove, longPSF, ... as used by the MCMC fitter)
+  is passed on to a trippy modelPSF, which is rebuilt on first use.
+  '''
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.hdulist = pyf.open(fileName, memmap=True)
+    self.header = self.hdulist[0].header
+    if self.header.get('PSFSTVER') != PSF_STORE_VERSION:
+      self.hdulist.close()
+      raise IOError('{} has PSF store version {}, expected {}'.format(
+          fileName, self.header.get('PSFSTVER'), PSF_STORE_VERSION))
+    self._modelPSF = None
+
+  @property
+  def lookupTable(self):
+    '''The (memory-mapped, float32) lookup table.'''
+    return self.hdulist['LOOKUPTABLE'].data
+
+  @property
+  def goodFits(self):
+    return self.hdulist['GOODFITS'].data
+
+  @property
+  def goodMeds(self):
+    return self.hdulist['GOODMEDS'].data
+
+  @property
+  def goodSTDs(self):
+    return self.hdulist['GOODSTDS'].data
+
+  def FWHM(self):
+    return self.header['FWHM']
+
+  def _aperCorr(self, name, r):
+    curve = self.hdulist[name].data
+    return (np.interp(r, curve['RADIUS'], curve['CORR'])
+            - np.min(curve['CORR']))
+
+  def roundAperCorr(self, r):
+    return self._aperCorr('APERCORR', r)
+
+  def lineAperCorr(self, r):
+    return self._aperCorr('LINEAPERCORR', r)
+
+  def modelPSF(self):
+    '''Rebuild (once) and return the full trippy modelPSF.'''
+    if self._modelPSF is None:
+      from trippy import psf
+      size = self.header['PSFSIZE']
+      goodPSF = psf.modelPSF(np.arange(size), np.arange(size),
+                             alpha=self.header['ALPHA'],
+                             beta=self.header['BETA'],
+                             repFact=self.header['REPFACT'])
+      goodPSF.lookupTable = np.array(self.lookupTable, dtype=np.float64)
+      goodPSF.fitted = True
+      goodPSF.genPSF()
+      goodPSF.line(self.header['RATE'], self.header['ANGLE'],
+                   self.header['DT'], pixScale=self.header['PIXSCALE'],
+                   useLookupTable=True)
+      curves = [self.hdulist[name].data for name in ('APERCORR',
+                                                     'LINEAPERCORR')]
+      setAperCorrs(goodPSF, curves[0]['RADIUS'], curves[0]['CORR'],
+                   curves[1]['RADIUS'], curves[1]['CORR'])
+      self._modelPSF = goodPSF
+    return self._modelPSF
+
+  def __getattr__(self, name):
+    if name.startswith('_') or name in ('hdulist', 'header', 'fileName'):
+      raise AttributeError(name)
+    return getattr(self.modelPSF(), name)
+
+  def close(self):
+    self.hdulist.close()
+
+
+# End of file.
+# Nothing to see here.
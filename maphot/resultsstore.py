@@ -0,0 +1,134 @@
+"""
+A typed, columnar store for maphot's results.
+
+Every maphot run appends fixed-size binary records to tables in a store
+directory; one record per TNO measurement in 'tno' and one record per star,
+per image in 'stars'. Images are stored by their file name, without the
+directory. Each table is a raw file of numpy records plus a small
+json schema file, so appending is a single write and reading a whole season
+of measurements is a single (memory-mapped) read:
+  tno = readTable('results', 'tno')
+  tno['magPS1'][tno['object'] == b'myTNO']
+A record is never changed once written: when an image is measured again
+(e.g. after review, see review.py), the later record of that image
+supersedes the earlier one, so readers use the last record of each image.
+exportFITS turns a table into a FITS binary table, for other tools.
+"""
+from __future__ import print_function, division
+import os
+import json
+import numpy as np
+from appender import appendLocked
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+STORE_VERSION = 1
+
+TNO_SCHEMA = [('image', 'S64'), ('object', 'S32'), ('extno', 'i2'),
+              ('mjd', 'f8'), ('mjdMid', 'f8'), ('ra', 'f8'), ('dec', 'f8'),
+              ('x', 'f8'), ('y', 'f8'), ('filter', 'S8'), ('fwhm', 'f8'),
+              ('aperture', 'f8'), ('magRaw', 'f8'), ('dmagRaw', 'f8'),
+              ('zptRaw', 'f8'), ('magCalibration', 'f8'),
+              ('dmagCalibration', 'f8'), ('magInst', 'f8'),
+              ('dmagInst', 'f8'), ('zptGood', 'f8'), ('magPS1', 'f8'),
+              ('dmagPS1', 'f8'), ('flux', 'f8'), ('snr', 'f8'), ('bg', 'f8'),
+              ('bgXMin', 'f4'), ('bgXMax', 'f4'), ('bgYMin', 'f4'),
+              ('bgYMax', 'f4'), ('runTime', 'S19'), ('version', 'S16')]
+
+STAR_SCHEMA = [('image', 'S64'), ('extno', 'i2'), ('mjdMid', 'f8'),
+               ('objName', 'S32'), ('x', 'f8'), ('y', 'f8'), ('ra', 'f8'),
+               ('dec', 'f8'), ('filter', 'S8'), ('mag', 'f8'),
+               ('dmag', 'f8'), ('flux', 'f8'), ('snr', 'f8'), ('bg', 'f8'),
+               ('refMag', 'f8'), ('refColour', 'f8'), ('calibStar', '?')]
+
+SCHEMAS = {'tno': TNO_SCHEMA, 'stars': STAR_SCHEMA}
+
+
+def tableFiles(storeDir, table):
+  '''The record and schema file names of a table.'''
+  return (os.path.join(storeDir, table + '.rec'),
+          os.path.join(storeDir, table + '.schema.json'))
+
+
+def checkWidth(name, values, dtype):
+  '''Raise ValueError if any of values is longer than the string column
+  name of type dtype (e.g. 'S64') holds, as numpy would silently truncate
+  it and different images or objects could end up with the same name.'''
+  lengths = np.char.str_len(np.atleast_1d(np.asarray(values)).astype(bytes))
+  if len(lengths) and (np.max(lengths) > np.dtype(dtype).itemsize):
+    raise ValueError("{} '{}' is longer than the {} characters the ".format(
+        name, np.atleast_1d(values)[np.argmax(lengths)],
+        np.dtype(dtype).itemsize) + 'results store allows.')
+
+
+def makeRecords(table, nrows=1, **columns):
+  '''Make nrows empty records for table and fill in the given columns.
+  Columns that are not given are NaN for floats and empty/0 otherwise,
+  as are masked values of float columns. String values that don't fit
+  their column raise ValueError (see checkWidth).'''
+  records = np.zeros(nrows, dtype=SCHEMAS[table])
+  for name in records.dtype.names:
+    if records.dtype[name].kind == 'f':
+      records[name] = np.nan
+  for name, values in columns.items():
+    if records.dtype[name].kind == 'f':
+      values = np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+    elif records.dtype[name].kind == 'S':
+      checkWidth(name, values, records.dtype[name])
+    records[name] = values
+  return records
+
+
+def checkSchema(storeDir, table, create=True):
+  '''Write the schema file of a table (unless create=False), or check that
+  an existing one matches this version of maphot.'''
+  schemaFile = tableFiles(storeDir, table)[1]
+  schema = {'version': STORE_VERSION, 'dtype': SCHEMAS[table]}
+  if os.path.isfile(schemaFile):
+    with open(schemaFile) as han:
+      stored = json.load(han)
+    if (stored['version'] != STORE_VERSION or
+        [tuple(column) for column in stored['dtype']] != SCHEMAS[table]):
+      raise IOError('{} does not match this version '.format(schemaFile)
+                    + 'of the results store.')
+  elif create:
+    if not os.path.isdir(storeDir):
+      os.makedirs(storeDir)
+    tmpFile = schemaFile + '.tmp{}'.format(os.getpid())
+    with open(tmpFile, 'w') as han:
+      json.dump(schema, han)
+    os.rename(tmpFile, schemaFile)
+
+
+def appendRecords(storeDir, table, records):
+  '''Append records to a table of the store, in a single locked write.'''
+  checkSchema(storeDir, table)
+  records = np.asarray(records, dtype=SCHEMAS[table])
+  appendLocked(tableFiles(storeDir, table)[0], records.tobytes())
+
+
+def readTable(storeDir, table, memmap=True):
+  '''Read a whole table as one numpy record array.
+  With memmap=True the file is memory-mapped rather than read.
+  Reading never writes; a table that doesn't exist is empty.'''
+  checkSchema(storeDir, table, create=False)
+  recordFile = tableFiles(storeDir, table)[0]
+  dtype = np.dtype(SCHEMAS[table])
+  if (not os.path.isfile(recordFile)) or os.path.getsize(recordFile) == 0:
+    return np.zeros(0, dtype=dtype)
+  nrows = os.path.getsize(recordFile) // dtype.itemsize
+  if memmap:
+    return np.memmap(recordFile, dtype=dtype, mode='r', shape=(nrows,))
+  return np.fromfile(recordFile, dtype=dtype, count=nrows)
+
+
+def exportFITS(storeDir, table, fitsFile):
+  '''Write a table of the store to a FITS binary table.'''
+  from astropy.io import fits
+  hdu = fits.BinTableHDU(np.array(readTable(storeDir, table)), name=table)
+  hdu.header['STOREVER'] = STORE_VERSION
+  hdu.writeto(fitsFile, overwrite=True)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+"""
+Deferred review of the choices maphot makes when run with '-p review'.
+
+In review mode maphot runs without any windows or prompts, chooses the
+centroid provisionally (see maphot_functions.autoChooseCentroid) and, in a
+background thread, renders a montage of the data, model, residual and
+apertures for each image to <inputName>_review.png and records its choices
+in <inputName>_review.json.
+
+Afterwards,
+  review.py -g
+gathers all of them into the gallery review.html (once, rather than after
+every image, which would read every record again each time). A person looks
+through review.html and writes an overrides file,
+with one line per image that needs changing:
+  <inputName> <S|M|e>      (use the SExtractor, MCMC or estimated centroid)
+  <inputName> <x> <y>      (use this exact position)
+Running
+  review.py -o <overridesfile>
+stores the overrides and redoes the TNO photometry of only those images, at
+the centroids the reviewer chose (see rerunOverride). The PSF, the star
+photometry and the calibration of the first run are reused, and its rows in
+TNOmags*.txt and the .mpc report are replaced; in a results store, the new TNO
+record supersedes the old one, as readers use the last record of an image.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import glob
+import json
+import getopt
+import numpy as np
+from astropy.visualization import interval
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+
+def reviewFileName(inputName):
+  '''The name of the json file holding the review record of an image.'''
+  return inputName + '_review.json'
+
+
+def readReviewRecord(inputName):
+  '''Read the review record of an image. Returns {} if there is none.'''
+  try:
+    with open(reviewFileName(inputName)) as han:
+      return json.load(han)
+  except (IOError, ValueError):
+    return {}
+
+
+def writeReviewRecord(inputName, record):
+  '''Write (merge) a review record for an image.
+  Entries already in the file, such as a reviewer's override, are kept
+  unless record replaces them. The file is replaced atomically.'''
+  fullRecord = readReviewRecord(inputName)
+  fullRecord.update(dict((key, value) for key, value in record.items()
+                         if value is not None))
+  tmpName = reviewFileName(inputName) + '.tmp{}'.format(os.getpid())
+  with open(tmpName, 'w') as han:
+    json.dump(fullRecord, han, indent=1, sort_keys=True)
+  os.rename(tmpName, reviewFileName(inputName))
+
+
+def readOverride(inputName):
+  '''Returns (choice, x, y) if a reviewer has overridden the centroid
+  of this image, otherwise None.'''
+  override = readReviewRecord(inputName).get('override')
+  if override is None:
+    return None
+  return override['choice'], override['x'], override['y']
+
+
+def cropStamp(array, xd, yd, halfSize=30):
+  '''Copy out a small square of array around (xd, yd), as float32.
+  Returns the copy and the position of (xd, yd) within it.'''
+  if array is None:
+    return None, (xd, yd)
+  ny, nx = np.shape(array)
+  xl, yl = np.max([0, int(xd) - halfSize]), np.max([0, int(yd) - halfSize])
+  xh, yh = (np.min([nx, int(xd) + halfSize + 1]),
+            np.min([ny, int(yd) + halfSize + 1]))
+  return (np.array(array[yl:yh, xl:xh], dtype=np.float32),
+          (xd - xl, yd - yl))
+
+
+def renderMontage(pngName, Data, modelImage, removed, xy, candidates, chosen,
+                  radius, trailLength, angle, title=''):
+  '''Render a four-panel montage (data, model, residual, apertures) to a PNG.
+  Uses the Agg canvas directly, so it is safe to call from a thread and
+  never opens a window. xy and the candidates are stamp coordinates.'''
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  from matplotlib.patches import Circle
+  z1, z2 = interval.ZScaleInterval().get_limits(Data)
+  normer = interval.ManualInterval(z1, z2)
+  fig = Figure(figsize=(12, 3.4))
+  FigureCanvasAgg(fig)
+  panels = [('data', Data), ('model', modelImage), ('residual', removed),
+            ('apertures', Data)]
+  for ii, (name, image) in enumerate(panels):
+    ax = fig.add_subplot(1, 4, ii + 1)
+    ax.set_title(name)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    if image is None:
+      ax.text(0.5, 0.5, 'not removed', ha='center', va='center',
+              transform=ax.transAxes)
+      continue
+    ax.imshow(normer(image), origin='lower', cmap='gray')
+  dx = 0.5 * trailLength * np.cos(angle * np.pi / 180.)
+  dy = 0.5 * trailLength * np.sin(angle * np.pi / 180.)
+  ax.plot([xy[0] - dx, xy[0] + dx], [xy[1] - dy, xy[1] + dy], 'r-')
+  for xend, yend in [(xy[0] - dx, xy[1] - dy), (xy[0] + dx, xy[1] + dy)]:
+    ax.add_patch(Circle((xend, yend), radius, fill=False, color='r'))
+  markers = {'S': 'w+', 'M': 'gx', 'e': 'k*'}
+  for key, (xc, yc) in candidates.items():
+    ax.plot([xc], [yc], markers.get(key, 'b.'), ms=10, mew=2,
+            label=key + (' (chosen)' if key == chosen else ''))
+  ax.legend(loc='upper right', fontsize='small')
+  ax.set_xlim(0, np.shape(Data)[1] - 1)
+  ax.set_ylim(0, np.shape(Data)[0] - 1)
+  fig.suptitle(title)
+  fig.savefig(pngName, dpi=72)
+
+
+def writeGallery(htmlName='review.html', directory='.'):
+  '''Write an html page showing every review montage in directory.'''
+  rows = []
+  for recordFile in sorted(glob.glob(os.path.join(directory,
+                                                  '*_review.json'))):
+    with open(recordFile) as han:
+      record = json.load(han)
+    inputName = os.path.basename(recordFile)[:-len('_review.json')]
+    override = record.get('override')
+    rows.append('<tr><td>{}</td><td><img src="{}"></td>'
+                .format(inputName, os.path.basename(record.get('png', '')))
+                + '<td>{}</td><td>{}</td><td><pre>{}</pre></td></tr>\n'
+                .format(record.get('chosen'),
+                        '' if override is None else override['choice'],
+                        '\n'.join(record.get('reasons', []))))
+  tmpName = os.path.join(directory, htmlName + '.tmp{}'.format(os.getpid()))
+  with open(tmpName, 'w') as han:
+    han.write('<html><head><title>maphot review</title></head><body>\n'
+              + '<p>Override with lines of "inputName S|M|e" or '
+              + '"inputName x y" in a file, then run review.py -o file.</p>\n'
+              + '<table border=1>\n<tr><th>Image</th><th>Montage</th>'
+              + '<th>Chosen</th><th>Override</th><th>Reasons</th></tr>\n'
+              + ''.join(rows) + '</table></body></html>\n')
+  os.rename(tmpName, os.path.join(directory, htmlName))
+
+
+def renderReview(inputName, record, stamps, candidates, radius, trailLength,
+                 angle):
+  '''Render the montage and save the record (see writeGallery).
+  This is the job that maphot runs on its background thread.'''
+  Data, modelImage, removed, xy = stamps
+  record['png'] = inputName + '_review.png'
+  renderMontage(record['png'], Data, modelImage, removed, xy, candidates,
+                record['chosen'], radius, trailLength, angle,
+                title=inputName)
+  writeReviewRecord(inputName, record)
+
+
+def queueReview(worker, inputName, argv, stamps, xUse, yUse, chosen,
+                centroidRecord, radius, trailLength, angle):
+  '''Copy out the stamps needed for the review montage of an image
+  and hand the rendering over to a BackgroundWorker.
+  stamps is what removeTSF returns: (Data, modelImage, removed, (xd, yd)),
+  where (xd, yd) is the position of (xUse, yUse) within Data.'''
+  Data, modelImage, removed, (xd, yd) = stamps
+  DataCrop, xy = cropStamp(Data, xd, yd)
+  modelCrop, _ = cropStamp(modelImage, xd, yd)
+  removedCrop, _ = cropStamp(removed, xd, yd)
+  candidates = dict((key, (float(xc - xUse + xy[0]), float(yc - yUse + xy[1])))
+                    for key, (xc, yc) in
+                    centroidRecord.get('candidates', {}).items())
+  record = {'argv': list(argv), 'chosen': chosen,
+            'x': float(xUse), 'y': float(yUse),
+            'candidates': dict((key, [float(xc), float(yc)]) for key, (xc, yc)
+                               in centroidRecord.get('candidates',
+                                                     {}).items()) or None,
+            'reasons': centroidRecord.get('reasons')}
+  worker.submit(renderReview, inputName, record,
+                (DataCrop, modelCrop, removedCrop, xy), candidates,
+                radius, trailLength, angle)
+
+
+def rerunOverride(inputName):
+  '''Redo the TNO photometry of an image at the centroid its reviewer chose,
+  with the maphot arguments of its first run. Only the TNO photometry and
+  outputs are redone: the PSF comes from <inputName>_psfStore.fits and the
+  star photometry and calibration from <inputName>.trippy.json. Returns
+  False, having done nothing, if either is missing.'''
+  from datetime import datetime
+  from maphot_functions import (getArguments, getDataHeader, measureTNO,
+                                CFHT_to_PS1, saveTNOMag, saveTNOMag2,
+                                saveTrippySidecar, PRECISIONS)
+  from psfstore import StoredPSF
+  from ephemeris import EphemerisService
+  from pix2world import pix2MPC, pix2MPCBatch, mpcReportName
+  from resultsstore import appendRecords, makeRecords
+  from __version__ import __version__
+  psfStoreName = inputName + '_psfStore.fits'
+  try:
+    with open(inputName + '.trippy.json') as han:
+      firstRun = json.load(han)
+  except (IOError, ValueError):
+    firstRun = {}
+  if (firstRun.get('dzptGood') is None) or not os.path.isfile(psfStoreName):
+    print('No PSF or calibration to reuse for {}; '.format(inputName)
+          + 'run maphot -p review on it again.')
+    return False
+  (inputFile, coordsfile, _, _, _, _, aprad, repfact, pxscale, _, _, extno,
+   _, _, _, resultsstore, _, precision, tag
+   ) = getArguments(readReviewRecord(inputName)['argv'])
+  choice, xUse, yUse = readOverride(inputName)
+  (data, header, EXPTIME, MAGZERO, MJD, MJDm, GAIN, _, _, WCS, FILTER
+   ) = getDataHeader(inputFile, extno=extno, dtype=PRECISIONS[precision])
+  rates, angles = EphemerisService(coordsfile).coordRateAngle(MJDm, WCS)[1:]
+  goodPSF = StoredPSF(psfStoreName)
+  fwhm = goodPSF.FWHM()
+  TNOPhot, bestap = measureTNO(data, xUse, yUse, fwhm, aprad,
+                               (EXPTIME / 3600.) * rates[0] / pxscale,
+                               angles[0], EXPTIME, MAGZERO, GAIN,
+                               repfact=repfact)
+  lineAperCorr = goodPSF.lineAperCorr(bestap * fwhm)
+  goodPSF.close()
+  # The calibration of the stars doesn't depend on the TNO.
+  zptGood, dmagCalibration = firstRun['zptGood'], firstRun['dzptGood']
+  magCalibration = zptGood - MAGZERO
+  finalTNOphotCFHT = (TNOPhot.magnitude - lineAperCorr + magCalibration,
+                      (TNOPhot.dmagnitude ** 2
+                       + dmagCalibration ** 2) ** 0.5)
+  finalTNOphotPS1 = CFHT_to_PS1(finalTNOphotCFHT[0], finalTNOphotCFHT[1],
+                                FILTER)
+  print('{} ({}): {} +/- {} at {} {}'.format(
+      inputName, choice, finalTNOphotPS1[0], finalTNOphotPS1[1], xUse, yUse))
+  TNOCoords = WCS.all_pix2world(xUse, yUse, 1)
+  timeNow = datetime.now().strftime('%Y-%m-%d/%H:%M:%S')
+  saveTNOMag2(inputFile, coordsfile, MJDm, TNOCoords, xUse, yUse,
+              FILTER, fwhm, finalTNOphotPS1, timeNow, __version__,
+              extno=extno, replace=True)
+  saveTNOMag(inputFile, coordsfile, MJD, MJDm, TNOCoords, xUse, yUse,
+             MAGZERO, FILTER, fwhm, bestap, TNOPhot,
+             magCalibration, dmagCalibration, finalTNOphotCFHT, zptGood,
+             finalTNOphotPS1, timeNow, np.array(TNOPhot.bgSamplingRegion),
+             __version__, extno=extno, tag='_' + tag if tag else '')
+  stars = firstRun['stars']
+  saveTrippySidecar(inputName, inputFile, extno, MJD, MJDm, MAGZERO,
+                    firstRun['MAGZERO_RMS'], zptGood, FILTER,
+                    {'objName': stars['objName'], 'XWIN_IMAGE': stars['x'],
+                     'YWIN_IMAGE': stars['y']}, stars, xUse, yUse,
+                    finalTNOphotPS1,
+                    (TNOPhot.magnitude - lineAperCorr, TNOPhot.dmagnitude),
+                    __version__, dzptGood=dmagCalibration)
+  if resultsstore is not None:  # The stars are unchanged, so not re-added.
+    appendRecords(resultsstore, 'tno', makeRecords(
+        'tno', image=os.path.basename(inputFile),
+        extno=-1 if extno is None else extno,
+        object=os.path.basename(coordsfile).replace('.mpc', ''),
+        mjd=MJD, mjdMid=MJDm, ra=TNOCoords[0], dec=TNOCoords[1],
+        x=xUse, y=yUse, filter=FILTER, fwhm=fwhm, aperture=bestap,
+        magRaw=TNOPhot.magnitude, dmagRaw=TNOPhot.dmagnitude,
+        zptRaw=MAGZERO, magCalibration=magCalibration,
+        dmagCalibration=dmagCalibration, magInst=finalTNOphotCFHT[0],
+        dmagInst=finalTNOphotCFHT[1], zptGood=zptGood,
+        magPS1=finalTNOphotPS1[0], dmagPS1=finalTNOphotPS1[1],
+        flux=TNOPhot.sourceFlux, snr=TNOPhot.snr, bg=TNOPhot.bg,
+        bgXMin=TNOPhot.bgSamplingRegion[0],
+        bgXMax=TNOPhot.bgSamplingRegion[1],
+        bgYMin=TNOPhot.bgSamplingRegion[2],
+        bgYMax=TNOPhot.bgSamplingRegion[3],
+        runTime=timeNow, version=__version__))
+  # The line of the first run is made again from its sidecar, to replace it.
+  firstLine = pix2MPCBatch(WCS, EXPTIME, MJD, firstRun['tno']['mag'],
+                           firstRun['tno']['x'], firstRun['tno']['y'],
+                           FILTER, mpcReportName(extno, tag)[0])[0]
+  pix2MPC(WCS, EXPTIME, MJD, finalTNOphotPS1[0], xUse, yUse, FILTER, extno,
+          replace=firstLine, tag=tag)
+  return True
+
+
+def applyOverrides(overrideFile, rerun=True):
+  '''Store the reviewer's overrides and redo the TNO photometry of those
+  images (see rerunOverride).
+  Returns the list of inputNames that were overridden.'''
+  overridden = []
+  with open(overrideFile) as han:
+    lines = [line.split() for line in han
+             if line.strip() and not line.startswith('#')]
+  for words in lines:
+    inputName = words[0]
+    if len(words) not in (2, 3):
+      print('Expected "<inputName> S|M|e" or "<inputName> x y", not '
+            + '"{}"; skipping.'.format(' '.join(words)))
+      continue
+    record = readReviewRecord(inputName)
+    if not record:
+      print('No review record for {}, skipping.'.format(inputName))
+      continue
+    if len(words) == 3:
+      override = {'choice': 'U', 'x': float(words[1]), 'y': float(words[2])}
+    elif words[1] in (record.get('candidates') or {}):
+      xc, yc = record['candidates'][words[1]]
+      override = {'choice': words[1], 'x': xc, 'y': yc}
+    else:
+      print('{} has no {} centroid, skipping.'.format(inputName, words[1]))
+      continue
+    writeReviewRecord(inputName, {'override': override})
+    overridden.append(inputName)
+  if rerun:
+    for inputName in overridden:
+      rerunOverride(inputName)
+  writeGallery()
+  return overridden
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = 'review -o <overridesfile> [-r <rerun>] | review -g'
+  overrideFile = None
+  rerun = True
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "o:r:gh",
+                                   ["overrides=", "rerun=", "gallery"])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-o', '--overrides'):
+      overrideFile = arg
+    elif opt in ('-r', '--rerun'):
+      rerun = arg not in ('0', 'False')
+  return overrideFile, rerun
+
+
+if __name__ == '__main__':
+  overrides, rerunMaphot = getArguments(sys.argv)
+  if overrides is None:
+    writeGallery()
+  else:
+    applyOverrides(overrides, rerun=rerunMaphot)
+
+
+# End of file.
+# Nothing to see here.
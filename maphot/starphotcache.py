@@ -0,0 +1,82 @@
+"""
+A cache of the reference-star photometry of an image.
+
+The photometry of the catalogue stars only depends on the image, the stars
+(from best.cat), the FWHM, the aperture radius, the zero point, the
+exposure time, the gain and repFact, not on which TNO is being measured.
+So when an image is run again (for another TNO, or after a crash), the
+star magnitudes, uncertainties, fluxes, SNRs and backgrounds are read back
+from <cacheDir>/<image>_<extno>_<key>.npz instead of being measured again.
+The key is a hash of all of those inputs, including the image's size and
+modification time and the star positions, so any change makes a new entry.
+Magnitudes are stored before the aperture correction.
+"""
+from __future__ import print_function, division
+import os
+import hashlib
+import zipfile
+import numpy as np
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+STARPHOT_VERSION = 1
+STARPHOT_QUANTITIES = ['mag', 'dmag', 'flux', 'snr', 'bg']
+
+
+def fileSignature(fileName):
+  '''Name, size and modification time of a file, which change whenever the
+  file does.'''
+  status = os.stat(fileName)
+  return '{}:{}:{}'.format(os.path.abspath(fileName), status.st_size,
+                           status.st_mtime)
+
+
+def starPhotKey(inputFile, extno, bestCatName, fwhm, radius, zeroPoint,
+                exptime, gain, repFact, x, y):
+  '''SHA1 hash of everything the star photometry of an image depends on.'''
+  parameters = np.array([fwhm, radius, zeroPoint, exptime, gain, repFact],
+                        dtype=np.float64)
+  sha1 = hashlib.sha1('{}|{}|{}|{}'.format(
+      STARPHOT_VERSION, fileSignature(inputFile), extno,
+      fileSignature(bestCatName)).encode())
+  for values in (parameters, x, y):
+    sha1.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+  return sha1.hexdigest()
+
+
+def starPhotFile(cacheDir, inputFile, extno, key):
+  '''The file name of a cache entry.'''
+  return os.path.join(cacheDir, '{}_{}_{}.npz'.format(
+      os.path.basename(inputFile).replace('.fits', ''),
+      -1 if extno is None else int(extno), key[:16]))
+
+
+def loadStarPhot(cacheDir, inputFile, extno, key):
+  '''The cached star photometry (a dictionary of STARPHOT_QUANTITIES
+  arrays), or None if this exact measurement hasn't been cached, or its
+  entry is truncated, corrupt or from another version.'''
+  try:
+    with np.load(starPhotFile(cacheDir, inputFile, extno, key)) as han:
+      if str(han['key']) != key:
+        return None
+      return dict((name, han[name]) for name in STARPHOT_QUANTITIES)
+  except (IOError, EOFError, ValueError, KeyError, zipfile.BadZipfile):
+    return None
+
+
+def saveStarPhot(cacheDir, inputFile, extno, key, starPhot):
+  '''Cache starPhot, a dictionary of STARPHOT_QUANTITIES arrays.
+  Written under a temporary name and renamed, so that parallel runs on the
+  same image never read a half-written entry.'''
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  entryFile = starPhotFile(cacheDir, inputFile, extno, key)
+  tmpFile = entryFile[:-4] + '.tmp{}.npz'.format(os.getpid())
+  np.savez(tmpFile, key=key, **dict(
+      (name, np.asarray(starPhot[name], dtype=np.float64))
+      for name in STARPHOT_QUANTITIES))
+  os.rename(tmpFile, entryFile)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+"""
+A pre-forked worker pool for running many short maphot tasks.
+
+Running maphot.py once per image spends most of a short task importing
+numpy, astropy, trippy, mp_ephem and the rest of maphot. Instead,
+  worker.py -n 8 -t maphot_commands.sh
+imports all of that (PRELOAD) once, then forks a Pool of n processes, which
+inherit the imported modules and each run many tasks. A task is one line of
+the tasks file (as written by locator.py), a maphot command line like
+  maphot.py -c obj.mpc -f a100.fits -e 12 -p auto
+which is run with maphot.py as __main__ in the worker, as if it had been
+started from the command line, but without starting Python again.
+Blank lines and lines starting with # are skipped. Tasks should not ask any
+questions (use -p auto or -p review). Tasks on the same image and extension
+(e.g. several objects on one CCD) share the Source Extractor catalogue and
+other files of that image, so they are run one after another, by the same
+worker, in the order of the file; give each its own -t <object> (as
+locator.py does), so that they don't overwrite each other's results.
+With -l <logdirectory>, the output of each task goes to
+<logdirectory>/task<number>.log instead of the screen.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import getopt
+import shlex
+import runpy
+import warnings
+import importlib
+import multiprocessing
+from collections import OrderedDict
+from timeit import default_timer
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+MAPHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maphot.py')
+
+# Everything a headless maphot run imports, slowest first.
+PRELOAD = ['numpy', 'scipy', 'astropy.io.fits', 'astropy.wcs',
+           'astropy.table', 'astropy.io.votable', 'requests', 'mp_ephem',
+           'dill', 'trippy.pill', 'trippy.psf', 'trippy.psfStarChooser',
+           'trippy.scamp', 'trippy.MCMCfit', 'matplotlib.figure',
+           'matplotlib.backends.backend_agg', 'maphot_functions', 'best',
+           'review', 'psfstore', 'apercorr', 'ephemeris', 'resultsstore',
+           'starphotcache', 'metrics']
+
+
+def preload(modules=None):
+  '''Import modules (default PRELOAD) once, before forking.
+  Returns the time it took and the modules that couldn't be imported.'''
+  start = default_timer()
+  missing = []
+  for module in PRELOAD if modules is None else modules:
+    try:
+      importlib.import_module(module)
+    except ImportError as error:
+      missing.append((module, error))
+  return default_timer() - start, missing
+
+
+def readTasks(tasksFile):
+  '''The maphot arguments of each line of a tasks file (- for stdin),
+  without any leading python or maphot.py.'''
+  han = sys.stdin if tasksFile == '-' else open(tasksFile)
+  tasks = []
+  for line in han:
+    if (not line.strip()) or line.lstrip().startswith('#'):
+      continue
+    arguments = shlex.split(line)
+    while arguments and (os.path.basename(arguments[0]).startswith('python')
+                         or (os.path.basename(arguments[0]) == 'maphot.py')):
+      arguments = arguments[1:]
+    tasks.append(arguments)
+  if han is not sys.stdin:
+    han.close()
+  return tasks
+
+
+def imageOf(arguments):
+  '''The image and extension (maphot -f and -e) of a task.'''
+  flags = {'-f': 0, '--imagefile': 0, '-e': 1, '--extension': 1}
+  imageExt = [None, None]
+  for argument, value in zip(arguments, list(arguments[1:]) + [None]):
+    if argument in flags:
+      imageExt[flags[argument]] = value
+    elif argument.split('=')[0] in flags:
+      imageExt[flags[argument.split('=')[0]]] = argument.split('=', 1)[1]
+  return tuple(imageExt)
+
+
+def runTask(task):
+  '''Run one task, (number, maphot arguments, log directory or None), with
+  maphot.py as __main__. Returns the number, the exit status (0, the
+  status it exited with, or the error) and the wall time.
+  Warning filters set by the task (maphot -i True) are undone afterwards,
+  so they don't leak into the next task run by the same worker.'''
+  number, arguments, logDirectory = task
+  savedArgv, savedStdout = sys.argv, sys.stdout
+  sys.argv = [MAPHOT] + list(arguments)
+  if logDirectory is not None:
+    sys.stdout = open(os.path.join(logDirectory,
+                                   'task{}.log'.format(number)), 'w')
+  start = default_timer()
+  try:
+    with warnings.catch_warnings():
+      runpy.run_path(MAPHOT, run_name='__main__')
+    status = 0
+  except SystemExit as exitError:  # maphot only exits when it can't run.
+    status = 1 if exitError.code is None else exitError.code
+  except Exception as error:  # pylint: disable=broad-except
+    status = repr(error)
+  finally:
+    if logDirectory is not None:
+      sys.stdout.close()
+    sys.argv, sys.stdout = savedArgv, savedStdout
+  return number, status, default_timer() - start
+
+
+def runTaskGroup(group):
+  '''Run a list of tasks (see runTask) one after another.'''
+  return [runTask(task) for task in group]
+
+
+def makePool(nprocesses, tasksPerChild=None):
+  '''A Pool of nprocesses forked workers, which inherit what has been
+  imported so far. Each is replaced after tasksPerChild tasks, if given.'''
+  if hasattr(multiprocessing, 'get_context'):  # Forking isn't the default
+    context = multiprocessing.get_context('fork')  # everywhere in Python 3.
+  else:
+    context = multiprocessing
+  return context.Pool(nprocesses, maxtasksperchild=tasksPerChild)
+
+
+def runTasks(tasks, nprocesses=1, logDirectory=None, tasksPerChild=None):
+  '''Run tasks (lists of maphot arguments) on a Pool of nprocesses, printing
+  the outcome of each as it finishes. Tasks on the same image and extension
+  are never run at the same time. Returns the number that failed.'''
+  if (logDirectory is not None) and not os.path.isdir(logDirectory):
+    os.makedirs(logDirectory)
+  groups = OrderedDict()
+  for number, arguments in enumerate(tasks):
+    groups.setdefault(imageOf(arguments), []).append(
+        (number, arguments, logDirectory))
+  pool = makePool(nprocesses, tasksPerChild)
+  failed = 0
+  for results in pool.imap_unordered(runTaskGroup, list(groups.values())):
+    for number, status, wall in results:
+      failed += status != 0
+      print('task{} ({:.1f}s): {}: {}'.format(
+          number, wall, 'ok' if status == 0 else status,
+          ' '.join(tasks[number])))
+  pool.close()
+  pool.join()
+  return failed
+
+
+def getArguments(sysargv):
+  '''Get arguments given when this is called from a command line'''
+  useage = ('worker -t <tasksfile> [-n <nprocesses> -l <logdirectory> '
+            + '-m <tasksperchild>]')
+  tasksFile, nprocesses, logDirectory, tasksPerChild = None, 1, None, None
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "t:n:l:m:h",
+                                   ["tasks=", "nprocesses=", "logs=",
+                                    "tasksperchild="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-t', '--tasks'):
+      tasksFile = arg
+    elif opt in ('-n', '--nprocesses'):
+      nprocesses = int(arg)
+    elif opt in ('-l', '--logs'):
+      logDirectory = arg
+    elif opt in ('-m', '--tasksperchild'):
+      tasksPerChild = int(arg) or None
+  if tasksFile is None:
+    print(useage)
+    sys.exit(2)
+  return tasksFile, nprocesses, logDirectory, tasksPerChild
+
+
+if __name__ == '__main__':
+  TASKSFILE, NPROCESSES, LOGDIRECTORY, TASKSPERCHILD = getArguments(sys.argv)
+  TASKS = readTasks(TASKSFILE)
+  PRELOADTIME, MISSING = preload()
+  print('Imported maphot in {:.1f}s'.format(PRELOADTIME))
+  for MODULE, ERROR in MISSING:
+    print('Could not preload {}: {}'.format(MODULE, ERROR))
+  FAILED = runTasks(TASKS, NPROCESSES, LOGDIRECTORY, TASKSPERCHILD)
+  print('{} of {} tasks failed.'.format(FAILED, len(TASKS)))
+  sys.exit(1 if FAILED else 0)
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+"""
+Global zero-point solution of a whole sequence of frames at once.
+
+Rather than calibrating each image on its own and then averaging the
+stars again (photcor's old ddzero), solveZeroPoints fits the zero-point
+offset of every frame and the magnitude of every star together, to the
+whole frames x stars matrix of star magnitudes:
+  mag[f, s] = starMag[s] + offset[f]
+as one sparse, weighted least-squares problem, with iteratively reweighted
+(Huber) weights so that variable stars, cosmic rays and bad frames don't
+drag the solution. The star block of the sparse normal equations is
+diagonal, so each solve only needs a dense (nframes x nframes) Schur
+complement, and hundreds of frames solve in a fraction of a second.
+The calibrated magnitude of anything measured in frame f is then
+mag - offset[f].
+Without anchoring, the offsets are relative (they average to zero).
+Optionally the star magnitudes are anchored to catalogue (PS1) magnitudes,
+  refMag[s] = starMag[s] + colourTerm * refColour[s],
+which makes the offsets absolute and fits one colour term.
+Usage:
+  zpsolver.py -c <cubedir> [-a <anchor (0/1)>] [-o <outputfile>]
+"""
+from __future__ import print_function, division
+import sys
+import getopt
+import numpy as np
+from scipy import sparse
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+HUBER_K = 2.  # Residuals beyond this many sigma get down-weighted.
+ERROR_FLOOR = 0.005  # Minimum magnitude error (mag), added in quadrature.
+ANCHOR_ERROR = 0.02  # Error of catalogue magnitudes, if not given (mag).
+GAUGE_WEIGHT = 1e3  # Weight of the sum(offsets) = 0 row, when not anchored.
+
+
+def huberWeights(normalisedResiduals, k=HUBER_K):
+  '''Huber weights (1 inside k sigma, k/|r| outside) of residuals that
+  are already divided by their errors.'''
+  absolute = np.abs(normalisedResiduals)
+  return np.where(absolute <= k, 1., k / np.maximum(absolute, k))
+
+
+def extraRows(nframes, nstars, anchorStars, refMag, refColour, refErr,
+              fitColour):
+  '''The sparse rows (and right-hand sides and errors) that are not star
+  measurements: the anchoring of anchorStars to refMag (and the colour term,
+  the last column, if fitColour), or, without anchor stars, the row that
+  makes the offsets average to zero.'''
+  ncolumns = nframes + nstars + int(fitColour)
+  if len(anchorStars) == 0:
+    gauge = sparse.csr_matrix((np.ones(nframes), (np.zeros(nframes),
+                                                  np.arange(nframes))),
+                              shape=(1, ncolumns))
+    return gauge, np.zeros(1), np.ones(1) / GAUGE_WEIGHT
+  rows = np.arange(len(anchorStars))
+  values = [np.ones(len(anchorStars))]
+  columns = [nframes + anchorStars]
+  if fitColour:
+    values.append(np.asarray(refColour, dtype=np.float64)[anchorStars])
+    columns.append(np.full(len(anchorStars), ncolumns - 1))
+  anchorA = sparse.csr_matrix(
+      (np.concatenate(values), (np.tile(rows, len(values)),
+                                np.concatenate(columns))),
+      shape=(len(anchorStars), ncolumns))
+  anchorErr = (np.full(len(anchorStars), ANCHOR_ERROR) if refErr is None
+               else np.asarray(refErr, dtype=np.float64)[anchorStars])
+  return (anchorA, np.asarray(refMag, dtype=np.float64)[anchorStars],
+          anchorErr)
+
+
+def solveZeroPoints(mag, dmag, usestars=None, refMag=None, refColour=None,
+                    refErr=None, colourTerm=True, maxiter=20, tol=1e-4,
+                    verbose=False):
+  '''
+  Solve for the zero-point offset of every frame and the magnitude of
+  every star at once.
+  mag and dmag are (nframes, nstars) arrays; NaNs (stars not measured in a
+  frame) are ignored, so stars don't need to be in every frame.
+  usestars is a boolean mask of the stars to fit (default all).
+  With refMag (nstars, NaN where unknown), the star magnitudes are anchored
+  to it (with errors refErr, default ANCHOR_ERROR), fitting a colour term
+  against refColour if that is given and colourTerm is True.
+  Reweighting stops when no offset (or colour term) changes by more than
+  tol; the magnitudes of variable stars may take much longer to settle.
+  Returns a dictionary of
+    offset, offsetErr: per frame (subtract offset to calibrate);
+    starMag, starMagErr: per star (NaN for stars not fitted);
+    colourTerm: the fitted colour term (0 if not fitted);
+    weights, residuals: (nframes, nstars), the final robust weights and
+                        residuals (NaN where not used);
+    chi2: reduced chi squared; niter: number of reweighting iterations.
+  '''
+  mag = np.asarray(mag, dtype=np.float64)
+  dmag = np.asarray(dmag, dtype=np.float64)
+  nframes, nstars = mag.shape
+  usestars = (np.ones(nstars, dtype=bool) if usestars is None
+              else np.asarray(usestars, dtype=bool))
+  good = np.isfinite(mag) & np.isfinite(dmag) & usestars
+  fitted = np.any(good, axis=0)
+  # Measurements are kept as (nframes, nstars) arrays, with zero weight
+  # where there is no measurement.
+  values = np.where(good, mag, 0.)
+  errors = np.where(good, np.sqrt(np.where(good, dmag, 0.) ** 2
+                                  + ERROR_FLOOR ** 2), 1.)
+  anchored = np.zeros(nstars, dtype=bool)
+  if refMag is not None:
+    anchored = np.isfinite(refMag) & fitted
+  fitColour = (bool(np.any(anchored)) and colourTerm
+               and (refColour is not None))
+  if fitColour:
+    anchored &= np.isfinite(refColour)
+  extraA, extraB, extraErr = extraRows(nframes, nstars,
+                                       np.nonzero(anchored)[0], refMag,
+                                       refColour, refErr, fitColour)
+  # Columns: nframes offsets, nstars magnitudes and the colour term.
+  # The normal matrix of the extra rows doesn't change, so it is split
+  # into the blocks of solveBlocks once.
+  small = np.arange(nframes)
+  if fitColour:
+    small = np.append(small, nframes + nstars)
+  large = np.arange(nframes, nframes + nstars)
+  extraNormal = (extraA.T @ sparse.diags(extraErr ** -2.) @ extraA).tocsr()
+  extraRHS = extraA.T @ (extraB / extraErr ** 2)
+  extraSmall = extraNormal[small][:, small].toarray()
+  extraCross = extraNormal[large][:, small].toarray()
+  extraDiagonal = extraNormal.diagonal()[large]
+  robust = good.astype(np.float64)
+  solution, variances = np.zeros([2, nframes + nstars + int(fitColour)])
+  for iteration in np.arange(maxiter):
+    w2 = (robust / errors) ** 2
+    smallBlock = extraSmall.copy()
+    smallBlock[np.arange(nframes), np.arange(nframes)] += np.sum(w2, axis=1)
+    cross = extraCross.copy()
+    cross[:, :nframes] += w2.T
+    rhsSmall = extraRHS[small]
+    rhsSmall[:nframes] += np.sum(w2 * values, axis=1)
+    largeDiagonal = extraDiagonal + np.sum(w2, axis=0)
+    previous = solution.copy()
+    (solution[small], solution[large], smallCovariance
+     ) = solveBlocks(smallBlock, largeDiagonal, cross, rhsSmall,
+                     extraRHS[large] + np.sum(w2 * values, axis=0))
+    residuals = (values - solution[:nframes, np.newaxis]
+                 - np.where(fitted, solution[large], 0.))
+    robust = np.where(good, huberWeights(residuals / errors), 0.)
+    change = np.max(np.abs(solution[small] - previous[small]))
+    if verbose:
+      print('Iteration {}: {} down-weighted measurements'.format(
+          iteration + 1, np.sum(good & (robust < 1))))
+    if change < tol:
+      break
+  variances[small] = np.diag(smallCovariance)
+  variances[large] = largeVariances(cross, largeDiagonal, smallCovariance)
+  extraResiduals = extraB - extraA @ np.nan_to_num(solution)
+  dof = max(np.sum(good) + len(extraB) - len(solution), 1)
+  chi2 = (np.sum(w2 * residuals ** 2)
+          + np.sum((extraResiduals / extraErr) ** 2)) / dof
+  errors = np.sqrt(variances * max(chi2, 1.))
+  result = {'offset': solution[:nframes],
+            'offsetErr': errors[:nframes],
+            'starMag': np.where(fitted, solution[large], np.nan),
+            'starMagErr': np.where(fitted, errors[large], np.nan),
+            'colourTerm': solution[-1] if fitColour else 0.,
+            'weights': np.full((nframes, nstars), np.nan),
+            'residuals': np.full((nframes, nstars), np.nan),
+            'chi2': chi2, 'niter': iteration + 1}
+  result['weights'][good] = robust[good]
+  result['residuals'][good] = residuals[good]
+  return result
+
+
+def solveBlocks(smallBlock, largeDiagonal, cross, rhsSmall, rhsLarge):
+  '''Solve the normal equations
+    [[smallBlock, cross.T], [cross, diag(largeDiagonal)]] x = rhs
+  and return the small and large parts of x and the small block of the
+  inverse normal matrix (the covariance of the offsets).
+  Every measurement involves one star only, so the star-star block is
+  diagonal and only the (nframes x nframes) Schur complement of the small
+  block (the offsets and the colour term) needs a dense solve.
+  Stars that are never measured get NaN.'''
+  known = largeDiagonal > 0
+  inverse = np.where(known, 1. / np.where(known, largeDiagonal, 1.), 0.)
+  schur = smallBlock - cross.T @ (inverse[:, np.newaxis] * cross)
+  smallCovariance = np.linalg.pinv(schur, hermitian=True)
+  xSmall = smallCovariance @ (rhsSmall - cross.T @ (inverse * rhsLarge))
+  xLarge = np.where(known, inverse * (rhsLarge - cross @ xSmall), np.nan)
+  return xSmall, xLarge, smallCovariance
+
+
+def largeVariances(cross, largeDiagonal, smallCovariance):
+  '''The star-magnitude part of the diagonal of the inverse normal matrix
+  of solveBlocks (NaN for stars that are never measured).'''
+  known = largeDiagonal > 0
+  inverse = np.where(known, 1. / np.where(known, largeDiagonal, 1.), 0.)
+  return np.where(known, inverse + inverse ** 2 * np.sum(
+      cross * (cross @ smallCovariance), axis=1), np.nan)
+
+
+def getArguments(sysargv):
+  """Get arguments given when this is called from a command line"""
+  useage = "zpsolver -c <cubedir> [-a <anchor (0/1)> -o <outputfile>]"
+  cubeDir, anchor, outFile = 'photcube', False, 'zeropoints.txt'
+  try:
+    options, dummy = getopt.getopt(sysargv[1:], "c:a:o:h",
+                                   ["cube=", "anchor=", "output="])
+  except getopt.GetoptError:
+    print(" Input ERROR! \n", useage)
+    sys.exit(2)
+  for opt, arg in options:
+    if opt == '-h':
+      print(useage)
+    elif opt in ('-c', '--cube'):
+      cubeDir = arg
+    elif opt in ('-a', '--anchor'):
+      anchor = arg in ('1', 'True')
+    elif opt in ('-o', '--output'):
+      outFile = arg
+  return cubeDir, anchor, outFile
+
+
+if __name__ == '__main__':
+  from photcube import loadCube
+  CUBEDIR, ANCHOR, OUTFILE = getArguments(sys.argv)
+  CUBE = loadCube(CUBEDIR)
+  SOLUTION = solveZeroPoints(CUBE['mag'], CUBE['dmag'],
+                             refMag=(CUBE['stars']['refMag'] if ANCHOR
+                                     else None),
+                             refColour=CUBE['stars']['refColour'],
+                             verbose=True)
+  with open(OUTFILE, 'w') as han:
+    han.write('#image extno mjdMid offset offsetErr\n' + ''.join(
+        '{} {} {:.6f} {:.5f} {:.5f}\n'.format(
+            frame['image'].decode(), frame['extno'], frame['mjdMid'],
+            offset, offsetErr)
+        for frame, offset, offsetErr in zip(CUBE['frames'],
+                                            SOLUTION['offset'],
+                                            SOLUTION['offsetErr'])))
+  print('Zero-point offsets of {} frames written to {} '.format(
+      len(CUBE['frames']), OUTFILE)
+        + '(reduced chi2 {:.2f}, colour term {:.4f})'.format(
+            SOLUTION['chi2'], SOLUTION['colourTerm']))
+
+
+# End of file.
+# Nothing to see here.
@@ -0,0 +1,70 @@
+"""
+Regression tests for photcor.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'maphot'))
+import photcor  # noqa: E402
+from phottransforms import toPS1  # noqa: E402
+from resultsstore import appendRecords, makeRecords  # noqa: E402
+__author__ = ('Mike Alexandersen (@mikea1985, github: mikea1985, '
+              'mike.alexandersen@alumni.ubc.ca)')
+
+TRUE_MAG = 22.0  # PS1 magnitude of the TNO in every frame.
+ZPT_RAW = 27.0
+
+
+def makeFlatStore(storeDir, nframes=8, nstars=40, seed=3):
+  '''A results store, as maphot -R writes it, of a TNO whose calibrated
+  magPS1 is TRUE_MAG in every frame, while the instrumental magnitudes of
+  the stars (and the TNO) are off by +-0.3 mag from frame to frame.
+  Returns the offsets.'''
+  rng = np.random.default_rng(seed)
+  offsets = 0.3 * np.where(np.arange(nframes) % 2, 1., -1.)
+  offsets *= rng.uniform(0.5, 1., nframes)
+  refMag = rng.uniform(16., 20., nstars)
+  refColour = rng.uniform(0.3, 1.2, nstars)
+  images = np.array(['flat{:02d}.fits'.format(ii) for ii in range(nframes)])
+  mjd = 58000. + np.arange(nframes) / 24.
+  # The instrumental magnitudes are relative to ZPT_RAW, not 26.
+  dzero = ZPT_RAW - 26.
+  mag = (refMag + offsets[:, np.newaxis] - dzero
+         + rng.normal(0, 0.002, (nframes, nstars)))
+  appendRecords(storeDir, 'stars', makeRecords(
+      'stars', nframes * nstars, image=np.repeat(images, nstars), extno=1,
+      mjdMid=np.repeat(mjd, nstars),
+      objName=np.tile(['star{:03d}'.format(jj) for jj in range(nstars)],
+                      nframes),
+      x=np.tile(rng.uniform(0, 2000, nstars), nframes),
+      y=np.tile(rng.uniform(0, 4000, nstars), nframes), filter='r',
+      mag=mag.ravel(), dmag=0.002, refMag=np.tile(refMag, nframes),
+      refColour=np.tile(refColour, nframes)))
+  conversion = toPS1(0., 0., 'CFHT', 'r')[0]
+  magInst = np.full(nframes, TRUE_MAG - conversion)
+  lineAperCorr = 0.1
+  appendRecords(storeDir, 'tno', makeRecords(
+      'tno', nframes, image=images, object='flat', extno=1, mjd=mjd,
+      mjdMid=mjd, x=1000., y=2000., filter='r',
+      magRaw=magInst + offsets - dzero + lineAperCorr, dmagRaw=0.01,
+      zptRaw=ZPT_RAW, magCalibration=dzero - offsets,
+      dmagCalibration=0.01, magInst=magInst, dmagInst=0.014,
+      magPS1=TRUE_MAG, dmagPS1=0.014))
+  return offsets
+
+
+def test_anchoredCalibrationOfCalibratedStore(tmp_path):
+  '''The per-frame offsets are applied to the TNO once, not on top of
+  maphot's own calibration, so a flat light curve stays flat.'''
+  storeDir = str(tmp_path / 'results')
+  makeFlatStore(storeDir)
+  result = photcor.calibrate(storedir=storeDir, objectname='flat',
+                             cubedir=str(tmp_path / 'photcube'),
+                             anchor=True)
+  assert np.allclose(result['magobj_done'], TRUE_MAG, atol=0.01)
+
+
+# End of file.
+# Nothing to see here.